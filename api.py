@@ -1,18 +1,33 @@
-from fastapi import FastAPI, HTTPException, Query, status, Request, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, status, Request, Body, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from psycopg2.extras import DictCursor
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Dict, Optional, Union
+import functools
+import inspect
 import json
 import re
 from datetime import datetime
 import os
-from db import execute_query
-import math
-from openai import OpenAI  # 正确导入OpenAI客户端
+from db import execute_query, get_connection, get_pool_stats, close_pool
+from outlet_store import SnapshotMiddleware, outlet_store
+from coverage_graph import COVERAGE_RADIUS_KM
+from intent_cache import describe_intent, intent_cache, normalize_query
+from intent_parser import intent_parser
+from query_planner import LOCATION_RESULT_LIMIT, build_plan, execute_plan, is_24hours, match_location, plan_response
+from singleflight import SingleFlight
+from fast_json import FastJSONResponse, dumps as json_dumps
+from pagination import Page
+from projection import Fields, parse_fields, project_row
+from etag import ETagMiddleware, etag_scope, now_or_date, stats as etag_stats
+from precompressed import PrecompressedMiddleware, stats as precompressed_stats
+from time_index import days_for, format_hhmm, iter_bits, parse_hhmm, MINUTES_PER_DAY
+import asyncio
+from spatial_index import parse_coordinates
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError  # 异步OpenAI客户端，调用期间不阻塞事件循环
+from circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget, guarded_call
 import time
-import psycopg2  # 添加psycopg2导入，因为connect_db函数需要
+import traceback
 
 # 创建FastAPI实例
 app = FastAPI(
@@ -21,6 +36,13 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# 静态门店接口的预压缩响应缓存，位于 ETag 中间件内层（先添加的中间件在内层）
+app.add_middleware(PrecompressedMiddleware)
+# 只读门店接口的 ETag / 304（304 响应同样经过 CORS 中间件）
+app.add_middleware(ETagMiddleware)
+# 每个请求固定一个门店快照；快照尚未加载时返回 503，而不是在事件循环里同步访问数据库
+app.add_middleware(SnapshotMiddleware)
+
 # 添加CORS中间件，允许跨域请求
 app.add_middleware(
     CORSMiddleware,
@@ -37,10 +59,26 @@ openai_api_key = os.getenv("OPENAI_API_KEY", "你的API密钥")
 print(
     f"OPENAI_API_KEY 是否存在: {openai_api_key != '你的API密钥' and len(openai_api_key) > 10}")
 
-# OpenAI客户端
+# OpenAI调用的超时、重试与熔断（OPENAI_BASE_URL 可指向本地模拟服务做测试）
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "8"))  # 一次调用（含重试和退避）的总时限（秒）
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))  # 单个请求最多重试次数
+OPENAI_RETRY_BUDGET_RATIO = float(os.getenv("OPENAI_RETRY_BUDGET_RATIO", "0.2"))  # 重试总量不超过调用量的该比例
+OPENAI_SLOW_CALL_SECONDS = float(os.getenv("OPENAI_SLOW_CALL_SECONDS", "5"))  # 超过该耗时的调用计为失败
+OPENAI_BREAKER_FAILURE_RATE = float(os.getenv("OPENAI_BREAKER_FAILURE_RATE", "0.5"))  # 熔断的失败率阈值
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))  # 熔断后多少秒尝试恢复
+
+openai_breaker = CircuitBreaker(
+    "openai",
+    failure_threshold=OPENAI_BREAKER_FAILURE_RATE,
+    slow_call_seconds=OPENAI_SLOW_CALL_SECONDS,
+    cooldown=OPENAI_BREAKER_COOLDOWN,
+)
+openai_retry_budget = RetryBudget(ratio=OPENAI_RETRY_BUDGET_RATIO)
+
+# OpenAI客户端（重试由 guarded_call 控制，关闭 SDK 自带的重试）
 client = None
 try:
-    client = OpenAI(api_key=openai_api_key)
+    client = AsyncOpenAI(api_key=openai_api_key, timeout=OPENAI_TIMEOUT, max_retries=0)
     print("✅ OpenAI客户端初始化成功")
 except Exception as e:
     print(f"⚠️ 警告: 无法初始化OpenAI客户端: {e}")
@@ -54,21 +92,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 数据库连接函数
-DB_NAME = "subway_db" 
-DB_USER = "neondb_owner" 
-DB_PASSWORD = "npg_c7TZpqPHBg9L" 
-DB_HOST = "ep-blue-leaf-a5q7udps-pooler.us-east-2.aws.neon.tech"  
-DB_PORT = "5432"  
-
+# 数据库连接函数 - 从进程级连接池借出，conn.close() 即归还
 def connect_db():
-    return psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+    return get_connection()
 
 
 def get_db_connection():
@@ -150,31 +176,6 @@ def convert_12h_to_24h(time_str):
         print(f"时间转换出错: {str(e)}")
         return "0000"  # 解析失败
 
-# 距离计算函数
-
-
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """计算两点之间的距离（公里）"""
-    if not all([lat1, lon1, lat2, lon2]):
-        return float('inf')  # 如果有缺失值，返回无穷大
-    
-    try:
-        lat1, lon1 = float(lat1), float(lon1)
-        lat2, lon2 = float(lat2), float(lon2)
-        
-        R = 6371  # 地球半径（公里）
-        dLat = math.radians(lat2 - lat1)
-        dLon = math.radians(lon2 - lon1)
-        a = (math.sin(dLat / 2) * math.sin(dLat / 2) +
-             math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-             math.sin(dLon / 2) * math.sin(dLon / 2))
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        distance = R * c
-        return distance
-    except Exception as e:
-        print(f"Error calculating distance: {e}")
-        return float('inf')
-
 # 查询请求体
 
 
@@ -182,277 +183,65 @@ class ChatRequest(BaseModel):
     query: str
     lat: Optional[float] = None  # 可选：用户当前位置纬度
     lon: Optional[float] = None  # 可选：用户当前位置经度
+    explain: bool = False  # 可选：附带查询计划和各阶段耗时（仅 /chatbot/query）
+    fields: Optional[str] = None  # 可选：逗号分隔的字段，响应附带这些列的店铺数据（outlets），前端不必再拉全量 /outlets
+
+    @field_validator("fields")
+    @classmethod
+    def _normalize_fields(cls, value):
+        """校验字段名，并规范为排序后的字符串（相同字段组合的请求可以合并）"""
+        names = parse_fields(value)
+        return ",".join(sorted(names)) if names else None
+
+
+# 批量聊天请求：最多多少条问题、同时处理多少条
+CHATBOT_BATCH_MAX_ITEMS = int(os.getenv("CHATBOT_BATCH_MAX_ITEMS", "50"))
+CHATBOT_BATCH_CONCURRENCY = int(os.getenv("CHATBOT_BATCH_CONCURRENCY", "8"))
+
+
+class ChatBatchRequest(BaseModel):
+    queries: List[ChatRequest] = Field(..., min_length=1, max_length=CHATBOT_BATCH_MAX_ITEMS)
+
+def fast_json_response(func):
+    """端点的返回值直接用 orjson 编码（跳过 FastAPI 的 jsonable_encoder）
+
+    返回值中 outlets 列表里与快照一致的行使用快照预编码的 JSON 片段。
+    同时为端点增加 fields 查询参数（稀疏字段）：outlets 中的行只返回请求的列，
+    只裁剪和编码要返回的行，端点本身不需要处理该参数。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        content = func(*args, **kwargs)
+        if isinstance(content, Response):
+            return content
+        if isinstance(content, dict) and isinstance(content.get("outlets"), list):
+            names = fields.names if isinstance(fields, Fields) else None
+            content = dict(content, outlets=outlet_store.snapshot().encode_rows(content["outlets"], names))
+        return FastJSONResponse(content)
+
+    signature = inspect.signature(func)
+    fields_param = inspect.Parameter("fields", inspect.Parameter.KEYWORD_ONLY, default=Depends(Fields), annotation=Fields)
+    wrapper.__signature__ = signature.replace(parameters=[*signature.parameters.values(), fields_param])
+    return wrapper
 
 # === 核心查询功能 ===
 
 # 1. 位置相关查询
 
 
-def find_outlets_by_location(location_query):
-    """查找特定位置的门店"""
-    conn = connect_db()
+def find_outlets_by_location(location_query, limit=LOCATION_RESULT_LIMIT):
+    """查找特定位置的门店
+
+    所有匹配策略都在快照的三元组倒排索引上完成（等价于原来的 ILIKE '%词%' 查询，见 query_planner.match_location），
+    同一策略内的结果按相关度排序，最多返回 limit 家（None 为不限制）。
+    """
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 尝试直接邮编匹配
-            if location_query.isdigit() and len(location_query) == 5:
-                print(f"尝试邮编精确匹配: {location_query}")
-                cur.execute(
-    "SELECT * FROM subway_outlets WHERE address ILIKE %s OR postcode = %s", [
-        f'%{location_query}%', location_query])
-                postcode_results = [dict(r) for r in cur.fetchall()]
-                if postcode_results:
-                    print(f"邮编匹配成功，找到 {len(postcode_results)} 个结果")
-                    return postcode_results
-            
-            # 邮编范围匹配 - 吉隆坡和雪兰莪地区邮编范围
-            postcode_ranges = {
-                # 吉隆坡地区
-                "City Centre": ["50000", "50999"],
-                "Taman Tun Dr Ismail": ["60000"],
-                "Ampang": ["68000"],
-                "Batu Caves": ["68100"],
-                "Bukit Bintang": ["55100"],
-                "Cheras": ["56000"],
-                "Kepong": ["52100"],
-                "Setapak": ["53000"],
-                "Wangsa Maju": ["53300"],
-                "Bangsar": ["59000"],
-                "Brickfields": ["50470"],
-                "Mont Kiara": ["50480"],
-                "Sri Hartamas": ["50480"],
-                "Seputeh": ["58000"],
-                "Bukit Jalil": ["57000"],
-                "Sri Petaling": ["57000"],
-                "Desa Petaling": ["57100"],
-                "Taman Desa": ["58100"],
-                "Kuchai Lama": ["58200"],
-                "Salak South": ["57100"],
-                "Sungai Besi": ["57000"],
-                # 雪兰莪地区
-                "Petaling Jaya": ["46000", "46999"],
-                "Subang Jaya": ["47500", "47630"],
-                "UEP Subang Jaya (USJ)": ["47600"],
-                "Bandar Sunway": ["47500"],
-                "Puchong": ["47100"],
-                "Seri Kembangan": ["43300"],
-                "Putra Heights": ["47650"],
-                "Kota Damansara": ["47810"],
-                "Ara Damansara": ["47301"],
-                "Damansara Jaya": ["47400"],
-                "Damansara Utama": ["47400"],
-                "Mutiara Damansara": ["47800"],
-                "Bandar Utama": ["47800"],
-                "Kelana Jaya": ["47301"],
-                "Gombak": ["68100"],
-                "Selayang": ["68100"],
-                "Rawang": ["48000"],
-                "Kundang": ["48050"],
-                "Kuang": ["48050"],
-                "Taman Melawati": ["53100"],
-                "Taman Sri Gombak": ["68100"],
-                "Setiawangsa": ["54200"],
-                "Klang": ["41000", "41999"],
-                "Port Klang": ["42000"],
-                "Kapar": ["42200"],
-                "Meru": ["41050"],
-                "Pandamaran": ["42000"],
-                "Bukit Tinggi": ["41200"],
-                "Bandar Botanik": ["41200"],
-                "Telok Panglima Garang": ["42500"],
-                "Banting": ["42700"],
-                "Kajang": ["43000"],
-                "Semenyih": ["43500"],
-                "Bangi": ["43650"],
-                "Cheras": ["43200"],
-                "Balakong": ["43300"],
-                "Hulu Langat": ["43100"],
-                "Sungai Long": ["43000"],
-                "Bandar Mahkota Cheras": ["43200"],
-                "Kuala Kubu Bharu": ["44000"],
-                "Batang Kali": ["44300"],
-                "Serendah": ["44300"],
-                "Rasa": ["44200"],
-                "Ulu Yam": ["44300"],
-                "Bukit Beruntung": ["48300"],
-                "Sepang": ["43900"],
-                "Dengkil": ["43800"],
-                "Salak Tinggi": ["43900"],
-                "Cyberjaya": ["63000"],
-                "KLIA": ["64000"]
-            }
-            
-            # 检查输入是否匹配邮编范围名称或名称的一部分
-            matched_areas = []
-            normalized_query = location_query.lower()
-            for area, postcodes in postcode_ranges.items():
-                if normalized_query in area.lower() or area.lower() in normalized_query:
-                    matched_areas.append((area, postcodes))
-            
-            # 如果匹配到地区名称，查询该地区所有邮编范围内的店铺
-            if matched_areas:
-                area_results = []
-                for area, postcodes in matched_areas:
-                    print(f"匹配到地区: {area}, 邮编范围: {postcodes}")
-                    # 构建邮编范围查询条件
-                    postcode_conditions = []
-                    params = []
-                    
-                    for postcode in postcodes:
-                        if "-" in postcode:  # 处理带范围的邮编
-                            start, end = postcode.split("-")
-                            # 这里假设邮编是数字
-                            postcode_conditions.append(
-                                "(CAST(postcode AS INTEGER) BETWEEN %s AND %s)")
-                            params.extend([start, end])
-                        else:  # 精确匹配单个邮编
-                            postcode_conditions.append("postcode = %s")
-                            params.append(postcode)
-                    
-                    # 添加地区名称匹配
-                    postcode_conditions.append(
-                        "(city ILIKE %s OR district ILIKE %s OR address ILIKE %s)")
-                    params.extend([f"%{area}%", f"%{area}%", f"%{area}%"])
-                    
-                    # 添加店铺名称匹配
-                    postcode_conditions.append("name ILIKE %s")
-                    params.append(f"%{area}%")
-                    
-                    query = "SELECT * FROM subway_outlets WHERE " + \
-                        " OR ".join(postcode_conditions)
-                    cur.execute(query, params)
-                    results = cur.fetchall()
-                    if results:
-                        area_results.extend([dict(r) for r in results])
-                
-                if area_results:
-                    print(f"通过邮编范围匹配成功，找到 {len(area_results)} 个结果")
-                    return area_results
-            
-            # 多种匹配条件
-            query = """
-                SELECT * FROM subway_outlets
-                WHERE 
-                    city ILIKE %s 
-                    OR district ILIKE %s 
-                    OR address ILIKE %s
-                    OR street_address ILIKE %s
-                    OR name ILIKE %s
-            """
-            params = [
-                f"%{location_query}%",  # 城市
-                f"%{location_query}%",  # 区域
-                f"%{location_query}%",  # 完整地址
-                f"%{location_query}%",  # 街道
-                f"%{location_query}%"   # 店名
-            ]
-            
-            cur.execute(query, params)
-            results = [dict(r) for r in cur.fetchall()]
-            
-            # 如果没找到，尝试更模糊的搜索
-            if not results:
-                # 1. 尝试部分匹配
-                words = location_query.split()
-                if len(words) > 1:
-                    for word in words:
-                        if len(word) > 3:  # 只使用较长的词以避免匹配太多无关项
-                            cur.execute("SELECT * FROM subway_outlets WHERE address ILIKE %s OR name ILIKE %s OR city ILIKE %s OR district ILIKE %s", 
-                                      [f'%{word}%', f'%{word}%', f'%{word}%', f'%{word}%'])
-                            partial_results = [dict(r) for r in cur.fetchall()]
-                            if partial_results:
-                                print(f"找到部分匹配: {word}")
-                                results.extend(partial_results)
-                
-                # 2. 尝试处理邮编格式
-                # 添加对邮编格式的特殊处理（处理不同长度的邮编）
-                if location_query.isdigit() and 4 <= len(location_query) <= 6:
-                    padded_postcode = location_query.zfill(5)  # 将邮编填充到5位数
-                    cur.execute(
-    "SELECT * FROM subway_outlets WHERE address ILIKE %s OR postcode = %s", [
-        f'%{padded_postcode}%', padded_postcode])
-                    postcode_fuzzy_results = [dict(r) for r in cur.fetchall()]
-                    if postcode_fuzzy_results:
-                        print(f"邮编模糊匹配成功: {padded_postcode}")
-                        results.extend(postcode_fuzzy_results)
-                
-                # 3. 尝试同音字或拼写相似的单词
-                if not results and len(location_query) > 3:
-                    # 例如：Bangsar, Bandar, Bangi - 开头相似
-                    prefix = location_query[:3]
-                    cur.execute("""
-                        SELECT * FROM subway_outlets 
-                        WHERE address ILIKE %s 
-                        OR city ILIKE %s 
-                        OR district ILIKE %s
-                        OR name ILIKE %s
-                    """, [f'%{prefix}%', f'%{prefix}%', f'%{prefix}%', f'%{prefix}%'])
-                    similar_results = [dict(r) for r in cur.fetchall()]
-                    if similar_results:
-                        print(f"找到相似匹配: {prefix}")
-                        results.extend(similar_results)
-                
-                # 4. 尝试使用特定键值对查询
-                if not results:
-                    location_lower = location_query.lower()
-                    specific_locations = {
-                        'bangsar': ['bangsar', 'telawi', 'jalan bangsar', 'lorong maarof', 'kerinchi', 'pantai', 'abdullah', 'menara ub', 'pusat', 'village'],
-                        'bandar': ['bandar', 'sri', 'maju', 'puteri', 'utama', 'kinrara', 'sunway', 'sri', 'pudu', 'baru'],
-                        'ampang': ['ampang', 'ukay', 'hulu', 'jaya', 'point', 'ampang park', 'ampang putra'],
-                        'klcc': ['klcc', 'kuala lumpur city centre', 'pavilion', 'bukit bintang', 'suria', 'twin towers', 'avenue k'],
-                        'sunway': ['sunway', 'subang', 'usj', 'sunway pyramid', 'subang jaya', 'sunway velocity'],
-                        'damansara': ['damansara', 'mutiara', 'uptown', 'utama', 'perdana', 'heights', 'damai', 'jaya'],
-                        'pj': ['petaling jaya', 'pj', 'ss2', 'ss15', 'kelana jaya', 'damansara'],
-                        'kl': ['kuala lumpur', 'kl', 'sentral', 'berjaya times square', 'pavilion', 'kl gateway'],
-                        'shah alam': ['shah alam', 'seksyen', 'setia alam', 'bukit jelutong']
-                    }
-                    
-                    # 查找匹配的地区
-                    matched_areas = []
-                    for area, keywords in specific_locations.items():
-                        if area in location_lower:
-                            matched_areas.append(area)
-                        else:
-                            # 检查关键词是否匹配
-                            for keyword in keywords:
-                                if keyword in location_lower:
-                                    matched_areas.append(area)
-                                    break
-                    
-                    # 查询匹配地区的店铺
-                    for area in matched_areas:
-                        keywords = specific_locations[area]
-                        for keyword in keywords:
-                            cur.execute("""
-                                SELECT * FROM subway_outlets 
-                                WHERE address ILIKE %s 
-                                OR name ILIKE %s
-                                OR city ILIKE %s
-                                OR district ILIKE %s
-                            """, [f'%{keyword}%', f'%{keyword}%', f'%{keyword}%', f'%{keyword}%'])
-                            keyword_results = [dict(r) for r in cur.fetchall()]
-                            if keyword_results:
-                                print(f"找到特定关键词匹配: {keyword}")
-                                results.extend(keyword_results)
-            
-            # 4. 限制最大结果数，避免返回太多
-            if len(results) > 20:
-                print(f"结果过多 ({len(results)}), 限制为前20个")
-                results = results[:20]
-            
-            # 去重
-            seen_ids = set()
-            unique_results = []
-            for o in results:
-                if o['id'] not in seen_ids:
-                    seen_ids.add(o['id'])
-                    unique_results.append(o)
-            
-            return unique_results
+        snapshot = outlet_store.snapshot()
+        return snapshot.rows_at(match_location(snapshot, location_query, limit))
     except Exception as e:
         print(f"Error finding outlets by location: {e}")
         return []
-    finally:
-        conn.close()
 
 # 2. 时间相关查询
 
@@ -640,114 +429,27 @@ def find_outlets_by_time(time_query, day=None, is_weekend=None):
     if 'is_at_query' not in locals():
         is_at_query = not is_after_query and not is_before_query
     
-    conn = connect_db()
+    target = target_hour * 60 + target_minute
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 查询所有有营业时间的店铺
-            cur.execute("""
-                SELECT * FROM subway_outlets
-                WHERE opening_hours IS NOT NULL
-                OR is_24hours = true
-                    OR operating_hours ILIKE '%24%'
-                    OR operating_hours ILIKE '%24 hours%'
-            """)
-            
-            rows = cur.fetchall()
-            results = []
-            
-            # 先添加24小时营业的店铺
-            for row in rows:
-                row_dict = dict(row)
-                if row_dict.get('is_24hours') or '24' in (
-                    row_dict.get('operating_hours') or ''):
-                    results.append(row_dict)
-
-            # 处理其他有营业时间的店铺
-            for row in rows:
-                row_dict = dict(row)
-                # 跳过已添加的24小时店铺
-                if row_dict.get('is_24hours') or '24' in (
-                    row_dict.get('operating_hours') or ''):
-                    continue
-                
-                hours = row_dict.get('opening_hours', {})
-                if not hours:
-                            continue
-
-                # 检查指定天的营业时间
-                for check_day in days:
-                    if check_day not in hours or not hours[check_day]:
-                            continue
-
-                    day_hours = hours[check_day]
-                    if 'open' not in day_hours or 'close' not in day_hours:
-                        continue
-
-                    open_time = day_hours['open']
-                    close_time = day_hours['close']
-
-                    if not open_time or not close_time:
-                        continue
-
-                    # 解析开关门时间
-                    open_hour = int(open_time[:2])
-                    open_minute = int(open_time[2:]) if len(
-                        open_time) >= 4 else 0
-                    close_hour = int(close_time[:2])
-                    close_minute = int(close_time[2:]) if len(
-                        close_time) >= 4 else 0
-
-                    # 处理跨午夜情况
-                    is_overnight = False
-                    if close_hour < open_hour or (
-    close_hour == open_hour and close_minute < open_minute):
-                        is_overnight = True
-
-                    # 根据查询类型进行匹配
-                    if is_after_query:
-                        # "after X" 查询 - 在目标时间后仍然营业
-                        if is_overnight:
-                            # 跨午夜情况
-                            if (open_hour <= target_hour and target_hour <= 23) or \
-                               (0 <= target_hour < close_hour) or \
-                               (target_hour == close_hour and close_minute > 0):
-                                # 只要目标时间在营业时间内，或者关门时间比目标时间晚
-                                results.append(row_dict)
-                                break
-                        else:
-                            # 当天情况 - 关门时间必须晚于目标时间
-                            if close_hour > target_hour or \
-                               (close_hour == target_hour and close_minute > target_minute):
-                                results.append(row_dict)
-                                break
-                    elif is_before_query:
-                        # "before X" 查询 - 开门时间早于目标时间
-                        if open_hour < target_hour or \
-                           (open_hour == target_hour and open_minute <= target_minute):
-                            results.append(row_dict)
-                            break
-                    else:  # is_at_query
-                        # "at X" 查询 - 查询时间在营业时间内
-                        if is_overnight:
-                            # 跨午夜情况
-                            if (open_hour <= target_hour and target_hour <= 23) or \
-                               (0 <= target_hour < close_hour) or \
-                               (target_hour == close_hour and target_minute <= close_minute):
-                                results.append(row_dict)
-                                break
-                        else:
-                            # 当天情况
-                                        if (open_hour < target_hour or (open_hour == target_hour and open_minute <= target_minute)) and \
-                                           (target_hour < close_hour or (target_hour == close_hour and target_minute <= close_minute)):
-                                            results.append(row_dict)
-                                            break
-
-            return results
+        snapshot = outlet_store.snapshot()
+        index = snapshot.time_index
+
+        # 根据查询类型在营业时间索引上二分/区间定位
+        if is_after_query:
+            # "after X" 查询 - 当天时段在目标时间后仍然营业（跨午夜时段按次日关门计算）
+            matched = index.open_after(target, days)
+        elif is_before_query:
+            # "before X" 查询 - 开门时间不晚于目标时间
+            matched = index.opens_before(target, days, inclusive=True)
+        else:  # is_at_query
+            # "at X" 查询 - 目标时刻落在营业区间内（前一天跨午夜的时段也计入）
+            matched = index.open_at(target, days)
+
+        # 24小时营业的店铺排在最前
+        return snapshot.rows_at(index.with_always_open(matched))
     except Exception as e:
         print(f"查找符合时间条件的店铺时出错: {e}")
         return []
-    finally:
-        conn.close()
 
 # 查询特定时间开店的门店
 
@@ -762,7 +464,6 @@ def find_outlets_by_opening_time(time_query, is_weekend=False):
     返回值:
         符合条件的门店列表
     """
-    conn = connect_db()
     try:
         # 解析目标时间
         target_time = None
@@ -827,98 +528,30 @@ def find_outlets_by_opening_time(time_query, is_weekend=False):
 
         print(f"查询的日期: {days}")
 
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 查询所有有营业时间的店铺
-            cur.execute("""
-                SELECT * FROM subway_outlets
-                WHERE opening_hours IS NOT NULL
-            """)
-
-            rows = cur.fetchall()
-            print(f"查询到 {len(rows)} 家有营业时间的店铺")
-            results = []
-
-            matched_count = 0
-            
-            for row in rows:
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-
-                if not hours:
-                    continue
-                    
-                # 检查每个指定天的开门时间
-                for day in days:
-                    if day not in hours:
-                        # print(f"店铺 {row_dict['name']} 没有 {day} 的数据")
-                        continue
-                        
-                    if not hours[day]:
-                        # print(f"店铺 {row_dict['name']} 在 {day} 没有营业时间")
-                        continue
-                        
-                    if 'open' not in hours[day]:
-                        # print(f"店铺 {row_dict['name']} 在 {day} 没有开门时间")
-                        continue
-                    
-                    open_time = hours[day]['open']
-                    if not open_time:
-                        continue
-                    
-                    # 输出调试信息
-                    print(f"店铺 {row_dict['name']} 在 {day} 的开门时间: {open_time}")
-                    
-                    # 根据查询类型匹配
-                    if is_before:
-                        # 查找在指定时间之前开门的店铺
-                        if open_time < target_time:
-                            print(f"匹配! {row_dict['name']} 在 {target_time} 之前开门 ({open_time})")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-                    elif is_after:
-                        # 查找在指定时间之后开门的店铺
-                        if open_time > target_time:
-                            print(f"匹配! {row_dict['name']} 在 {target_time} 之后开门 ({open_time})")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-                    else:
-                        # 查找在指定时间开门的店铺 (允许30分钟的误差)
-                        open_hour = int(open_time[:2])
-                        open_minute = int(open_time[2:]) if len(
-                            open_time) >= 4 else 0
-                        target_hour = int(target_time[:2])
-                        target_minute = int(target_time[2:]) if len(
-                            target_time) >= 4 else 0
-
-                        # 计算时间差（分钟）
-                        open_total_mins = open_hour * 60 + open_minute
-                        target_total_mins = target_hour * 60 + target_minute
-                        diff_mins = abs(open_total_mins - target_total_mins)
-
-                        # 如果时间差在30分钟以内，视为匹配
-                        if diff_mins <= 30:
-                            print(f"匹配! {row_dict['name']} 开门时间接近 {target_time} (差异 {diff_mins} 分钟)")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-            
-            print(f"共找到 {matched_count} 家符合条件的店铺")
-            # 输出前5家店铺名称作为示例
-            if results:
-                sample_names = [r['name'] for r in results[:5]]
-                print(f"示例店铺: {', '.join(sample_names)}")
-            return results
+        # 在营业时间索引上二分查找开门时间
+        target_minutes = parse_hhmm(target_time)
+        snapshot = outlet_store.snapshot()
+        index = snapshot.time_index
+        if is_before:
+            matched = index.opens_before(target_minutes, days)
+        elif is_after:
+            matched = index.opens_after(target_minutes, days)
+        else:
+            # 允许30分钟的误差
+            matched = index.opens_near(target_minutes, days, 30)
+        results = snapshot.rows_at(sorted(matched))
+        matched_count = len(results)
+
+        print(f"共找到 {matched_count} 家符合条件的店铺")
+        # 输出前5家店铺名称作为示例
+        if results:
+            sample_names = [r['name'] for r in results[:5]]
+            print(f"示例店铺: {', '.join(sample_names)}")
+        return results
     except Exception as e:
         print(f"查询特定时间开店的门店时出错: {e}")
         traceback.print_exc()
         return []
-    finally:
-        conn.close()
 
 # 查询特定时间关店的门店
 
@@ -933,7 +566,6 @@ def find_outlets_by_closing_time(time_query, is_weekend=False):
     返回值:
         符合条件的门店列表
     """
-    conn = connect_db()
     try:
         # 解析目标时间
         target_time = None
@@ -999,141 +631,71 @@ def find_outlets_by_closing_time(time_query, is_weekend=False):
 
         print(f"查询的日期: {days}")
 
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 查询所有有营业时间的店铺
-            cur.execute("""
-                SELECT * FROM subway_outlets
-                WHERE opening_hours IS NOT NULL
-            """)
-
-            rows = cur.fetchall()
-            print(f"查询到 {len(rows)} 家有营业时间的店铺")
-            results = []
-            
-            matched_count = 0
-
-            for row in rows:
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-
-                if not hours:
-                    continue
-
-                # 检查每个指定天的关门时间
-                for day in days:
-                    if day not in hours:
-                        # print(f"店铺 {row_dict['name']} 没有 {day} 的数据")
-                        continue
-                        
-                    if not hours[day]:
-                        # print(f"店铺 {row_dict['name']} 在 {day} 没有营业时间")
-                        continue
-                        
-                    if 'close' not in hours[day]:
-                        # print(f"店铺 {row_dict['name']} 在 {day} 没有关门时间")
-                        continue
-
-                    close_time = hours[day]['close']
-                    if not close_time:
-                        continue
-                    
-                    # 输出调试信息
-                    print(f"店铺 {row_dict['name']} 在 {day} 的关门时间: {close_time}")
-                    
-                    # 处理跨午夜情况
-                    day_hours = hours[day]
-                    adjusted_close_time = close_time
-                    if 'open' in day_hours and day_hours['open'] > close_time:
-                        # 跨午夜情况，关门时间应该加上24小时
-                        hour = int(close_time[:2]) + 24
-                        minute = int(close_time[2:]) if len(
-                            close_time) >= 4 else 0
-                        adjusted_close_time = f"{hour:02d}{minute:02d}"
-                        print(f"  跨午夜情况，调整后关门时间: {adjusted_close_time}")
-
-                    # 根据查询类型匹配
-                    if is_before:
-                        # 查找在指定时间之前关门的店铺
-                        if adjusted_close_time < target_time:
-                            print(f"匹配! {row_dict['name']} 在 {target_time} 之前关门 ({close_time})")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-                    elif is_after:
-                        # 查找在指定时间之后关门的店铺
-                        if adjusted_close_time > target_time:
-                            print(f"匹配! {row_dict['name']} 在 {target_time} 之后关门 ({close_time})")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-                    else:
-                        # 查找在指定时间关门的店铺 (允许30分钟的误差)
-                        close_hour = int(adjusted_close_time[:2])
-                        close_minute = int(adjusted_close_time[2:]) if len(
-                            adjusted_close_time) >= 4 else 0
-                        target_hour = int(target_time[:2])
-                        target_minute = int(target_time[2:]) if len(
-                            target_time) >= 4 else 0
-
-                        # 处理跨午夜情况进行比较
-                        if close_hour >= 24:
-                            close_hour -= 24
-
-                        # 计算时间差（分钟）
-                        close_total_mins = close_hour * 60 + close_minute
-                        target_total_mins = target_hour * 60 + target_minute
-                        diff_mins = abs(close_total_mins - target_total_mins)
-
-                        # 如果时间差在30分钟以内，视为匹配
-                        if diff_mins <= 30:
-                            print(f"匹配! {row_dict['name']} 关门时间接近 {target_time} (差异 {diff_mins} 分钟)")
-                            if row_dict not in results:  # 避免重复添加
-                                results.append(row_dict)
-                                matched_count += 1
-                            break
-            
-            print(f"共找到 {matched_count} 家符合条件的店铺")
-            # 输出前5家店铺名称作为示例
-            if results:
-                sample_names = [r['name'] for r in results[:5]]
-                print(f"示例店铺: {', '.join(sample_names)}")
-            return results
+        # 在营业时间索引上二分查找关门时间（跨午夜的关门时间按 +24 小时比较）
+        target_minutes = parse_hhmm(target_time)
+        snapshot = outlet_store.snapshot()
+        index = snapshot.time_index
+        if is_before:
+            matched = index.closes_before(target_minutes, days)
+        elif is_after:
+            matched = index.closes_after(target_minutes, days)
+        else:
+            # 允许30分钟的误差，按当天钟点比较
+            matched = index.closes_near(target_minutes, days, 30)
+        results = snapshot.rows_at(sorted(matched))
+        matched_count = len(results)
+
+        print(f"共找到 {matched_count} 家符合条件的店铺")
+        # 输出前5家店铺名称作为示例
+        if results:
+            sample_names = [r['name'] for r in results[:5]]
+            print(f"示例店铺: {', '.join(sample_names)}")
+        return results
     except Exception as e:
         print(f"查询特定时间关店的门店时出错: {e}")
         traceback.print_exc()
         return []
-    finally:
-        conn.close()
 
 # 3. 获取最近的店铺
 
 
-def get_nearest_outlets(lat, lon, limit=5):
-    """获取距离给定坐标最近的n个门店"""
-    conn = connect_db()
+def get_nearest_outlets(lat, lon, limit=5, radius_km=None, open_now=False, is_weekend=None):
+    """获取距离给定坐标最近的n个门店
+
+    参数:
+        lat, lon: 中心坐标
+        limit: 最多返回的门店数
+        radius_km: 只返回该半径（公里）内的门店，为None时不限制
+        open_now: 是否只返回当前营业的门店
+        is_weekend: 判断当前营业时使用的周末/工作日，为None时根据当前日期判断
+    """
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT * FROM subway_outlets WHERE latitude IS NOT NULL AND longitude IS NOT NULL;")
-            outlets = [dict(r) for r in cur.fetchall()]
-            
-            # 计算每个门店的距离
-            for outlet in outlets:
-                outlet['distance'] = calculate_distance(
-                    lat, lon,
-                    outlet['latitude'], outlet['longitude']
-                )
-            
-            # 按距离排序并返回前n个
-            nearest = sorted(outlets, key=lambda x: x['distance'])[:limit]
-            return nearest
+        snapshot = outlet_store.snapshot()
+        lat, lon = float(lat), float(lon)
+
+        # 时间条件转换为快照下标位图，在 KD 树搜索时直接过滤
+        mask = None
+        if open_now:
+            now = datetime.now()
+            if is_weekend is None:
+                is_weekend = now.weekday() >= 5
+            mask = snapshot.open_bitmap.open_at(now.hour * 60 + now.minute, days_for(is_weekend))
+
+        if radius_km is not None:
+            hits = snapshot.spatial_index.within(lat, lon, radius_km, mask)[:limit]
+        else:
+            hits = snapshot.spatial_index.nearest(lat, lon, limit, mask)
+
+        indexes = [i for _, i in hits]
+        nearest = snapshot.rows_at(indexes)
+        # 一次向量化调用算出所有结果的距离
+        distances = snapshot.coordinates.distances_from(lat, lon, indexes)
+        for outlet, distance in zip(nearest, distances):
+            outlet['distance'] = float(distance)
+        return nearest
     except Exception as e:
         print(f"Error finding nearest outlets: {e}")
         return []
-    finally:
-        conn.close()
 
 # 4. 复合查询
 
@@ -1142,7 +704,8 @@ def find_outlets_compound(
     location_query,
     time_query=None,
     day=None,
-    is_weekend=None):
+    is_weekend=None,
+    location_limit=LOCATION_RESULT_LIMIT):
     """复合查询：位置+时间
 
     参数:
@@ -1150,6 +713,7 @@ def find_outlets_compound(
         time_query: 时间查询字符串，如"now"、"9pm"等
         day: 指定星期几，如"monday"、"tuesday"等
         is_weekend: 是否为周末查询
+        location_limit: 位置匹配最多保留的店铺数，None 为不限制
 
     返回值:
         符合条件的门店列表
@@ -1165,7 +729,7 @@ def find_outlets_compound(
             is_weekend = today >= 5  # 5和6分别是周六和周日
 
     # 先按位置筛选
-    location_results = find_outlets_by_location(location_query)
+    location_results = find_outlets_by_location(location_query, location_limit)
     print(f"位置查询 '{location_query}' 找到 {len(location_results)} 家店铺")
     
     # 如果没有时间条件，直接返回
@@ -1304,320 +868,137 @@ def find_outlets_compound(
 
 def find_earliest_opening_outlets(is_weekend=False):
     """查找最早开门的店铺，区分周末和工作日"""
-    conn = connect_db()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 获取所有有营业时间的店铺
-            cur.execute("""
-                SELECT id, name, address, opening_hours, operating_hours, latitude, longitude 
-                FROM subway_outlets 
-                WHERE opening_hours IS NOT NULL 
-            """)
-
-            # 根据是否为周末选择要查询的天
-            days = [
-    "saturday",
-    "sunday"] if is_weekend else [
-        "monday",
-        "tuesday",
-        "wednesday",
-        "thursday",
-         "friday"]
-            
-            outlets = []
-            earliest_time = "2400"  # 初始值设为最晚
-            outlet_ids = set()  # 用于跟踪已添加的店铺ID
-            
-            for row in cur.fetchall():
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-                
-                # 跳过没有营业时间的店铺
-                if not hours:
-                            continue
-                        
-                # 检查指定天的开门时间
-                for day in days:
-                    if day not in hours or not hours[day] or 'open' not in hours[day]:
-                        continue
-
-                    open_time = hours[day]['open']
-                    if not open_time:
-                        continue
-
-                    # 更新最早时间
-                    if open_time < earliest_time:
-                        earliest_time = open_time
-                        outlets = [row_dict]  # 重置列表
-                        outlet_ids = {row_dict['id']}  # 重置ID集合
-                    elif open_time == earliest_time and row_dict['id'] not in outlet_ids:
-                        outlets.append(row_dict)  # 添加到列表
-                        outlet_ids.add(row_dict['id'])  # 记录ID已添加
-            
-            # 为每个店铺添加开门时间
-            for outlet in outlets:
-                outlet['opening_time'] = earliest_time
-                # 添加相关天信息
-                outlet['days'] = "weekend" if is_weekend else "weekday"
-            
-            return outlets, earliest_time
+        # 在营业时间索引上直接取各天开门时间的最小值
+        snapshot = outlet_store.snapshot()
+        matched, minutes = snapshot.time_index.earliest_opening(days_for(is_weekend))
+        if minutes is None:
+            return [], "2400"
+        earliest_time = format_hhmm(minutes)
+
+        outlets = snapshot.rows_at(matched)
+        # 为每个店铺添加开门时间
+        for outlet in outlets:
+            outlet['opening_time'] = earliest_time
+            # 添加相关天信息
+            outlet['days'] = "weekend" if is_weekend else "weekday"
+        
+        return outlets, earliest_time
     except Exception as e:
         print(f"Error finding earliest opening outlets: {e}")
         return [], "2400"
-    finally:
-        conn.close()
 
 # 新增：查找最晚开门的店铺
 def find_latest_opening_outlets(is_weekend=False):
     """查找最晚开门的店铺，区分周末和工作日"""
-    conn = connect_db()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 获取所有有营业时间的店铺
-            cur.execute("""
-                SELECT id, name, address, opening_hours, operating_hours, latitude, longitude 
-                FROM subway_outlets 
-                WHERE opening_hours IS NOT NULL
-            """)
-            
-            # 根据是否为周末选择要查询的天
-            days = ["saturday", "sunday"] if is_weekend else ["monday", "tuesday", "wednesday", "thursday", "friday"]
-            
-            outlets = []
-            latest_time = "0000"  # 初始值设为最早
-            outlet_ids = set()  # 用于跟踪已添加的店铺ID
-            
-            for row in cur.fetchall():
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-                
-                # 跳过没有营业时间的店铺
-                if not hours:
-                                    continue
-                            
-                # 检查指定天的开门时间
-                for day in days:
-                    if day not in hours or not hours[day] or 'open' not in hours[day]:
-                        continue
-                    
-                    open_time = hours[day]['open']
-                    if not open_time:
-                        continue
-                    
-                    # 更新最晚时间
-                    if open_time > latest_time:
-                        latest_time = open_time
-                        outlets = [row_dict]  # 重置列表
-                        outlet_ids = {row_dict['id']}  # 重置ID集合
-                    elif open_time == latest_time and row_dict['id'] not in outlet_ids:
-                        outlets.append(row_dict)  # 添加到列表
-                        outlet_ids.add(row_dict['id'])  # 记录ID已添加
-            
-            # 为每个店铺添加开门时间
-            for outlet in outlets:
-                outlet['opening_time'] = latest_time
-                # 添加相关天信息
-                outlet['days'] = "weekend" if is_weekend else "weekday"
-            
-            return outlets, latest_time
+        # 在营业时间索引上直接取各天开门时间的最大值
+        snapshot = outlet_store.snapshot()
+        matched, minutes = snapshot.time_index.latest_opening(days_for(is_weekend))
+        if minutes is None:
+            return [], "0000"
+        latest_time = format_hhmm(minutes)
+
+        outlets = snapshot.rows_at(matched)
+        # 为每个店铺添加开门时间
+        for outlet in outlets:
+            outlet['opening_time'] = latest_time
+            # 添加相关天信息
+            outlet['days'] = "weekend" if is_weekend else "weekday"
+        
+        return outlets, latest_time
     except Exception as e:
         print(f"Error finding latest opening outlets: {e}")
         return [], "0000"
-    finally:
-        conn.close()
 
 # 新增：查找最早关门的店铺
 def find_earliest_closing_outlets(is_weekend=False):
     """查找最早关门的店铺，区分周末和工作日"""
-    conn = connect_db()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT id, name, address, opening_hours, operating_hours, latitude, longitude 
-                FROM subway_outlets 
-                WHERE opening_hours IS NOT NULL 
-            """)
-            
-            # 根据是否为周末选择要查询的天
-            days = ["saturday", "sunday"] if is_weekend else ["monday", "tuesday", "wednesday", "thursday", "friday"]
-            
-            outlets = []
-            earliest_time = "2500"  # 初始值设为超晚（比24小时还晚）
-            outlet_ids = set()  # 用于跟踪已添加的店铺ID
-            
-            for row in cur.fetchall():
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-                
-                # 跳过没有营业时间的店铺
-                if not hours:
-                            continue
-                        
-                # 检查指定天的关门时间
-                for day in days:
-                    if day not in hours or not hours[day] or 'close' not in hours[day]:
-                        continue
-                    
-                    close_time = hours[day]['close']
-                    if not close_time:
-                        continue
-                    
-                    # 处理跨午夜情况 (如果关门时间早于开门时间，可能是第二天凌晨)
-                    day_hours = hours[day]
-                    # 跳过跨午夜的情况，因为我们要找最早关门的（非凌晨关门的）
-                    if 'open' in day_hours and day_hours['open'] > close_time:
-                                    continue
-                            
-                    # 更新最早时间
-                    if close_time < earliest_time:
-                        earliest_time = close_time
-                        outlets = [row_dict]  # 重置列表
-                        outlet_ids = {row_dict['id']}  # 重置ID集合
-                    elif close_time == earliest_time and row_dict['id'] not in outlet_ids:
-                        outlets.append(row_dict)  # 添加到列表
-                        outlet_ids.add(row_dict['id'])  # 记录ID已添加
-            
-            # 为每个店铺添加关门时间
-            for outlet in outlets:
-                outlet['closing_time'] = earliest_time
-                # 添加相关天信息
-                outlet['days'] = "weekend" if is_weekend else "weekday"
-            
-            return outlets, earliest_time
+        # 跨午夜（凌晨关门）的时段不参与比较，由索引在构建时排除
+        snapshot = outlet_store.snapshot()
+        matched, minutes = snapshot.time_index.earliest_closing(days_for(is_weekend))
+        if minutes is None:
+            return [], "2500"
+        earliest_time = format_hhmm(minutes)
+
+        outlets = snapshot.rows_at(matched)
+        # 为每个店铺添加关门时间
+        for outlet in outlets:
+            outlet['closing_time'] = earliest_time
+            # 添加相关天信息
+            outlet['days'] = "weekend" if is_weekend else "weekday"
+        
+        return outlets, earliest_time
     except Exception as e:
         print(f"Error finding earliest closing outlets: {e}")
         return [], "2400"
-    finally:
-        conn.close()
 
 # 6. 查找最晚关门的店铺
 def find_latest_closing_outlets(is_weekend=False):
     """查找最晚关门的店铺，区分周末和工作日"""
-    conn = connect_db()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT id, name, address, opening_hours, operating_hours, latitude, longitude 
-                FROM subway_outlets 
-                WHERE opening_hours IS NOT NULL
-            """)
-            
-            # 根据是否为周末选择要查询的天
-            days = ["saturday", "sunday"] if is_weekend else ["monday", "tuesday", "wednesday", "thursday", "friday"]
-            
-            outlets = []
-            latest_time = "0000"  # 初始值设为最早
-            outlet_ids = set()  # 用于跟踪已添加的店铺ID
-            
-            for row in cur.fetchall():
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-                
-                # 跳过没有营业时间的店铺
-                if not hours:
-                    continue
-                
-                # 检查指定天的关门时间
-                for day in days:
-                    if day not in hours or not hours[day] or 'close' not in hours[day]:
-                        continue
-                    
-                    close_time = hours[day]['close']
-                    if not close_time:
-                        continue
-                    
-                    # 处理跨午夜情况 (如果关门时间早于开门时间，可能是第二天凌晨)
-                    day_hours = hours[day]
-                    if 'open' in day_hours and day_hours['open'] > close_time:
-                        # 这里是跨午夜情况，关门时间应该加上24小时
-                        hour = int(close_time[:2]) + 24
-                        minute = int(close_time[2:]) if len(close_time) >= 4 else 0
-                        close_time = f"{hour:02d}{minute:02d}"
-                    
-                    # 更新最晚时间
-                    if close_time > latest_time:
-                        latest_time = close_time
-                        outlets = [row_dict]  # 重置列表
-                        outlet_ids = {row_dict['id']}  # 重置ID集合
-                    elif close_time == latest_time and row_dict['id'] not in outlet_ids:
-                        outlets.append(row_dict)  # 添加到列表
-                        outlet_ids.add(row_dict['id'])  # 记录ID已添加
-            
-            # 为每个店铺添加关门时间
-            displayed_time = latest_time
-            if int(latest_time[:2]) >= 24:
-                # 如果是跨午夜的时间，转换回正常显示格式
-                hour = int(latest_time[:2]) - 24
-                minute = latest_time[2:] if len(latest_time) >= 4 else "00"
-                displayed_time = f"{hour:02d}{minute}"
-                
-            for outlet in outlets:
-                outlet['closing_time'] = displayed_time
-                # 添加相关天信息
-                outlet['days'] = "weekend" if is_weekend else "weekday"
-            
-            return outlets, displayed_time
+        # 跨午夜的关门时间在索引中已按 +24 小时存储
+        snapshot = outlet_store.snapshot()
+        matched, minutes = snapshot.time_index.latest_closing(days_for(is_weekend))
+        if minutes is None:
+            return [], "0000"
+        # 如果是跨午夜的时间，转换回正常显示格式
+        if minutes >= MINUTES_PER_DAY:
+            minutes -= MINUTES_PER_DAY
+        displayed_time = format_hhmm(minutes)
+
+        outlets = snapshot.rows_at(matched)
+        for outlet in outlets:
+            outlet['closing_time'] = displayed_time
+            # 添加相关天信息
+            outlet['days'] = "weekend" if is_weekend else "weekday"
+        
+        return outlets, displayed_time
     except Exception as e:
         print(f"Error finding latest closing outlets: {e}")
         return [], "0000"
-    finally:
-        conn.close()
 
 # 7. 获取24小时营业店铺
 def find_24hour_outlets():
     """查找所有24小时营业的店铺"""
-    conn = connect_db()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT * FROM subway_outlets
-                WHERE is_24hours = true 
-                OR operating_hours ILIKE '%24 hours%' 
-                OR operating_hours ILIKE '%24hrs%'
-                OR operating_hours ILIKE '%24hr%'
-            """)
-            return [dict(r) for r in cur.fetchall()]
+        return [dict(o) for o in outlet_store.snapshot().outlets if is_24hours(o)]
     except Exception as e:
         print(f"Error finding 24-hour outlets: {e}")
         return []
-    finally:
-        conn.close()
 
-# 获取特定位置的坐标
-def get_location_coordinates(location):
-    """尝试找出地点的大致坐标（从数据库中的地址匹配）"""
-    outlets = find_outlets_by_location(location)
-    
-    if not outlets:
-        return None, None
-    
-    # 取平均值作为该区域的中心点
-    avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/len(outlets)
-    avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/len(outlets)
-    
-    return avg_lat, avg_lng
+# 8. 查找当前营业的店铺
+def find_open_now_outlets(location=None, is_weekend=None, location_limit=LOCATION_RESULT_LIMIT):
+    """查找当前营业的店铺：查一次"营业中"位图，再与位置结果的位图取交集
 
-# 通过OpenAI处理查询
-def process_with_ai(query):
-    # 获取所有可能的地区和店铺示例
-    conn = connect_db()
+    参数:
+        location: 位置查询字符串，为空时返回所有当前营业的店铺
+        is_weekend: 是否按周末营业时间判断，为None时根据当前日期判断
+        location_limit: 位置匹配最多保留的店铺数，None 为不限制
+    """
+    now = datetime.now()
+    if is_weekend is None:
+        is_weekend = now.weekday() >= 5  # 5和6分别是周六和周日
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 获取地区示例
-            cur.execute("""
-                SELECT DISTINCT city 
-                FROM subway_outlets 
-                WHERE city IS NOT NULL AND city != ''
-                LIMIT 20
-            """)
-            areas = [row[0] for row in cur.fetchall() if row[0]]
-            
-            # 获取店铺示例
-            cur.execute("SELECT id, name, address, opening_hours, latitude, longitude FROM subway_outlets LIMIT 10;")
-            outlets = [dict(r) for r in cur.fetchall()]
-            
-            # 构建系统提示
-            system_prompt = f"""You are an AI assistant for a Subway restaurant map application. 
+        snapshot = outlet_store.snapshot()
+        mask = snapshot.open_bitmap.open_at(now.hour * 60 + now.minute, days_for(is_weekend))
+        if location:
+            mask &= snapshot.mask_of(r['id'] for r in find_outlets_by_location(location, location_limit))
+        # 24小时店铺在前，其余按快照顺序排列
+        always_open_mask = snapshot.open_bitmap.always_open_mask
+        matched = [i for i in snapshot.time_index.always_open if mask >> i & 1]
+        matched.extend(iter_bits(mask & ~always_open_mask))
+        return snapshot.rows_at(matched)
+    except Exception as e:
+        print(f"查找当前营业的店铺时出错: {e}")
+        return []
+
+# 通过OpenAI处理查询
+_prompt_context = None  # (快照版本, 地区列表, 系统提示)
+
+def _build_system_prompt(areas):
+    return f"""You are an AI assistant for a Subway restaurant map application. 
 Your task is to interpret user queries about Subway stores and extract relevant information.
 You have access to information about Subway outlets in various locations.
 Available areas include: {', '.join(areas)}
@@ -1675,1316 +1056,419 @@ For "open now" or "currently open" queries, these should be handled as time_quer
 You MUST follow these formats EXACTLY. ONLY reply with the JSON object. Do not add any other text.
 """
 
-            # 没有OpenAI客户端时的备用处理
+
+def get_prompt_context(snapshot):
+    """提示词中的地区列表和渲染好的系统提示，按快照版本缓存（数据刷新前不重复构建，也不查询数据库）"""
+    global _prompt_context
+    context = _prompt_context
+    if context is None or context[0] != snapshot.version:
+        # 与原来的 SELECT DISTINCT city ... LIMIT 20 相同：最多 20 个非空城市
+        areas = snapshot.gazetteer.cities[:20]
+        context = _prompt_context = (snapshot.version, areas, _build_system_prompt(areas))
+    return context[1], context[2]
+
+
+# 相同问题的并发请求只调用一次模型 / 只执行一次查询，结果分发给所有等待者
+ai_flight = SingleFlight("process_with_ai")
+chatbot_flight = SingleFlight("chatbot")
+
+
+def _chat_request_key(route):
+    """聊天路由的合并键：路由 + 规范化问题 + 用户位置 + explain + fields + 快照版本（批量请求固定了快照时不会合并到其他版本上）"""
+    return lambda request: (route, normalize_query(request.query), request.lat, request.lon, request.explain,
+                            request.fields, outlet_store.snapshot().version)
+
+
+async def process_with_ai(query):
+    """解析用户意图；正在进行中的相同问题直接等待同一次解析的结果"""
+    key = (normalize_query(query), outlet_store.snapshot().version)
+    result = await ai_flight.do(key, _process_with_ai, query)
+    return dict(result)
+
+
+async def _process_with_ai(query):
+    try:
+        snapshot = outlet_store.snapshot()
+        gazetteer = snapshot.gazetteer
+
+        # 本地规则解析优先：置信度足够（或未配置OpenAI）时不调用模型
+        intent, confidence = intent_parser.parse(query, gazetteer)
+        if confidence >= intent_parser.min_confidence or not client:
             if not client:
-                print("⚠️ 未配置OpenAI API密钥，使用默认解析")
-                
-                # 提取位置和时间的简单规则
-                location_match = None
-                time_match = None
-                
-                # Check for location keywords in English
-                for area in areas:
-                    if area.lower() in query.lower():
-                        location_match = area
-                        break
-                
-                # Pattern matching for locations in different formats
-                location_patterns = [
-                    r'in\s+([a-zA-Z\s]+)(?:\s+that|\s+which|\s+area|\s+district)?',  # "in Bangsar area"
-                    r'([a-zA-Z\s]+)\s+(?:area|district|region)',  # "Bangsar area"
-                    r'near\s+([a-zA-Z\s]+)',  # "near KLCC"
-                    r'around\s+([a-zA-Z\s]+)',  # "around Sunway"
-                ]
-                
-                for pattern in location_patterns:
-                    match = re.search(pattern, query)
-                    if match:
-                        potential_location = match.group(1).strip().lower()
-                        # Check if extracted location is in our known areas
-                        for area in areas:
-                            if area.lower() in potential_location:
-                                location_match = area
-                                break
-                        if location_match:
-                            break
-                
-                # Check for time-related patterns
-                time_patterns = [
-                    r'(?:close|closes|closing)?\s*(?:before|after)\s+(\d+(?::\d+)?(?:\s*[ap]m)?)',  # "close before 9:30am"
-                    r'before\s+(\d+(?::\d+)?(?:\s*[ap]m)?)',  # "before 8pm"
-                    r'after\s+(\d+(?::\d+)?(?:\s*[ap]m)?)',  # "after 10pm"
-                    r'at\s+(\d+(?::\d+)?(?:\s*[ap]m)?)',  # "at 7pm"
-                    r'(\d+(?::\d+)?(?:\s*[ap]m)?)',  # "8pm", "9:30am"
-                    r'(now|currently|at this time)'  # current time
-                ]
-                
-                for pattern in time_patterns:
-                    match = re.search(pattern, query.lower())
-                    if match:
-                        time_match = match.group(0)
-                        break
-                
-                # Check for opening/closing keywords
-                is_opening_query = any(kw in query.lower() for kw in ["open", "opens", "opening"])
-                is_closing_query = any(kw in query.lower() for kw in ["close", "closes", "closing"])
-                is_still_open_query = any(kw in query.lower() for kw in ["still open", "still operating"])
-                is_before_query = "before" in query.lower()
-                
-                # Handle compound query - location + time
-                if location_match and time_match:
-                    # Build time condition
-                    if is_opening_query:
-                        time_condition = f"open {time_match}"
-                    elif is_closing_query:
-                        time_condition = f"close {time_match}"
-                    elif is_still_open_query or "after" in time_match:
-                        time_condition = f"open {time_match}"
-                    elif is_before_query and not (is_opening_query or is_closing_query):
-                        # 如果只有"before X"这样的查询，并且没有明确指定开门或关门，默认为关门查询
-                        time_condition = f"close {time_match}"
-                    else:
-                        time_condition = time_match
-                    
-                    # 确保时间条件不包含位置信息
-                    location_lower = location_match.lower()
-                    if location_lower in time_condition.lower():
-                        # 从时间查询中移除位置信息
-                        time_condition = re.sub(f'(?i)(?:at|in)?\s+{re.escape(location_lower)}', '', time_condition).strip()
-                    
-                    return {
-                        "answer": f"Looking for outlets in {location_match} that match the time condition: {time_condition}.",
-                        "action": "compound_query",
-                        "location": location_match,
-                        "time": time_condition
-                    }
-                    
-                # 以下是原有代码的处理逻辑...
-                
-                # 检查是否是特定时间开店查询
-                if ("open before" in query.lower() or 
-                    "opens before" in query.lower()):
-                    time_pattern = r'(before|after)\s+(\d+(?::\d+)?(?:\s*[ap]m)?)'
-                    match = re.search(time_pattern, query.lower())
-                    if match:
-                        time_query = match.group(0)
-                        return {
-                            "answer": f"Let me find Subway outlets that open {time_query}.",
-                            "action": "opening_time_query",
-                            "time": time_query,
-                            "location": location_match
-                        }
-                
-                # 检查是否为特殊时间+位置查询（如最早开门、最晚关门等）
-                special_time_patterns = [
-                    (r'earliest\s+(?:to\s+)?open', 'earliest_opening'),
-                    (r'open\s+(?:the\s+)?earliest', 'earliest_opening'),
-                    (r'latest\s+(?:to\s+)?open', 'latest_opening'),
-                    (r'open\s+(?:the\s+)?latest', 'latest_opening'),
-                    (r'earliest\s+(?:to\s+)?close', 'earliest_closing'),
-                    (r'close\s+(?:the\s+)?earliest', 'earliest_closing'),
-                    (r'latest\s+(?:to\s+)?close', 'latest_closing'),
-                    (r'close\s+(?:the\s+)?latest', 'latest_closing')
-                ]
-                
-                for pattern, attribute in special_time_patterns:
-                    if re.search(pattern, query.lower()) and location_match:
-                        print(f"检测到特殊时间+位置查询 - 位置: {location_match}, 属性: {attribute}")
-                        return {
-                            "answer": f"Looking for outlets in {location_match} with attribute: {attribute}",
-                            "action": "special_time_location",
-                            "location": location_match,
-                            "attribute": attribute
-                        }
-                
-                # 检查是否是"still open after"或"open after"查询（同样的处理方式）
-                if ("still open after" in query.lower() or 
-                    "still open before" in query.lower() or
-                    "open after" in query.lower() or
-                    "opens after" in query.lower()):
-                    time_pattern = r'(before|after)\s+(\d+(?::\d+)?(?:\s*[ap]m)?)'
-                    match = re.search(time_pattern, query.lower())
-                    if match:
-                        time_query = match.group(0)
-                        action_type = "still_open_after" if "after" in time_query.lower() else "still_open_before"
-                        return {
-                            "answer": f"Let me find Subway outlets that are still open {time_query}.",
-                            "action": action_type,
-                            "time": time_query,
-                            "location": location_match
-                        }
-                
-                # 检查是否是特定时间关店查询
-                if ("close before" in query.lower() or "close after" in query.lower() or 
-                    "closes before" in query.lower() or "closes after" in query.lower()):
-                    time_pattern = r'(before|after)\s+(\d+(?::\d+)?(?:\s*[ap]m)?)'
-                    match = re.search(time_pattern, query.lower())
-                    if match:
-                        time_query = match.group(0)
-                        return {
-                            "answer": f"Let me find Subway outlets that close {time_query}.",
-                            "action": "closing_time_query",
-                            "time": time_query,
-                            "location": location_match
-                        }
-                
-                # 检查是否包含时间关键词
-                time_keywords = ["open", "close", "opening", "closing", "hour", "time", "now", "late", "early", "24"]
-                has_time_keywords = any(kw in query.lower() for kw in time_keywords)
-                
-                if location_match and has_time_keywords:
-                    return {
-                        "answer": f"Let me check Subway outlets in {location_match} for the specified time.",
-                        "action": "time_query",
-                        "location": location_match,
-                        "time": "now" if "now" in query.lower() else "business_hours"
-                    }
-                elif location_match:
-                    return {
-                        "answer": f"Let me find Subway outlets in {location_match}.",
-                        "action": "search_location",
-                        "location": location_match
-                    }
-                elif "nearest" in query.lower() or "near" in query.lower() or "nearby" in query.lower() or "close to" in query.lower():
-                    return {
-                        "answer": "Let me find the nearest Subway outlets to your location.",
-                        "action": "get_nearest",
-                        "location": "user_location"
-                    }
-                elif "open now" in query.lower() or "currently open" in query.lower():
-                    return {
-                        "answer": "Let me find Subway outlets that are currently open.",
-                        "action": "time_query",
-                        "time": "now"
-                    }
-                elif "earliest opening" in query.lower() or "open earliest" in query.lower() or "open the earliest" in query.lower():
-                    return {
-                        "answer": "Let me find which Subway outlet opens the earliest.",
-                        "action": "get_attribute",
-                        "attribute": "earliest_opening"
-                    }
-                elif "latest closing" in query.lower() or "close latest" in query.lower() or "close the latest" in query.lower():
-                    return {
-                        "answer": "Let me find which Subway outlet closes the latest.",
-                        "action": "get_attribute",
-                        "attribute": "latest_closing"
-                    }
-                elif "earliest closing" in query.lower() or "close earliest" in query.lower() or "close the earliest" in query.lower():
-                    return {
-                        "answer": "Let me find which Subway outlet closes the earliest.",
-                        "action": "get_attribute",
-                        "attribute": "earliest_closing"
-                    }
-                elif "24 hour" in query.lower() or "24hour" in query.lower() or "all day" in query.lower() or "all night" in query.lower():
-                    return {
-                        "answer": "Let me find Subway outlets that are open 24 hours.",
-                        "action": "get_attribute",
-                        "attribute": "24hours"
-                    }
-                elif "latest opening" in query.lower() or "open latest" in query.lower() or "open the latest" in query.lower():
-                    return {
-                        "answer": "Let me find which Subway outlet opens the latest.",
-                        "action": "get_attribute",
-                        "attribute": "latest_opening"
-                    }
-                else:
-                    return {
-                        "answer": "I'm not sure how to answer that. You can ask about Subway outlets in specific locations, opening times, or find the nearest outlet to your location.",
-                        "action": ""
-                    }
+                print("⚠️ 未配置OpenAI API密钥，使用本地解析")
+            print(f"✅ 本地解析意图 (置信度 {confidence}): {intent}")
+            return intent
+
+        # 相同（规范化后）或槽位签名相同的问题直接复用缓存的意图，跳过模型调用
+        cached, needs_audit = intent_cache.get(query, gazetteer)
+        if cached is not None and not needs_audit:
+            cached["answer"] = describe_intent(cached)
+            print(f"✅ 意图缓存命中: {cached}")
+            return cached
+        # 抽样核对：签名命中但仍调用模型，比较两者是否一致
+        audit_against = cached
+
+        # 地区列表和系统提示按快照版本缓存，调用模型前不需要查询数据库
+        _, system_prompt = get_prompt_context(snapshot)
+
+        # 使用OpenAI API
+        try:
+            # 可视化消息流
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query}
+            ]
             
-            # 使用OpenAI API
-            try:
-                # 可视化消息流
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ]
-                
-                response = client.chat.completions.create(
+            response = await guarded_call(
+                lambda: client.chat.completions.create(
                     model="gpt-3.5-turbo",
                     messages=messages,
                     temperature=0.3,
                     max_tokens=150
-                )
+                ),
+                openai_breaker,
+                openai_retry_budget,
+                timeout=OPENAI_TIMEOUT,
+                max_retries=OPENAI_MAX_RETRIES,
+                retryable=(APIConnectionError, RateLimitError, InternalServerError),
+            )
+            
+            result_text = response.choices[0].message.content
+            
+            # 尝试解析JSON
+            try:
+                result = json.loads(result_text)
+                if audit_against is not None:
+                    intent_cache.audit(audit_against, result)
+                intent_cache.put(query, result, gazetteer)
+                return result
+            except json.JSONDecodeError as e:
+                print(f"解析AI回复为JSON时出错: {e}")
+                print(f"原始回复: {result_text}")
                 
-                result_text = response.choices[0].message.content
+                # 尝试提取JSON部分
+                json_extract = re.search(r'(\{.*?\})', result_text, re.DOTALL)
+                if json_extract:
+                    try:
+                        result = json.loads(json_extract.group(1))
+                        if audit_against is not None:
+                            intent_cache.audit(audit_against, result)
+                        intent_cache.put(query, result, gazetteer)
+                        return result
+                    except:
+                        pass
                 
-                # 尝试解析JSON
-                try:
-                    result = json.loads(result_text)
-                    return result
-                except json.JSONDecodeError as e:
-                    print(f"解析AI回复为JSON时出错: {e}")
-                    print(f"原始回复: {result_text}")
-                    
-                    # 尝试提取JSON部分
-                    json_extract = re.search(r'(\{.*?\})', result_text, re.DOTALL)
-                    if json_extract:
-                        try:
-                            result = json.loads(json_extract.group(1))
-                            return result
-                        except:
-                            pass
-                    
-                    # 备用策略：使用规则
-                    return {
-                        "answer": result_text,
-                        "action": ""
-                    }
-                    
-            except Exception as e:
-                print(f"调用OpenAI API时出错: {e}")
+                # 备用策略：使用规则
                 return {
-                    "answer": "I'm sorry, I'm having trouble processing your request at the moment. Please try again or ask a different question.",
+                    "answer": result_text,
                     "action": ""
                 }
                 
+        except CircuitOpenError:
+            # 熔断期间不调用模型，直接使用本地解析结果
+            print(f"⚠️ OpenAI熔断中，使用本地解析 (置信度 {confidence})")
+            return intent
+        except Exception as e:
+            print(f"调用OpenAI API时出错，使用本地解析: {e!r}")
+            return intent
+            
     except Exception as e:
         print(f"Error in process_with_ai: {e}")
         return {
             "answer": "I'm sorry, I'm having trouble understanding your request. Could you rephrase it?",
             "action": ""
         }
-    finally:
-        conn.close()
 
 # === API路由 ===
 
+@app.on_event("startup")
+def load_outlet_snapshot():
+    """启动时加载门店快照并开启定时刷新"""
+    try:
+        outlet_store.refresh()
+    except Exception as e:
+        print(f"⚠️ 启动时加载门店快照失败，在后台重试，加载成功前读接口返回 503: {e}")
+    outlet_store.start()
+
+@app.on_event("shutdown")
+def shutdown_db_pool():
+    """进程退出时停止快照刷新并关闭连接池"""
+    outlet_store.stop()
+    close_pool()
+
 @app.get("/")
 def root():
     return {"message": "Welcome to the Subway API! Use /docs for documentation."}
 
+@app.get("/health")
+def health():
+    """健康检查：快照是否已加载、OpenAI 熔断器状态"""
+    store = outlet_store.stats()
+    breaker = openai_breaker.stats()
+    return {
+        "status": "ok" if store["version"] is not None and breaker["state"] == "closed" else "degraded",
+        "snapshot_version": store["version"],
+        "openai_circuit": breaker,
+    }
+
+@app.get("/api/metrics")
+def service_metrics():
+    """服务内部指标（连接池等待时间、饱和度等）"""
+    return {
+        "db_pool": get_pool_stats(),
+        "outlet_store": outlet_store.stats(),
+        "intent_parser": intent_parser.stats(),
+        "intent_cache": intent_cache.stats(),
+        "openai": {"circuit": openai_breaker.stats(), "retry_budget": openai_retry_budget.stats()},
+        "single_flight": {flight.name: flight.stats() for flight in (ai_flight, chatbot_flight)},
+        "etag": etag_stats(),
+        "precompressed": precompressed_stats()
+    }
+
+@app.post("/api/outlets/refresh")
+def refresh_outlet_snapshot():
+    """立即重新加载门店快照（例如爬虫写入新数据之后）"""
+    try:
+        snapshot = outlet_store.refresh()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Snapshot refresh failed: {e}")
+    return {"version": snapshot.version, "count": len(snapshot)}
+
 @app.get("/outlets")
-def get_all_outlets():
-    """获取所有门店信息"""
-    conn = get_db_connection()
+@etag_scope("static")
+def get_all_outlets(page: Page = Depends(), fields: Fields = Depends()):
+    """获取所有门店信息，可用 limit / after_id 按 ID 键集分页，fields 只返回指定的列"""
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM subway_outlets;")
-            rows = cur.fetchall()
-            outlets = [dict(r) for r in rows]
-        return {"outlets": outlets}
+        # 全表的片段（每种字段组合）在快照内缓存，这里只是拼接预编码的片段
+        snapshot = outlet_store.snapshot()
+        if not page.requested:
+            return FastJSONResponse({"outlets": snapshot.encoded_rows(fields.names)})
+        # 快照按 ID 升序排列，直接二分定位本页；字段组合没有缓存时只编码本页
+        start, stop = page.window(snapshot.ids)
+        return FastJSONResponse({"outlets": snapshot.encoded_range(start, stop, fields.names),
+                                 "page": page.info(snapshot.ids, start, stop)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.post("/chatbot/query")
+@chatbot_flight.coalesce(_chat_request_key("/chatbot/query"))
 async def query_chatbot(request: ChatRequest):
+    """聊天查询：解析意图 → 生成查询计划（位置、时间、最早/最晚、空间排序）→ 在快照索引上一次执行
+
+    请求中 explain 为 true 时，响应附带解析出的意图、查询计划（plan）和各阶段耗时（stages）；
+    提供 fields 时响应附带 related_ids 对应店铺的这些列（outlets）。
+    """
     user_query = request.query
-    user_lat = request.lat
-    user_lon = request.lon
     
     # 打印查询详情
     print(f"收到查询: {user_query}")
-    print(f"用户位置: 纬度 {user_lat}, 经度 {user_lon}" if user_lat and user_lon else "用户未提供位置")
+    print(f"用户位置: 纬度 {request.lat}, 经度 {request.lon}" if request.lat and request.lon else "用户未提供位置")
     
     # 使用process_with_ai处理查询，获取用户意图
-    ai_result = process_with_ai(user_query)
+    start = time.perf_counter()
+    ai_result = await process_with_ai(user_query)
+    intent_ms = round((time.perf_counter() - start) * 1000, 3)
     print(f"AI处理结果: {ai_result}")
     
-    # === 特殊查询路由 ===
-    
-    # 处理当前时间的查询
-    if "open now" in user_query.lower() or "currently open" in user_query.lower() or "now open" in user_query.lower():
-        print("转发到当前时间查询处理器")
-        return await handle_current_time_query(request)
-    
-    # 检测是否包含位置信息的特殊时间查询
-    query_lower = user_query.lower()
-    
-    # 检查是否是get_attribute操作但实际包含位置信息的情况
-    if ai_result.get("action") == "get_attribute" and ai_result.get("attribute") in ["earliest_opening", "latest_opening", "earliest_closing", "latest_closing"]:
-        # 验证查询中是否真的包含earliest/latest关键词
-        attribute_type = ai_result.get("attribute")
-        attribute_keywords = {
-            "earliest_opening": ["earliest", "first", "soonest"],
-            "latest_opening": ["latest", "last"],  
-            "earliest_closing": ["earliest", "first", "soonest"],
-            "latest_closing": ["latest", "last"]
-        }
-        
-        keywords_present = any(kw in query_lower for kw in attribute_keywords.get(attribute_type, []))
-        time_pattern_present = re.search(r'\b(before|after|at)\s+\d+(?::\d+)?\s*(?:am|pm)?\b', query_lower)
-        
-        if not keywords_present and time_pattern_present:
-            print(f"⚠️ 查询'{query_lower}'包含时间匹配模式但缺少'{attribute_type}'关键词，重新路由为时间查询")
-            # 提取时间部分
-            time_match = re.search(r'\b(before|after|at)\s+\d+(?::\d+)?\s*(?:am|pm)?\b', query_lower)
-            if time_match:
-                time_query = time_match.group(0)
-                # 重定向到时间查询处理
-                if "before" in time_query and "close" in query_lower:
-                    print(f"重定向到'关门前'时间查询: {time_query}")
-                    return find_outlets_by_closing_time(time_query, is_weekend=False)
-                elif "after" in time_query and "open" in query_lower:
-                    print(f"重定向到'开门后'时间查询: {time_query}")
-                    return find_outlets_by_opening_time(time_query, is_weekend=False)
-        
-        # 继续正常处理位置信息
-        conn = connect_db()
+    # 同一次请求内只取一次快照，计划的所有阶段都在它上面执行
+    snapshot = outlet_store.snapshot()
+    start = time.perf_counter()
+    plan = build_plan(ai_result, user_query, request.lat, request.lon)
+    plan_ms = round((time.perf_counter() - start) * 1000, 3)
+    result = execute_plan(plan, snapshot)
+    print(f"查询计划: {plan.describe()}，找到 {len(result.indexes)} 家店铺")
+    
+    response = plan_response(result, explain=request.explain)
+    if request.fields:
+        names = parse_fields(request.fields)
+        response["outlets"] = [project_row(o, names) for o in result.outlets]
+    if request.explain:
+        response["intent"] = ai_result
+        response["snapshot_version"] = snapshot.version
+        response["stages"] = [{"stage": "intent", "ms": intent_ms},
+                              {"stage": "plan", "ms": plan_ms}] + response["stages"]
+    return response
+
+# 流式回答：先推送确定性查询得到的店铺，再逐个 token 推送模型生成的回答
+ANSWER_SYSTEM_PROMPT = (
+    "You are the assistant of a Subway outlet map. Rewrite the search result below as a short, friendly "
+    "answer to the user's question, in the user's language. Only mention outlets and facts given in the result."
+)
+
+
+def _sse(event, data):
+    """一条 Server-Sent Events 消息（店铺行中的 Decimal、datetime 由 orjson 编码）"""
+    return f"event: {event}\ndata: {json_dumps(data).decode('utf-8')}\n\n"
+
+
+def _chat_result_payload(result):
+    """聊天处理器的返回值统一为 (answer, related_ids, center)；个别分支直接返回店铺列表"""
+    if isinstance(result, list):
+        coords = [c for c in (parse_coordinates(o) for o in result) if c]
+        center = [sum(c[0] for c in coords) / len(coords), sum(c[1] for c in coords) / len(coords)] if coords else []
+        return f"I found {len(result)} Subway outlets.", [o['id'] for o in result], center
+    return result.get("answer") or "", result.get("related_ids", []), result.get("center", [])
+
+
+async def _stream_answer_tokens(query, answer, related_ids):
+    """用模型把查询结果改写成自然语言回答并逐段产出；模型不可用或出错时产出模板回答
+
+    无论正常结束、出错、超时还是客户端断开（生成器被关闭），上游的流都会被关闭。
+    """
+    streamed = False
+    stream = None
+    if client:
+        snapshot = outlet_store.snapshot()
+        names = [snapshot.by_id[i]['name'] for i in related_ids[:5] if i in snapshot.by_id]
+        messages = [
+            {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Question: {query}\nSearch result: {answer}\n"
+                                        f"Outlets: {', '.join(names) or 'none'}"}
+        ]
         try:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                # 获取已知的所有地区
-                cur.execute("""
-                    SELECT DISTINCT city 
-                    FROM subway_outlets 
-                    WHERE city IS NOT NULL AND city != ''
-                """)
-                all_areas = [row[0].lower() for row in cur.fetchall() if row[0]]
-                
-                # 检查查询中是否包含已知的地区
-                location_in_query = None
-                for area in all_areas:
-                    # 添加完整单词匹配检查，避免数字或部分字符被错误匹配
-                    # 使用正则表达式查找完整的单词匹配
-                    if re.search(r'\b' + re.escape(area.lower()) + r'\b', query_lower):
-                        location_in_query = area
-                        break
-                
-                # 如果原始AI结果没有位置但查询中包含位置，重新路由
-                if location_in_query:
-                    print(f"检测到查询中包含位置信息：{location_in_query}，但AI未正确识别。重新路由为特殊时间+位置查询。")
-                    # 修改请求属性
-                    modified_request = ChatRequest(
-                        query=f"{ai_result.get('attribute')} in {location_in_query}",
-                        lat=request.lat,
-                        lon=request.lon
-                    )
-                    return await handle_special_time_in_location(modified_request)
+            stream = await guarded_call(
+                lambda: client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=messages,
+                    temperature=0.3,
+                    max_tokens=150,
+                    stream=True
+                ),
+                openai_breaker,
+                openai_retry_budget,
+                timeout=OPENAI_TIMEOUT,
+                max_retries=OPENAI_MAX_RETRIES,
+                retryable=(APIConnectionError, RateLimitError, InternalServerError),
+            )
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    # 每段之间同样受超时限制，上游中途卡住时不会一直挂着连接
+                    chunk = await asyncio.wait_for(chunks.__anext__(), OPENAI_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    # 建立流时已经记为成功，中途卡住同样算一次上游失败
+                    openai_breaker.record_failure(OPENAI_TIMEOUT)
+                    raise
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    streamed = True
+                    yield token
+        except Exception as e:
+            print(f"⚠️ 流式生成回答失败，使用模板回答: {e!r}")
         finally:
-            conn.close()
-    
-    # 检查AI是否识别为特殊时间+位置查询
-    if ai_result.get("action") == "special_time_location":
-        print(f"AI识别为特殊时间+位置查询: {user_query}")
-        print(f"位置: {ai_result.get('location')}, 属性: {ai_result.get('attribute')}")
-        return await handle_special_time_in_location(request)
-    
-    # 关键词手动检测最早/最晚开门/关门+位置的查询
-    has_special_time_keyword = any(kw in query_lower for kw in [
-        "earliest", "latest", "first", "last"
-    ])
-    has_time_action = any(kw in query_lower for kw in [
-        "open", "close", "opening", "closing"
-    ])
-    location = ai_result.get("location")
-    
-    # 直接匹配特定格式的查询
-    is_special_format = False
-    if location:
-        special_patterns = [
-            r'latest\s+opening\s+(?:outlet|store|subway|restaurant)?\s+in\s+\w+',
-            r'earliest\s+opening\s+(?:outlet|store|subway|restaurant)?\s+in\s+\w+',
-            r'latest\s+closing\s+(?:outlet|store|subway|restaurant)?\s+in\s+\w+',
-            r'earliest\s+closing\s+(?:outlet|store|subway|restaurant)?\s+in\s+\w+',
-            r'(?:outlet|store|subway|restaurant)?\s+(?:that|which)\s+opens?\s+(?:the\s+)?latest\s+in\s+\w+',
-            r'(?:outlet|store|subway|restaurant)?\s+(?:that|which)\s+opens?\s+(?:the\s+)?earliest\s+in\s+\w+',
-            r'(?:outlet|store|subway|restaurant)?\s+(?:that|which)\s+closes?\s+(?:the\s+)?latest\s+in\s+\w+',
-            r'(?:outlet|store|subway|restaurant)?\s+(?:that|which)\s+closes?\s+(?:the\s+)?earliest\s+in\s+\w+',
-        ]
-        for pattern in special_patterns:
-            if re.search(pattern, query_lower):
-                is_special_format = True
-                break
-    
-    # 如果匹配特殊格式或同时包含时间关键词和位置，使用特殊时间处理器
-    if (is_special_format or (has_special_time_keyword and has_time_action and location)):
-        print(f"检测到特殊时间+位置查询: '{user_query}'")
-        print(f"位置: {location}")
-        return await handle_special_time_in_location(request)
-    
-    # 检查是否为复合查询（位置+时间）
-    if ai_result.get("action") == "compound_query":
-        print("检测到复合查询（位置+时间），转发到复合查询处理器")
-        return await handle_compound_query(request)
-    
-    # 处理其他类型的查询...
-    # 提取时间模式 - 用于后续处理
-    time_pattern = r'(before|after)\s+(\d+(?::\d+)?(?:\s*[ap]m)?)'
-    time_match = re.search(time_pattern, user_query.lower())
-    
-    # 提取可能的位置信息
-    location = None
-    for loc in ['bangsar', 'klcc', 'pj', 'petaling', 'subang', 'sunway', 'damansara', 'kl', 'shah alam']:
-        if loc in user_query.lower():
-            location = loc
-            break
-    
-    # 检查是否是关于开门时间的查询
-    is_opening_query = (
-        "open before" in user_query.lower() or 
-        "opens before" in user_query.lower() or
-        "which subway outlets open before" in user_query.lower() or 
-        # 检查位置相关开门查询，例如 "which sunway outlets open before 10 pm"
-        (location and "open" in user_query.lower() and "before" in user_query.lower() and time_match)
+            if stream is not None:
+                await stream.close()
+    if not streamed:
+        yield answer
+
+
+async def _chat_event_stream(request):
+    # 第一个事件立即发出，首字节不必等待意图解析（可能是一次模型调用）
+    yield _sse("status", {"stage": "searching"})
+    try:
+        result = await query_chatbot(request)
+    except HTTPException as e:
+        yield _sse("error", {"detail": e.detail})
+        return
+    except Exception as e:
+        print(f"⚠️ 流式聊天查询失败: {e!r}")
+        yield _sse("error", {"detail": str(e)})
+        return
+
+    answer, related_ids, center = _chat_result_payload(result)
+    results = {"related_ids": related_ids, "center": center}
+    if isinstance(result, dict) and "outlets" in result:
+        results["outlets"] = result["outlets"]
+    yield _sse("results", results)
+
+    tokens = []
+    answer_tokens = _stream_answer_tokens(request.query, answer, related_ids)
+    try:
+        async for token in answer_tokens:
+            tokens.append(token)
+            yield _sse("answer", {"token": token})
+    finally:
+        # 客户端断开时本生成器被关闭，内层生成器也要立即关闭，才能及时关闭上游的流
+        await answer_tokens.aclose()
+    yield _sse("done", {"answer": "".join(tokens)})
+
+
+@app.post("/chatbot/query/stream")
+async def query_chatbot_stream(request: ChatRequest):
+    """/chatbot/query 的流式版本（Server-Sent Events）
+
+    事件依次为：status（立即发送，不等待意图解析）、
+    results（related_ids 和 center，请求带 fields 时还有 outlets，查询完成后立即发送）、
+    若干 answer（模型生成的回答片段）、done（完整回答）；出错时为 error。
+    """
+    return StreamingResponse(
+        _chat_event_stream(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    
-    # 检查是否是"open after"或"still open after"查询 - 这类查询应该使用find_outlets_by_time
-    is_still_open_query = (
-        "still open after" in user_query.lower() or 
-        "still open before" in user_query.lower() or
-        "are still open after" in user_query.lower() or
-        "are still open before" in user_query.lower() or
-        "still open" in user_query.lower() and "after" in user_query.lower() or
-        "still open" in user_query.lower() and "before" in user_query.lower() or
-        # 将 "open after" 也视为 "still open after"
-        "open after" in user_query.lower() or
-        "opens after" in user_query.lower() or
-        "which subway outlets open after" in user_query.lower() or
-        # 检查位置相关后时间开门查询
-        (location and "open" in user_query.lower() and "after" in user_query.lower() and time_match)
-    )
-    
-    # 检查是否是关于关门时间的查询
-    is_closing_query = (
-        "close before" in user_query.lower() or 
-        "close after" in user_query.lower() or 
-        "closes before" in user_query.lower() or 
-        "closes after" in user_query.lower() or
-        "which subway outlets close before" in user_query.lower() or 
-        "which subway outlets close after" in user_query.lower() or
-        # 检查位置相关关门查询
-        (location and "close" in user_query.lower() and time_match)
-    )
-    
-    # 处理"仍然营业"查询（使用find_outlets_by_time函数）
-    if is_still_open_query and time_match:
-        print("处理'仍然营业'查询")
-        full_time_query = time_match.group(0)  # 包含 "after 10pm" 这样的完整短语
-        time_direction = time_match.group(1)  # "before" 或 "after"
-        time_value = time_match.group(2)  # "10pm" 或 "9:30pm" 等
-        
-        print(f"解析时间查询: 方向={time_direction}, 时间值={time_value}, 完整查询={full_time_query}")
-        
-        # 检查是否指定了周末或工作日
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5
-            
-        print(f"查询的日期类型: {'周末' if is_weekend else '工作日'}")
-        
-        if location:
-            print(f"查询在{location}地区{full_time_query}营业的门店")
-            # 特定地区在特定时间仍然营业的门店
-            outlets = find_outlets_compound(location, full_time_query)
-        else:
-            print(f"查询{full_time_query}仍然营业的门店")
-            # 所有在特定时间仍然营业的门店
-            outlets = find_outlets_by_time(full_time_query, is_weekend=is_weekend)
-            
-        print(f"查询结果: 找到 {len(outlets) if outlets else 0} 家符合条件的店铺")
-            
-        day_type = "weekend" if is_weekend else "weekday"
-        if not outlets:
-            location_str = f" in {location}" if location else ""
-            return {"answer": f"I couldn't find any Subway outlets that are still open {full_time_query}{location_str} on {day_type}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            valid_outlets = [o for o in outlets if o.get('latitude') and o.get('longitude')]
-            if valid_outlets:
-                avg_lat = sum(float(o['latitude']) for o in valid_outlets) / len(valid_outlets)
-                avg_lng = sum(float(o['longitude']) for o in valid_outlets) / len(valid_outlets)
-                center = [avg_lat, avg_lng]
-            else:
-                center = []
-        except Exception as e:
-            print(f"计算地图中心点时出错: {e}")
-            center = []
-            
-        location_str = f" in {location}" if location else ""
-        
-        # 输出前几家店铺的名称，作为调试信息
-        if outlets and len(outlets) > 0:
-            sample_names = [o['name'] for o in outlets[:min(5, len(outlets))]]
-            print(f"示例店铺: {', '.join(sample_names)}")
-        
-        return {
-            "answer": f"I found {count} Subway outlets that are still open {full_time_query}{location_str} on {day_type}.",
-            "related_ids": ids,
-            "center": center
-        }
-    # 处理开门时间查询
-    elif is_opening_query:
-        print("处理特定时间开店查询")
-        full_time_query = time_match.group(0)  # 包含 "before 9am" 这样的完整短语
-        time_direction = time_match.group(1)  # "before" 或 "after"
-        time_value = time_match.group(2)  # "9am" 或 "9:30am" 等
-        
-        print(f"解析时间查询: 方向={time_direction}, 时间值={time_value}, 完整查询={full_time_query}")
-        
-        # 检查是否指定了周末或工作日
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5
-            
-        print(f"查询的日期类型: {'周末' if is_weekend else '工作日'}")
-        
-        if location:
-            print(f"查询在{location}地区{full_time_query}开店的门店")
-            # 特定地区特定时间开店的门店
-            outlets = find_outlets_compound(location, full_time_query)
-        else:
-            print(f"查询{full_time_query}开店的门店")
-            # 所有特定时间开店的门店
-            outlets = find_outlets_by_opening_time(full_time_query, is_weekend)
-            
-        print(f"查询结果: 找到 {len(outlets) if outlets else 0} 家符合条件的店铺")
-            
-        day_type = "weekend" if is_weekend else "weekday"
-        if not outlets:
-            location_str = f" in {location}" if location else ""
-            return {"answer": f"I couldn't find any Subway outlets that open {full_time_query}{location_str} on {day_type}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            valid_outlets = [o for o in outlets if o.get('latitude') and o.get('longitude')]
-            if valid_outlets:
-                avg_lat = sum(float(o['latitude']) for o in valid_outlets) / len(valid_outlets)
-                avg_lng = sum(float(o['longitude']) for o in valid_outlets) / len(valid_outlets)
-                center = [avg_lat, avg_lng]
-            else:
-                center = []
-        except Exception as e:
-            print(f"计算地图中心点时出错: {e}")
-            center = []
-            
-        location_str = f" in {location}" if location else ""
-        
-        # 输出前几家店铺的名称，作为调试信息
-        if outlets and len(outlets) > 0:
-            sample_names = [o['name'] for o in outlets[:min(5, len(outlets))]]
-            print(f"示例店铺: {', '.join(sample_names)}")
-        
-        return {
-            "answer": f"I found {count} Subway outlets that open {full_time_query}{location_str} on {day_type}.",
-            "related_ids": ids,
-            "center": center
-        }
-    
-    # 处理关门时间查询
-    elif is_closing_query and time_match:
-        print("处理特定时间关店查询")
-        full_time_query = time_match.group(0)  # 包含 "after 9pm" 这样的完整短语
-        time_direction = time_match.group(1)  # "before" 或 "after"
-        time_value = time_match.group(2)  # "9pm" 或 "9:30am" 等
-        
-        print(f"解析时间查询: 方向={time_direction}, 时间值={time_value}, 完整查询={full_time_query}")
-        
-        # 检查是否指定了周末或工作日
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5
-            
-        print(f"查询的日期类型: {'周末' if is_weekend else '工作日'}")
-        
-        if location:
-            print(f"查询在{location}地区{full_time_query}关店的门店")
-            # 特定地区特定时间关店的门店
-            outlets = find_outlets_compound(location, full_time_query)
-        else:
-            print(f"查询{full_time_query}关店的门店")
-            # 所有特定时间关店的门店
-            outlets = find_outlets_by_closing_time(full_time_query, is_weekend)
-            
-        print(f"查询结果: 找到 {len(outlets) if outlets else 0} 家符合条件的店铺")
-            
-        day_type = "weekend" if is_weekend else "weekday"
-        if not outlets:
-            location_str = f" in {location}" if location else ""
-            return {"answer": f"I couldn't find any Subway outlets that close {full_time_query}{location_str} on {day_type}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
+
+async def _answer_batch_item(index, request, semaphore):
+    """处理批量请求中的一条，单条失败不影响其他条目"""
+    async with semaphore:
+        start = time.perf_counter()
         try:
-            valid_outlets = [o for o in outlets if o.get('latitude') and o.get('longitude')]
-            if valid_outlets:
-                avg_lat = sum(float(o['latitude']) for o in valid_outlets) / len(valid_outlets)
-                avg_lng = sum(float(o['longitude']) for o in valid_outlets) / len(valid_outlets)
-                center = [avg_lat, avg_lng]
-            else:
-                center = []
+            item = {"index": index, "result": await query_chatbot(request)}
+        except HTTPException as e:
+            item = {"index": index, "error": e.detail}
         except Exception as e:
-            print(f"计算地图中心点时出错: {e}")
-            center = []
-            
-        location_str = f" in {location}" if location else ""
-        
-        # 输出前几家店铺的名称，作为调试信息
-        if outlets and len(outlets) > 0:
-            sample_names = [o['name'] for o in outlets[:min(5, len(outlets))]]
-            print(f"示例店铺: {', '.join(sample_names)}")
-        
-        return {
-            "answer": f"I found {count} Subway outlets that close {full_time_query}{location_str} on {day_type}.",
-            "related_ids": ids,
-            "center": center
-        }
-    
-    # 处理特殊查询 - "closes earliest"或"earliest closing"
-    if "close earliest" in user_query.lower() or "earliest closing" in user_query.lower() or "close the earliest" in user_query.lower():
-        print("处理'最早关门'查询")
-        try:
-            # 检查是否指定了周末
-            is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-            # 检查是否指定了工作日
-            is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-            
-            # 如果没有明确指定，根据当前日期判断
-            if not is_weekend and not is_weekday:
-                today = datetime.now().weekday()
-                is_weekend = today >= 5  # 5和6分别是周六和周日
-            
-            outlets, earliest_close_time = find_earliest_closing_outlets(is_weekend)
-            if outlets and outlets[0]:
-                earliest_outlet = outlets[0]
-                hour = int(earliest_close_time[:2])
-                minute = int(earliest_close_time[2:]) if len(earliest_close_time) >= 4 else 0
-                time_str = f"{hour:02d}:{minute:02d}"
-                day_type = "weekend" if is_weekend else "weekday"
-                
-                outlet_count = len(outlets)
-                if outlet_count > 1:
-                    # 对名称进行去重
-                    unique_names = []
-                    seen_names = set()
-                    for o in outlets:
-                        if o['name'] not in seen_names:
-                            unique_names.append(o['name'])
-                            seen_names.add(o['name'])
-                    
-                    # 显示前三个不重复的名称
-                    outlet_names = ", ".join(unique_names[:3])
-                    if len(unique_names) > 3:
-                        outlet_names += f" and {len(unique_names)-3} other outlets"
-                
-                    return {
-                        "answer": f"{outlet_count} outlets close earliest on {day_type} at {time_str}. Including: {outlet_names}",
-                        "related_ids": [o['id'] for o in outlets],
-                        "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-                    }
-                else:
-                    return {
-                        "answer": f"{earliest_outlet['name']} closes earliest on {day_type} at {time_str}.",
-                        "related_ids": [earliest_outlet['id']],
-                        "center": [float(earliest_outlet['latitude']), float(earliest_outlet['longitude'])]
-                    }
-            else:
-                return {
-                    "answer": "I couldn't find information about the earliest closing outlets.",
-                    "related_ids": [],
-                    "center": []
-                }
+            print(f"⚠️ 批量聊天第 {index} 条失败: {e!r}")
+            item = {"index": index, "error": str(e)}
+        item["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return item
 
-            # 下方這段原始程式中的第二個 else，會導致語法錯誤，故以註釋方式保留：
-            # else:
-            #     return {"answer": "I couldn't find information about the earliest closing outlets.", "related_ids": [], "center": []}
 
-        except Exception as e:
-            print(f"查找最早关门店铺时出错: {e}")
-            return {"answer": "Sorry, there was a problem finding the earliest closing outlets.", "related_ids": [], "center": []}
-    
-    # 处理特殊查询 - "opens earliest"或"earliest opening"
-    elif "open earliest" in user_query.lower() or "earliest opening" in user_query.lower() or "open the earliest" in user_query.lower():
-        print("处理'最早开门'查询")
-        # 检查是否指定了周末
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        # 检查是否指定了工作日
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        # 如果没有明确指定，根据当前日期判断
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5  # 5和6分别是周六和周日
-        
-        outlets, time = find_earliest_opening_outlets(is_weekend)
-        if not outlets:
-            return {"answer": "I couldn't find information about the earliest opening outlets.", "related_ids": [], "center": []}
-        
-        hour = int(time[:2])
-        minute = int(time[2:]) if len(time) >= 4 else 0
-        time_str = f"{hour:02d}:{minute:02d}"
-        day_type = "weekend" if is_weekend else "weekday"
-        
-        outlet_count = len(outlets)
-        if outlet_count > 1:
-            # 对名称进行去重
-            unique_names = []
-            seen_names = set()
-            for o in outlets:
-                if o['name'] not in seen_names:
-                    unique_names.append(o['name'])
-                    seen_names.add(o['name'])
-            
-            # 显示前三个不重复的名称
-            outlet_names = ", ".join(unique_names[:3])
-            if len(unique_names) > 3:
-                outlet_names += f" and {len(unique_names)-3} other outlets"
-            
-            return {
-                "answer": f"{outlet_count} outlets open earliest on {day_type} at {time_str}. Including: {outlet_names}",
-                "related_ids": [o['id'] for o in outlets],
-                "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-            }
-        else:
-            outlet = outlets[0]
-            return {
-                "answer": f"{outlet['name']} opens earliest on {day_type} at {time_str}.",
-                "related_ids": [outlet['id']],
-                "center": [float(outlet['latitude']), float(outlet['longitude'])]
-            }
-    
-    # 处理特殊查询 - "closes latest"或"latest closing"
-    elif "close latest" in user_query.lower() or "latest closing" in user_query.lower() or "close the latest" in user_query.lower():
-        print("处理'最晚关门'查询")
-        # 检查是否指定了周末
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        # 检查是否指定了工作日
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        # 如果没有明确指定，根据当前日期判断
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5  # 5和6分别是周六和周日
-        
-        outlets, time = find_latest_closing_outlets(is_weekend)
-        if not outlets:
-            return {"answer": "I couldn't find information about the latest closing outlets.", "related_ids": [], "center": []}
-        
-        hour = int(time[:2])
-        if hour >= 24:
-            hour -= 24
-        minute = int(time[2:]) if len(time) >= 4 else 0
-        time_str = f"{hour:02d}:{minute:02d}"
-        day_type = "weekend" if is_weekend else "weekday"
-        
-        outlet_count = len(outlets)
-        if outlet_count > 1:
-            # 对名称进行去重
-            unique_names = []
-            seen_names = set()
-            for o in outlets:
-                if o['name'] not in seen_names:
-                    unique_names.append(o['name'])
-                    seen_names.add(o['name'])
-            
-            # 显示前三个不重复的名称
-            outlet_names = ", ".join(unique_names[:3])
-            if len(unique_names) > 3:
-                outlet_names += f" and {len(unique_names)-3} other outlets"
-            
-            return {
-                "answer": f"{outlet_count} outlets close latest on {day_type} at {time_str}. Including: {outlet_names}",
-                "related_ids": [o['id'] for o in outlets],
-                "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-            }
-        else:
-            outlet = outlets[0]
-            return {
-                "answer": f"{outlet['name']} closes latest on {day_type} at {time_str}.",
-                "related_ids": [outlet['id']],
-                "center": [float(outlet['latitude']), float(outlet['longitude'])]
-            }
-    
-    # 添加新的查询类型 - "opens latest"或"latest opening"
-    elif "open latest" in user_query.lower() or "latest opening" in user_query.lower() or "open the latest" in user_query.lower():
-        print("处理'最晚开门'查询")
-        # 检查是否指定了周末
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        # 检查是否指定了工作日
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        # 如果没有明确指定，根据当前日期判断
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5  # 5和6分别是周六和周日
-        
-        outlets, time = find_latest_opening_outlets(is_weekend)
-        if not outlets:
-            return {"answer": "I couldn't find information about the latest opening outlets.", "related_ids": [], "center": []}
-        
-        hour = int(time[:2])
-        minute = int(time[2:]) if len(time) >= 4 else 0
-        time_str = f"{hour:02d}:{minute:02d}"
-        day_type = "weekend" if is_weekend else "weekday"
-        
-        outlet_count = len(outlets)
-        if outlet_count > 1:
-            # 对名称进行去重
-            unique_names = []
-            seen_names = set()
-            for o in outlets:
-                if o['name'] not in seen_names:
-                    unique_names.append(o['name'])
-                    seen_names.add(o['name'])
-            
-            # 显示前三个不重复的名称
-            outlet_names = ", ".join(unique_names[:3])
-            if len(unique_names) > 3:
-                outlet_names += f" and {len(unique_names)-3} other outlets"
-            
-            return {
-                "answer": f"{outlet_count} outlets open latest on {day_type} at {time_str}. Including: {outlet_names}",
-                "related_ids": [o['id'] for o in outlets],
-                "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-            }
-        else:
-            outlet = outlets[0]
-            return {
-                "answer": f"{outlet['name']} opens latest on {day_type} at {time_str}.",
-                "related_ids": [outlet['id']],
-                "center": [float(outlet['latitude']), float(outlet['longitude'])]
-            }
-    
-    # 使用AI处理查询
-    ai_result = process_with_ai(user_query)
-    print(f"AI结果: {ai_result}")
-    
-    # 根据AI返回的action类型执行不同操作
-    action = ai_result.get("action", "")
-    
-    if action == "search_location":
-        location = ai_result.get("location", "")
-        if not location:
-            return {"answer": "I need a location to search for outlets.", "related_ids": [], "center": []}
-        
-        outlets = find_outlets_by_location(location)
-        if not outlets:
-            return {"answer": f"I couldn't find any Subway outlets in {location}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-            avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-            center = [avg_lat, avg_lng]
-        except:
-            center = []
-        
-        return {
-            "answer": f"I found {count} Subway outlets in or near {location.title()}.",
-            "related_ids": ids,
-            "center": center
-        }
-    
-    elif action == "get_nearest":
-        location = ai_result.get("location", "")
-        
-        # 如果用户提供了位置，优先使用用户位置
-        if user_lat and user_lon:
-            nearest_outlets = get_nearest_outlets(user_lat, user_lon)
-            if not nearest_outlets:
-                return {"answer": "I couldn't find any nearby Subway outlets.", "related_ids": [], "center": []}
-            
-            ids = [o['id'] for o in nearest_outlets]
-            distances = [f"{o['name']}: {o['distance']:.1f}km" for o in nearest_outlets]
-            
-            answer = f"Here are the nearest Subway outlets to your location:\n" + "\n".join(distances[:3])
-            return {"answer": answer, "related_ids": ids, "center": [user_lat, user_lon]}
-        
-        # 否则使用地点名查询
-        elif location:
-            loc_lat, loc_lon = get_location_coordinates(location)
-            if not loc_lat or not loc_lon:
-                return {"answer": f"I couldn't determine the location of {location}.", "related_ids": [], "center": []}
-            
-            nearest_outlets = get_nearest_outlets(loc_lat, loc_lon)
-            if not nearest_outlets:
-                return {"answer": f"I couldn't find any Subway outlets near {location}.", "related_ids": [], "center": []}
-            
-            ids = [o['id'] for o in nearest_outlets]
-            return {"answer": ai_result.get("answer"), "related_ids": ids, "center": [loc_lat, loc_lon]}
-        
-        return {"answer": "I need a location to find nearby outlets.", "related_ids": [], "center": []}
-    
-    elif action == "opening_time_query":
-        # 处理特定开店时间查询
-        time_query = ai_result.get("time", "")
-        location = ai_result.get("location", "")
-        
-        if not time_query:
-            return {"answer": "I need a time to search for outlets.", "related_ids": [], "center": []}
-            
-        # 检查是否指定了周末或工作日
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5
-            
-        if location:
-            # 特定地区特定时间开店的门店
-            outlets = find_outlets_compound(location, time_query)
-        else:
-            # 所有特定时间开店的门店
-            outlets = find_outlets_by_opening_time(time_query, is_weekend)
-            
-        day_type = "weekend" if is_weekend else "weekday"
-        if not outlets:
-            location_str = f" in {location}" if location else ""
-            return {"answer": f"I couldn't find any Subway outlets that open {time_query}{location_str} on {day_type}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-            avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-            center = [avg_lat, avg_lng]
-        except:
-            center = []
-            
-        location_str = f" in {location}" if location else ""
-        return {
-            "answer": f"I found {count} Subway outlets that open {time_query}{location_str} on {day_type}.",
-            "related_ids": ids,
-            "center": center
-        }
-        
-    elif action == "closing_time_query":
-        # 处理特定关店时间查询
-        time_query = ai_result.get("time", "")
-        location = ai_result.get("location", "")
-        
-        if not time_query:
-            return {"answer": "I need a time to search for outlets.", "related_ids": [], "center": []}
-            
-        # 检查是否指定了周末或工作日
-        is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-        is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-        
-        if not is_weekend and not is_weekday:
-            today = datetime.now().weekday()
-            is_weekend = today >= 5
-            
-        if location:
-            # 特定地区特定时间关店的门店
-            outlets = find_outlets_compound(location, time_query)
-        else:
-            # 所有特定时间关店的门店
-            outlets = find_outlets_by_closing_time(time_query, is_weekend)
-            
-        day_type = "weekend" if is_weekend else "weekday"
-        if not outlets:
-            location_str = f" in {location}" if location else ""
-            return {"answer": f"I couldn't find any Subway outlets that close {time_query}{location_str} on {day_type}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-            avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-            center = [avg_lat, avg_lng]
-        except:
-            center = []
-            
-        location_str = f" in {location}" if location else ""
-        return {
-            "answer": f"I found {count} Subway outlets that close {time_query}{location_str} on {day_type}.",
-            "related_ids": ids,
-            "center": center
-        }
-    
-    elif action == "time_query":
-        location = ai_result.get("location", "")
-        time = ai_result.get("time", "")
-        
-        if not location or not time:
-            return {"answer": "I need both a location and time to search.", "related_ids": [], "center": []}
-        
-        outlets = find_outlets_compound(location, time)
-        if not outlets:
-            return {"answer": f"I couldn't find any Subway outlets in {location} open at {time}.", "related_ids": [], "center": []}
-        
-        count = len(outlets)
-        ids = [o['id'] for o in outlets]
-        
-        # 计算地图中心点
-        try:
-            avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-            avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-            center = [avg_lat, avg_lng]
-        except:
-            center = []
-            
-        return {
-            "answer": f"I found {count} Subway outlets in {location} open at {time}.",
-            "related_ids": ids,
-            "center": center
-        }
-    
-    elif action == "get_attribute":
-        attribute = ai_result.get("attribute", "")
-        
-        if attribute == "latest_closing":
-            # 检查是否指定了周末或工作日
-            is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-            is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-            
-            # 如果没有明确指定，根据当前日期判断
-            if not is_weekend and not is_weekday:
-                today = datetime.now().weekday()
-                is_weekend = today >= 5  # 5和6分别是周六和周日
-                
-            outlets, time = find_latest_closing_outlets(is_weekend)
-            if not outlets:
-                return {"answer": "I couldn't determine which outlet closes the latest.", "related_ids": [], "center": []}
-            
-            hour = int(time[:2])
-            if hour >= 24:
-                hour -= 24
-            minute = int(time[2:]) if len(time) >= 4 else 0
-            time_str = f"{hour:02d}:{minute:02d}"
-            
-            day_type = "weekend" if is_weekend else "weekday"
-            
-            outlet_count = len(outlets)
-            if outlet_count > 1:
-                # 对名称进行去重
-                unique_names = []
-                seen_names = set()
-                for o in outlets:
-                    if o['name'] not in seen_names:
-                        unique_names.append(o['name'])
-                        seen_names.add(o['name'])
-                
-                # 显示前三个不重复的名称
-                outlet_names = ", ".join(unique_names[:3])
-                if len(unique_names) > 3:
-                    outlet_names += f" and {len(unique_names)-3} other outlets"
-                
-                return {
-                    "answer": f"{outlet_count} outlets close latest on {day_type} at {time_str}. Including: {outlet_names}",
-                    "related_ids": [o['id'] for o in outlets],
-                    "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-                }
-            else:
-                outlet = outlets[0]
-                return {
-                    "answer": f"{outlet['name']} closes latest on {day_type} at {time_str}.",
-                    "related_ids": [outlet['id']],
-                    "center": [float(outlet['latitude']), float(outlet['longitude'])]
-                }
-        
-        elif attribute == "earliest_closing":
-            # 检查是否指定了周末或工作日
-            is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-            is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-            
-            # 如果没有明确指定，根据当前日期判断
-            if not is_weekend and not is_weekday:
-                today = datetime.now().weekday()
-                is_weekend = today >= 5  # 5和6分别是周六和周日
-                
-            outlets, time = find_earliest_closing_outlets(is_weekend)
-            if not outlets or not outlets[0]:
-                return {"answer": "I couldn't determine which outlet closes the earliest.", "related_ids": [], "center": []}
-            
-            hour = int(time[:2])
-            minute = int(time[2:]) if len(time) >= 4 else 0
-            time_str = f"{hour:02d}:{minute:02d}"
-            
-            day_type = "weekend" if is_weekend else "weekday"
-            
-            outlet_count = len(outlets)
-            if outlet_count > 1:
-                # 对名称进行去重
-                unique_names = []
-                seen_names = set()
-                for o in outlets:
-                    if o['name'] not in seen_names:
-                        unique_names.append(o['name'])
-                        seen_names.add(o['name'])
-                
-                # 显示前三个不重复的名称
-                outlet_names = ", ".join(unique_names[:3])
-                if len(unique_names) > 3:
-                    outlet_names += f" and {len(unique_names)-3} other outlets"
-                
-                return {
-                    "answer": f"{outlet_count} outlets close earliest on {day_type} at {time_str}. Including: {outlet_names}",
-                    "related_ids": [o['id'] for o in outlets],
-                    "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-                }
-            else:
-                outlet = outlets[0]
-                return {
-                    "answer": f"{outlet['name']} closes earliest on {day_type} at {time_str}.",
-                    "related_ids": [outlet['id']],
-                    "center": [float(outlet['latitude']), float(outlet['longitude'])]
-                }
+@app.post("/chatbot/batch")
+async def query_chatbot_batch(batch: ChatBatchRequest):
+    """一次提交多条聊天问题，按提交顺序返回结果
 
-        elif attribute == "latest_opening":
-            # 检查是否指定了周末或工作日
-            is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-            is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-            
-            # 如果没有明确指定，根据当前日期判断
-            if not is_weekend and not is_weekday:
-                today = datetime.now().weekday()
-                is_weekend = today >= 5  # 5和6分别是周六和周日
-                
-            outlets, time = find_latest_opening_outlets(is_weekend)
-            if not outlets:
-                return {"answer": "I couldn't determine which outlet opens the latest.", "related_ids": [], "center": []}
-            
-            hour = int(time[:2])
-            minute = int(time[2:]) if len(time) >= 4 else 0
-            time_str = f"{hour:02d}:{minute:02d}"
-            
-            day_type = "weekend" if is_weekend else "weekday"
-            
-            outlet_count = len(outlets)
-            if outlet_count > 1:
-                # 对名称进行去重
-                unique_names = []
-                seen_names = set()
-                for o in outlets:
-                    if o['name'] not in seen_names:
-                        unique_names.append(o['name'])
-                        seen_names.add(o['name'])
-                
-                # 显示前三个不重复的名称
-                outlet_names = ", ".join(unique_names[:3])
-                if len(unique_names) > 3:
-                    outlet_names += f" and {len(unique_names)-3} other outlets"
-                
-                return {
-                    "answer": f"{outlet_count} outlets open latest on {day_type} at {time_str}. Including: {outlet_names}",
-                    "related_ids": [o['id'] for o in outlets],
-                    "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-                }
-            else:
-                outlet = outlets[0]
-                return {
-                    "answer": f"{outlet['name']} opens latest on {day_type} at {time_str}.",
-                    "related_ids": [outlet['id']],
-                    "center": [float(outlet['latitude']), float(outlet['longitude'])]
-                }
-            
-        elif attribute == "earliest_opening":
-            # 检查是否指定了周末或工作日
-            is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
-            is_weekday = "weekday" in user_query.lower() or "工作日" in user_query.lower() or "weekdays" in user_query.lower()
-            
-            # 如果没有明确指定，根据当前日期判断
-            if not is_weekend and not is_weekday:
-                today = datetime.now().weekday()
-                is_weekend = today >= 5  # 5和6分别是周六和周日
-                
-            outlets, time = find_earliest_opening_outlets(is_weekend)
-            if not outlets:
-                return {"answer": "I couldn't determine which outlet opens the earliest.", "related_ids": [], "center": []}
-            
-            hour = int(time[:2])
-            minute = int(time[2:]) if len(time) >= 4 else 0
-            time_str = f"{hour:02d}:{minute:02d}"
-            
-            day_type = "weekend" if is_weekend else "weekday"
-            
-            outlet_count = len(outlets)
-            if outlet_count > 1:
-                # 对名称进行去重
-                unique_names = []
-                seen_names = set()
-                for o in outlets:
-                    if o['name'] not in seen_names:
-                        unique_names.append(o['name'])
-                        seen_names.add(o['name'])
-                
-                # 显示前三个不重复的名称
-                outlet_names = ", ".join(unique_names[:3])
-                if len(unique_names) > 3:
-                    outlet_names += f" and {len(unique_names)-3} other outlets"
-                
-                return {
-                    "answer": f"{outlet_count} outlets open earliest on {day_type} at {time_str}. Including: {outlet_names}",
-                    "related_ids": [o['id'] for o in outlets],
-                    "center": [float(outlets[0]['latitude']), float(outlets[0]['longitude'])]
-                }
-            else:
-                outlet = outlets[0]
-                return {
-                    "answer": f"{outlet['name']} opens earliest on {day_type} at {time_str}.",
-                    "related_ids": [outlet['id']],
-                    "center": [float(outlet['latitude']), float(outlet['longitude'])]
-                }
-            
-        elif attribute == "24hours":
-            outlets = find_24hour_outlets()
-            if not outlets:
-                return {"answer": "I couldn't find any 24-hour Subway outlets.", "related_ids": [], "center": []}
-            
-            count = len(outlets)
-            ids = [o['id'] for o in outlets]
-            
-            # 计算地图中心点
-            try:
-                avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-                avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-                center = [avg_lat, avg_lng]
-            except:
-                center = []
-                
-            return {
-                "answer": f"I found {count} Subway outlets that are open 24 hours.",
-                "related_ids": ids,
-                "center": center
-            }
-    
-    # 默认回复
+    各条并发处理（共用意图缓存和并发合并），全部条目基于同一个门店快照，
+    期间快照刷新也不会让同一批结果前后不一致。每条结果附带处理耗时。
+    """
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(CHATBOT_BATCH_CONCURRENCY)
+    with outlet_store.pinned() as snapshot:
+        items = await asyncio.gather(*(
+            _answer_batch_item(n, request, semaphore) for n, request in enumerate(batch.queries)))
     return {
-        "answer": ai_result.get("answer", "I'm not sure how to help with that query."),
-        "related_ids": [],
-        "center": []
+        "snapshot_version": snapshot.version,
+        "results": items,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
     }
 
 # === 其他API端点 ===
 
 @app.get("/api/outlets/search")
-def search_outlets(query: str, time: Optional[str] = None):
+@etag_scope(now_or_date)
+@fast_json_response
+def search_outlets(query: str, time: Optional[str] = None, page: Page = Depends()):
     """综合搜索API - 支持位置、时间或两者的组合"""
     outlets = []
     
+    # 分页时按 ID 遍历全部匹配，不截取相关度最高的前 LOCATION_RESULT_LIMIT 家
+    limit = None if page.requested else LOCATION_RESULT_LIMIT
     if time:
         # 复合查询
-        outlets = find_outlets_compound(query, time)
+        outlets = find_outlets_compound(query, time, location_limit=limit)
     else:
         # 仅位置查询
-        outlets = find_outlets_by_location(query)
+        outlets = find_outlets_by_location(query, limit)
     
     if not outlets:
-        return {"message": f"No outlets found for query: {query}", "outlets": []}
+        return page.apply({"message": f"No outlets found for query: {query}", "outlets": []})
     
-    return {"message": f"Found {len(outlets)} outlets", "outlets": outlets}
+    return page.apply({"message": f"Found {len(outlets)} outlets", "outlets": outlets})
 
 @app.get("/api/outlets/open-now")
-def currently_open_outlets(location: Optional[str] = None):
+@etag_scope("minute")
+@fast_json_response
+def currently_open_outlets(location: Optional[str] = None, page: Page = Depends()):
     """获取当前营业的店铺"""
     now = datetime.now()
     time_str = f"{now.hour:02d}:{now.minute:02d}"
@@ -2992,12 +1476,8 @@ def currently_open_outlets(location: Optional[str] = None):
     # 打印当前时间，帮助调试
     print(f"当前时间: {time_str}")
     
-    if location:
-        # 特定地区当前营业的店铺
-        outlets = find_outlets_compound(location, "now")
-    else:
-        # 所有当前营业的店铺
-        outlets = find_outlets_by_time("now")
+    # 特定地区或所有当前营业的店铺
+    outlets = find_open_now_outlets(location, location_limit=None if page.requested else LOCATION_RESULT_LIMIT)
     
     if not outlets:
         # 如果没有结果，尝试查询营业至晚上的店铺
@@ -3008,11 +1488,13 @@ def currently_open_outlets(location: Optional[str] = None):
             outlets = find_outlets_by_time("after 18")  # 假设晚上6点后开门
     
     if not outlets:
-        return {"message": "No outlets currently open", "outlets": []}
+        return page.apply({"message": "No outlets currently open", "outlets": []})
     
-    return {"message": f"Found {len(outlets)} open outlets", "outlets": outlets}
+    return page.apply({"message": f"Found {len(outlets)} open outlets", "outlets": outlets})
 
 @app.get("/api/outlets/earliest")
+@etag_scope("static")
+@fast_json_response
 def earliest_opening_outlets():
     """获取最早开门的店铺"""
     outlets, time = find_earliest_opening_outlets()
@@ -3031,6 +1513,8 @@ def earliest_opening_outlets():
     }
 
 @app.get("/api/outlets/latest")
+@etag_scope("static")
+@fast_json_response
 def latest_closing_outlets():
     """获取最晚关门的店铺"""
     outlets, time = find_latest_closing_outlets()
@@ -3052,6 +1536,8 @@ def latest_closing_outlets():
     }
 
 @app.get("/api/outlets/24hours")
+@etag_scope("static")
+@fast_json_response
 def hours24_outlets():
     """获取24小时营业的店铺"""
     outlets = find_24hour_outlets()
@@ -3064,9 +1550,90 @@ def hours24_outlets():
         "outlets": outlets
     } 
 
+@app.get("/api/outlets/coverage")
+@etag_scope("static")
+@fast_json_response
+def outlet_coverage(radius_km: Optional[float] = Query(None, gt=0, le=50)):
+    """店铺覆盖范围相交图：每家店相交的店铺数量、相交店铺 ID 以及连通的店铺簇
+
+    参数:
+        radius_km: 两家店距离不超过该值（公里）即视为覆盖相交，默认 COVERAGE_RADIUS_KM
+    """
+    snapshot = outlet_store.snapshot()
+    coverage = snapshot.coverage_for(radius_km or COVERAGE_RADIUS_KM)
+    
+    # 簇按大小降序编号
+    cluster_ids = {}
+    clusters = []
+    for number, members in enumerate(coverage.clusters):
+        for i in members:
+            cluster_ids[i] = number
+        clusters.append({
+            "cluster": number,
+            "size": len(members),
+            "outlet_ids": [snapshot.outlets[i]['id'] for i in members]
+        })
+    
+    outlets = []
+    for i, neighbors in enumerate(coverage.neighbors):
+        if i not in cluster_ids:
+            continue  # 没有坐标的店铺
+        outlet = snapshot.outlets[i]
+        outlets.append({
+            "id": outlet['id'],
+            "name": outlet.get('name'),
+            "latitude": outlet.get('latitude'),
+            "longitude": outlet.get('longitude'),
+            "overlap_count": len(neighbors),
+            "overlap_ids": [snapshot.outlets[j]['id'] for j in neighbors],
+            "cluster": cluster_ids[i]
+        })
+    
+    return {
+        "radius_km": coverage.radius_km,
+        "version": snapshot.version,
+        "pair_count": coverage.edge_count(),
+        "cluster_count": len(clusters),
+        "outlets": outlets,
+        "clusters": clusters
+    }
+
+@app.get("/api/outlets/nearest")
+@etag_scope(now_or_date)
+@fast_json_response
+def nearest_outlets_api(
+    lat: float,
+    lon: float,
+    limit: int = Query(5, ge=1, le=100),
+    radius_km: Optional[float] = Query(None, gt=0),
+    open_now: bool = False,
+    is_weekend: Optional[bool] = None
+):
+    """获取离指定坐标最近的店铺
+
+    参数:
+        lat, lon: 中心坐标
+        limit: 最多返回的店铺数
+        radius_km: 只返回该半径（公里）内的店铺
+        open_now: 是否只返回当前营业的店铺
+        is_weekend: 是否按周末营业时间判断，默认根据当前日期判断
+    """
+    outlets = get_nearest_outlets(lat, lon, limit, radius_km=radius_km, open_now=open_now, is_weekend=is_weekend)
+    
+    if not outlets:
+        return {"message": "No outlets found near the given location", "outlets": []}
+    
+    return {
+        "message": f"Found {len(outlets)} nearest outlets",
+        "center": [lat, lon],
+        "outlets": outlets
+    }
+
 # 添加这些API端点在文件末尾
 
 @app.get("/api/outlets/earliest-opening")
+@etag_scope("date")
+@fast_json_response
 def earliest_opening_outlets_api(is_weekend: Optional[bool] = None):
     """获取最早开门的店铺
     
@@ -3096,6 +1663,8 @@ def earliest_opening_outlets_api(is_weekend: Optional[bool] = None):
     }
 
 @app.get("/api/outlets/latest-opening")
+@etag_scope("date")
+@fast_json_response
 def latest_opening_outlets_api(is_weekend: Optional[bool] = None):
     """获取最晚开门的店铺
     
@@ -3125,6 +1694,8 @@ def latest_opening_outlets_api(is_weekend: Optional[bool] = None):
     }
 
 @app.get("/api/outlets/earliest-closing")
+@etag_scope("date")
+@fast_json_response
 def earliest_closing_outlets_api(is_weekend: Optional[bool] = None):
     """获取最早关门的店铺
     
@@ -3154,6 +1725,8 @@ def earliest_closing_outlets_api(is_weekend: Optional[bool] = None):
     }
 
 @app.get("/api/outlets/latest-closing")
+@etag_scope("date")
+@fast_json_response
 def latest_closing_outlets_api(is_weekend: Optional[bool] = None):
     """获取最晚关门的店铺
     
@@ -3186,7 +1759,9 @@ def latest_closing_outlets_api(is_weekend: Optional[bool] = None):
     }
 
 @app.get("/api/outlets/by-opening-time")
-def outlets_by_opening_time(time: str, is_weekend: Optional[bool] = None):
+@etag_scope(now_or_date)
+@fast_json_response
+def outlets_by_opening_time(time: str, is_weekend: Optional[bool] = None, page: Page = Depends()):
     """获取特定时间开门的店铺
     
     参数:
@@ -3202,17 +1777,19 @@ def outlets_by_opening_time(time: str, is_weekend: Optional[bool] = None):
     day_type = "weekend" if is_weekend else "weekday"
     
     if not outlets:
-        return {"message": f"No outlets found that open {time} on {day_type}", "outlets": []}
+        return page.apply({"message": f"No outlets found that open {time} on {day_type}", "outlets": []})
     
-    return {
+    return page.apply({
         "message": f"Found {len(outlets)} outlets that open {time} on {day_type}",
         "day_type": day_type,
         "time_query": time,
         "outlets": outlets
-    }
+    })
 
 @app.get("/api/outlets/by-closing-time")
-def outlets_by_closing_time(time: str, is_weekend: Optional[bool] = None):
+@etag_scope(now_or_date)
+@fast_json_response
+def outlets_by_closing_time(time: str, is_weekend: Optional[bool] = None, page: Page = Depends()):
     """获取特定时间关门的店铺
     
     参数:
@@ -3228,17 +1805,20 @@ def outlets_by_closing_time(time: str, is_weekend: Optional[bool] = None):
     day_type = "weekend" if is_weekend else "weekday"
     
     if not outlets:
-        return {"message": f"No outlets found that close {time} on {day_type}", "outlets": []}
+        return page.apply({"message": f"No outlets found that close {time} on {day_type}", "outlets": []})
     
-    return {
+    return page.apply({
         "message": f"Found {len(outlets)} outlets that close {time} on {day_type}",
         "day_type": day_type,
         "time_query": time,
         "outlets": outlets
-    }
+    })
 
 @app.get("/api/outlets/open-at-time")
-def outlets_open_at_time(time: str, location: Optional[str] = None, is_weekend: Optional[bool] = None):
+@etag_scope(now_or_date)
+@fast_json_response
+def outlets_open_at_time(time: str, location: Optional[str] = None, is_weekend: Optional[bool] = None,
+                         page: Page = Depends()):
     """获取特定时间点营业的店铺
     
     参数:
@@ -3251,7 +1831,8 @@ def outlets_open_at_time(time: str, location: Optional[str] = None, is_weekend:
         is_weekend = today >= 5
     
     if location:
-        outlets = find_outlets_compound(location, time, is_weekend=is_weekend)
+        outlets = find_outlets_compound(location, time, is_weekend=is_weekend,
+                                        location_limit=None if page.requested else LOCATION_RESULT_LIMIT)
     else:
         outlets = find_outlets_by_time(time, is_weekend=is_weekend)
     
@@ -3259,17 +1840,18 @@ def outlets_open_at_time(time: str, location: Optional[str] = None, is_weekend:
     location_str = f" in {location}" if location else ""
     
     if not outlets:
-        return {"message": f"No outlets found open at {time} on {day_type}{location_str}", "outlets": []}
+        return page.apply({"message": f"No outlets found open at {time} on {day_type}{location_str}", "outlets": []})
     
-    return {
+    return page.apply({
         "message": f"Found {len(outlets)} outlets open at {time} on {day_type}{location_str}",
         "day_type": day_type,
         "time_query": time,
         "location": location,
         "outlets": outlets
-    }
+    })
 
 @app.post("/chatbot/handle_current_time")
+@chatbot_flight.coalesce(_chat_request_key("/chatbot/handle_current_time"))
 async def handle_current_time_query(request: ChatRequest):
     """处理当前时间的查询"""
     user_query = request.query
@@ -3278,11 +1860,7 @@ async def handle_current_time_query(request: ChatRequest):
     now = datetime.now()
     
     # 检查是否指定了位置
-    location = None
-    for loc in ['bangsar', 'klcc', 'pj', 'petaling', 'subang', 'sunway', 'damansara', 'kl', 'shah alam']:
-        if loc in user_query.lower():
-            location = loc
-            break
+    location = outlet_store.snapshot().gazetteer.quick_location(user_query)
     
     # 检查是否指定了周末或工作日
     is_weekend = "weekend" in user_query.lower() or "周末" in user_query.lower()
@@ -3293,10 +1871,7 @@ async def handle_current_time_query(request: ChatRequest):
         today = now.weekday()
         is_weekend = today >= 5  # 5和6分别是周六和周日
     
-    if location:
-        outlets = find_outlets_compound(location, "now", is_weekend=is_weekend)
-    else:
-        outlets = find_outlets_by_time("now", is_weekend=is_weekend)
+    outlets = find_open_now_outlets(location, is_weekend=is_weekend)
     
     if not outlets:
         # 如果没有结果，尝试查询当天营业的店铺
@@ -3311,18 +1886,10 @@ async def handle_current_time_query(request: ChatRequest):
                     day = weekday
                     break
         
-        conn = connect_db()
-        try:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(f"""
-                    SELECT * FROM subway_outlets 
-                    WHERE is_24hours = true 
-                    OR operating_hours ILIKE '%24 hours%'
-                    OR opening_hours->'{day}' IS NOT NULL
-                """)
-                outlets = [dict(r) for r in cur.fetchall()]
-        finally:
-            conn.close()
+        outlets = [dict(o) for o in outlet_store.snapshot().outlets
+                   if o.get('is_24hours')
+                   or '24 hours' in (o.get('operating_hours') or '').lower()
+                   or day in (o.get('opening_hours') or {})]
 
     if outlets:
         count = len(outlets)
@@ -3349,6 +1916,7 @@ async def handle_current_time_query(request: ChatRequest):
         return {"answer": f"I couldn't find any Subway outlets currently open on {day_type}{location_str}.", "related_ids": [], "center": []}
     
 @app.post("/api/outlets/compound_search")
+@fast_json_response
 def compound_search_outlets(location_query: str, time_query: str, is_weekend: Optional[bool] = None):
     """Compound search - Process both location and time conditions
     
@@ -3400,6 +1968,7 @@ def compound_search_outlets(location_query: str, time_query: str, is_weekend: Op
     }
 
 @app.post("/chatbot/compound_query")
+@chatbot_flight.coalesce(_chat_request_key("/chatbot/compound_query"))
 async def handle_compound_query(request: ChatRequest):
     """Handle location+time compound queries
     
@@ -3411,7 +1980,7 @@ async def handle_compound_query(request: ChatRequest):
     print(f"处理复合查询: '{user_query}'")
     
     # Use process_with_ai to extract location and time information
-    ai_result = process_with_ai(user_query)
+    ai_result = await process_with_ai(user_query)
     location = ai_result.get("location")
     time_condition = ai_result.get("time")
     
@@ -3504,12 +2073,19 @@ async def handle_compound_query(request: ChatRequest):
         }
     
 @app.get("/api/outlets/special-time-in-location")
+@etag_scope(now_or_date)
+@fast_json_response
 def special_time_outlets_in_location(
     location: str, 
     attribute: str, 
     is_weekend: Optional[bool] = None
 ):
-    """查询特定地区的最早/最晚开门/关门店铺
+    """查询特定地区的最早/最晚开门/关门店铺"""
+    return find_special_time_outlets_in_location(location, attribute, is_weekend)
+
+
+def find_special_time_outlets_in_location(location, attribute, is_weekend=None):
+    """特定地区的最早/最晚开门/关门店铺（聊天处理器直接调用）
     
     Parameters:
         location: Location query string
@@ -3539,144 +2115,43 @@ def special_time_outlets_in_location(
     location_ids = [r['id'] for r in location_results]
     
     # 实现位置内的最早/最晚开关门店铺查询
-    conn = connect_db()
     try:
-        # 根据是否周末确定要检查的营业日
-        if is_weekend:
-            days = ["saturday", "sunday"]
-        else:
-            days = ["monday", "tuesday", "wednesday", "thursday", "friday"]
-        
-        # 根据属性确定时间字段和比较方式
-        if attribute == "earliest_opening":
-            time_field = "open"
-            best_time = "2400"  # 初始值设为最大，寻找最小值
-            compare_func = lambda x, y: x < y  # 比较函数：找最小值
-        elif attribute == "latest_opening":
-            time_field = "open"
-            best_time = "0000"  # 初始值设为最小，寻找最大值
-            compare_func = lambda x, y: x > y  # 比较函数：找最大值
-        elif attribute == "earliest_closing":
-            time_field = "close"
-            best_time = "2400"  # 初始值设为最大，寻找最小值
-            compare_func = lambda x, y: x < y  # 比较函数：找最小值
-        elif attribute == "latest_closing":
-            time_field = "close"
-            best_time = "0000"  # 初始值设为最小，寻找最大值
-            compare_func = lambda x, y: x > y  # 比较函数：找最大值
-        else:
+        snapshot = outlet_store.snapshot()
+        index = snapshot.time_index
+
+        # 根据属性选择索引上的聚合查询
+        aggregates = {
+            "earliest_opening": index.earliest_opening,
+            "latest_opening": index.latest_opening,
+            "earliest_closing": index.earliest_closing,  # 跨午夜关门的时段不参与
+            "latest_closing": index.latest_closing,  # 跨午夜的关门时间按 +24 小时比较
+        }
+        if attribute not in aggregates:
             return {
                 "message": f"Invalid attribute: {attribute}. Must be one of 'earliest_opening', 'latest_opening', 'earliest_closing', 'latest_closing'",
                 "count": 0,
                 "outlets": []
             }
         
-        # 查询位置内的所有店铺
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            location_ids_str = ", ".join([f"'{id}'" for id in location_ids])
-            cur.execute(f"""
-                SELECT * FROM subway_outlets
-                WHERE id IN ({location_ids_str})
-                AND opening_hours IS NOT NULL
-            """)
-            
-            rows = cur.fetchall()
-            if not rows:
-                return {
-                    "message": f"No outlets with opening hours found in {location}",
-                    "count": 0,
-                    "day_type": day_type,
-                    "location": location,
-                    "attribute": attribute,
-                    "outlets": []
-                }
-            
-            print(f"从 {location} 区域找到 {len(rows)} 家有营业时间的店铺")
-            
-            # 用于跟踪最佳结果
-            best_outlets = []
-            outlet_ids = set()
-            
-            # 遍历店铺找出符合条件的
-            for row in rows:
-                row_dict = dict(row)
-                hours = row_dict.get('opening_hours', {})
-                
-                # 跳过没有营业时间的店铺
-                if not hours:
-                    continue
-                
-                # 遍历指定的营业日
-                for day in days:
-                    if day not in hours or not hours[day] or time_field not in hours[day]:
-                        continue
-                    
-                    time_value = hours[day][time_field]
-                    if not time_value:
-                        continue
-                    
-                    # 特殊处理"latest_closing"，考虑跨午夜情况
-                    if attribute == "latest_closing" and 'open' in hours[day] and hours[day]['open'] > time_value:
-                        # 跨午夜情况：关门时间在次日，需要加24小时
-                        hour = int(time_value[:2]) + 24
-                        minute = int(time_value[2:]) if len(time_value) >= 4 else 0
-                        time_value = f"{hour:02d}{minute:02d}"
-                    
-                    # 跳过earliest_closing的跨午夜情况
-                    if attribute == "earliest_closing" and 'open' in hours[day] and hours[day]['open'] > time_value:
-                        continue
-                    
-                    print(f"店铺 {row_dict['name']} 在 {day} 的 {time_field} 时间: {time_value}")
-                    
-                    # 检查是否是最佳结果
-                    if compare_func(time_value, best_time):
-                        best_time = time_value
-                        best_outlets = [row_dict]
-                        outlet_ids = {row_dict['id']}
-                    elif time_value == best_time and row_dict['id'] not in outlet_ids:
-                        best_outlets.append(row_dict)
-                        outlet_ids.add(row_dict['id'])
-            
-            if not best_outlets:
-                attribute_display = {
-                    "earliest_opening": "open earliest",
-                    "latest_opening": "open latest",
-                    "earliest_closing": "close earliest",
-                    "latest_closing": "close latest"
-                }.get(attribute, attribute)
-                
-                return {
-                    "message": f"No outlets found in {location} that {attribute_display} on {day_type}",
-                    "count": 0,
-                    "day_type": day_type,
-                    "location": location,
-                    "attribute": attribute,
-                    "outlets": []
-                }
-            
-            # 格式化时间显示
-            if best_time:
-                hour = int(best_time[:2])
-                # 处理跨午夜情况
-                if attribute == "latest_closing" and hour >= 24:
-                    hour -= 24
-                minute = int(best_time[2:]) if len(best_time) >= 4 else 0
-                formatted_time = f"{hour:02d}:{minute:02d}"
-            else:
-                formatted_time = "N/A"
-            
-            # 准备返回数据
-            outlets = best_outlets
-            
-            # 计算地图中心
-            try:
-                count = len(outlets)
-                avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
-                avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
-                center = [avg_lat, avg_lng]
-            except:
-                center = []
-            
+        # 位置内有营业时间的店铺（快照下标）
+        candidates = {snapshot.index_of[i] for i in location_ids
+                      if i in snapshot.index_of and snapshot.by_id[i].get('opening_hours') is not None}
+        if not candidates:
+            return {
+                "message": f"No outlets with opening hours found in {location}",
+                "count": 0,
+                "day_type": day_type,
+                "location": location,
+                "attribute": attribute,
+                "outlets": []
+            }
+        
+        print(f"从 {location} 区域找到 {len(candidates)} 家有营业时间的店铺")
+        
+        matched, best_minutes = aggregates[attribute](days_for(is_weekend), candidates)
+        best_outlets = snapshot.rows_at(matched)
+        
+        if not best_outlets:
             attribute_display = {
                 "earliest_opening": "open earliest",
                 "latest_opening": "open latest",
@@ -3685,15 +2160,51 @@ def special_time_outlets_in_location(
             }.get(attribute, attribute)
             
             return {
-                "message": f"Found {len(outlets)} outlets in {location} that {attribute_display} at {formatted_time} on {day_type}",
-                "count": len(outlets),
+                "message": f"No outlets found in {location} that {attribute_display} on {day_type}",
+                "count": 0,
                 "day_type": day_type,
                 "location": location,
                 "attribute": attribute,
-                "time": formatted_time,
-                "center": center,
-                "outlets": outlets
+                "outlets": []
             }
+        
+        # 格式化时间显示（跨午夜的关门时间转换回当天钟点）
+        if best_minutes is not None:
+            if best_minutes >= MINUTES_PER_DAY:
+                best_minutes -= MINUTES_PER_DAY
+            formatted_time = f"{best_minutes // 60:02d}:{best_minutes % 60:02d}"
+        else:
+            formatted_time = "N/A"
+        
+        # 准备返回数据
+        outlets = best_outlets
+        
+        # 计算地图中心
+        try:
+            count = len(outlets)
+            avg_lat = sum(float(o['latitude']) for o in outlets if o.get('latitude'))/count
+            avg_lng = sum(float(o['longitude']) for o in outlets if o.get('longitude'))/count
+            center = [avg_lat, avg_lng]
+        except:
+            center = []
+        
+        attribute_display = {
+            "earliest_opening": "open earliest",
+            "latest_opening": "open latest",
+            "earliest_closing": "close earliest",
+            "latest_closing": "close latest"
+        }.get(attribute, attribute)
+        
+        return {
+            "message": f"Found {len(outlets)} outlets in {location} that {attribute_display} at {formatted_time} on {day_type}",
+            "count": len(outlets),
+            "day_type": day_type,
+            "location": location,
+            "attribute": attribute,
+            "time": formatted_time,
+            "center": center,
+            "outlets": outlets
+        }
     except Exception as e:
         print(f"Error in special_time_outlets_in_location: {e}")
         return {
@@ -3704,10 +2215,9 @@ def special_time_outlets_in_location(
             "attribute": attribute,
             "outlets": []
         }
-    finally:
-        conn.close()
     
 @app.post("/chatbot/special_time_in_location")
+@chatbot_flight.coalesce(_chat_request_key("/chatbot/special_time_in_location"))
 async def handle_special_time_in_location(request: ChatRequest):
     """Handle queries for earliest/latest opening/closing outlets in a specific location
     
@@ -3720,7 +2230,7 @@ async def handle_special_time_in_location(request: ChatRequest):
     print(f"处理特殊时间+位置查询: '{user_query}'")
     
     # Use process_with_ai to extract location and attribute information
-    ai_result = process_with_ai(user_query)
+    ai_result = await process_with_ai(user_query)
     location = ai_result.get("location")
     
     print(f"AI解析结果 - 位置: '{location}'")
@@ -3728,27 +2238,10 @@ async def handle_special_time_in_location(request: ChatRequest):
     # 如果AI未提取到位置，尝试从查询中直接提取
     if not location:
         print("⚠️ AI未能识别位置，尝试直接从查询中提取位置")
-        query_lower = user_query.lower()
-        conn = connect_db()
-        try:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                # 获取所有已知地区
-                cur.execute("""
-                    SELECT DISTINCT city 
-                    FROM subway_outlets 
-                    WHERE city IS NOT NULL AND city != ''
-                """)
-                all_areas = [row[0] for row in cur.fetchall() if row[0]]
-                
-                # 检查查询中是否包含这些地区
-                for area in all_areas:
-                    # 使用完整单词匹配，避免数字或部分字符被错误匹配为位置
-                    if re.search(r'\b' + re.escape(area.lower()) + r'\b', query_lower):
-                        location = area
-                        print(f"从查询中提取到位置: {location}")
-                        break
-        finally:
-            conn.close()
+        # 使用完整单词匹配，避免数字或部分字符被错误匹配为位置
+        location = outlet_store.snapshot().gazetteer.find_city(user_query)
+        if location:
+            print(f"从查询中提取到位置: {location}")
     
     # 检查是否能提取到位置信息
     if not location:
@@ -3822,8 +2315,8 @@ async def handle_special_time_in_location(request: ChatRequest):
     print(f"查询日期类型: {day_type}")
     
     # 调用更新后的API端点
-    print(f"调用special_time_outlets_in_location API - 位置: '{location}', 属性: '{attribute}', 周末: {is_weekend}")
-    result = special_time_outlets_in_location(
+    print(f"调用find_special_time_outlets_in_location - 位置: '{location}', 属性: '{attribute}', 周末: {is_weekend}")
+    result = find_special_time_outlets_in_location(
         location=location,
         attribute=attribute,
         is_weekend=is_weekend
@@ -0,0 +1,126 @@
+"""并发基准：聊天请求进行中时 /outlets 的延迟是否被拖慢
+
+先单独压测 /outlets 得到基线，再在持续发送 /chatbot/query 的同时重复压测，
+比较两轮的 p50/p95/p99。聊天处理器阻塞事件循环时，第二轮的 p99 会接近一次 LLM 调用的耗时。
+
+用法:
+    # 1. 启动一个模拟 OpenAI 的服务（每次调用固定延迟），并让 API 指向它
+    python benchmarks/bench_concurrency.py --serve-fake-openai 9100 --llm-delay 2
+    # （或 python benchmarks/fake_openai.py --port 9100 --delay 2）
+    OPENAI_API_KEY=test OPENAI_BASE_URL=http://127.0.0.1:9100/v1 uvicorn api:app --port 8000
+
+    # 2. 运行基准
+    python benchmarks/bench_concurrency.py --base-url http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from fake_openai import serve_fake_openai
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    pos = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[pos]
+
+
+def summarize(label, latencies, errors):
+    ms = [v * 1000 for v in latencies]
+    print(f"{label:<28} n={len(ms):<5} errors={errors:<4} p50={percentile(ms, 50):8.1f}ms  p95={percentile(ms, 95):8.1f}ms  "
+          f"p99={percentile(ms, 99):8.1f}ms  max={max(ms):8.1f}ms  mean={statistics.mean(ms):8.1f}ms")
+    return percentile(ms, 99)
+
+
+async def hit_outlets(client, total, concurrency):
+    """以固定并发请求 /outlets，返回 (每个请求的耗时（秒）, 失败/超时次数)，失败的请求也计入耗时"""
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await client.get("/outlets")
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def chat_load(client, concurrency, query, stop):
+    """持续发送聊天请求直到 stop 被设置，返回完成的请求数"""
+    done = 0
+
+    async def worker():
+        nonlocal done
+        while not stop.is_set():
+            try:
+                await client.post("/chatbot/query", json={"query": query}, timeout=120)
+                done += 1
+            except httpx.HTTPError:
+                pass
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return done
+
+
+async def run(args):
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        # 预热
+        await hit_outlets(client, 5, 1)
+
+        baseline, baseline_errors = await hit_outlets(client, args.requests, args.concurrency)
+
+        stop = asyncio.Event()
+        chat_task = asyncio.create_task(chat_load(client, args.chat_concurrency, args.query, stop))
+        await asyncio.sleep(args.warmup)  # 等聊天请求进入 LLM 调用
+        loaded, loaded_errors = await hit_outlets(client, args.requests, args.concurrency)
+        stop.set()
+        chat_done = await chat_task
+
+    print(f"/outlets x{args.requests} (并发 {args.concurrency})，聊天并发 {args.chat_concurrency}")
+    base_p99 = summarize("/outlets baseline", baseline, baseline_errors)
+    load_p99 = summarize("/outlets + chatbot in flight", loaded, loaded_errors)
+    print(f"chatbot requests completed: {chat_done}")
+    print(f"p99 ratio (loaded / baseline): {load_p99 / base_p99:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=200, help="每轮 /outlets 请求数")
+    parser.add_argument("--concurrency", type=int, default=10, help="/outlets 并发数")
+    parser.add_argument("--chat-concurrency", type=int, default=20, help="同时进行的聊天请求数")
+    parser.add_argument("--query", default="Which outlets in Bangsar have drive-thru?",
+                        help="要交给 LLM 的问题（本地解析器能直接回答的问题不会调用模型）")
+    parser.add_argument("--timeout", type=float, default=30, help="/outlets 单个请求的超时（秒）")
+    parser.add_argument("--warmup", type=float, default=0.5, help="开始聊天负载后等待的秒数")
+    parser.add_argument("--serve-fake-openai", type=int, metavar="PORT",
+                        help="只启动模拟 OpenAI 服务，不运行基准")
+    parser.add_argument("--llm-delay", type=float, default=2.0, help="模拟 OpenAI 服务的响应延迟（秒）")
+    args = parser.parse_args()
+
+    if args.serve_fake_openai:
+        server = serve_fake_openai(args.serve_fake_openai, args.llm_delay)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
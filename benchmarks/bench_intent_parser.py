@@ -0,0 +1,95 @@
+"""本地意图解析器基准：在标注语料上统计本地解析率、准确率和解析耗时
+
+语料每行一个 JSON：{"query": ..., "action": ..., "location"?: ..., "time"?: ..., "attribute"?: ...}，
+标注的是期望的意图（与 LLM 返回的 JSON 格式一致）。置信度达到阈值的查询由本地直接回答，
+其余交给 LLM；"误判"指本地直接回答了但与标注不一致。标注 "escalate": true 的查询带有本地规则
+处理不了的条件（例如 "near klcc open now"），必须交给 LLM，本地直接回答一律算误判。
+
+用法:
+    python benchmarks/bench_intent_parser.py
+    python benchmarks/bench_intent_parser.py --repeat 2000 --verbose
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gazetteer import Gazetteer  # noqa: E402
+from intent_parser import IntentParser, INTENT_PARSER_MIN_CONFIDENCE  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.jsonl")
+DEFAULT_CITIES = "Kuala Lumpur,Petaling Jaya,Shah Alam,Subang Jaya,Ampang"
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    pos = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[pos]
+
+
+def _norm(value):
+    return "".join(str(value).lower().split()) if value else ""
+
+
+def matches(intent, label):
+    """action 必须一致；标注中出现的 location/time/attribute 也必须一致（忽略大小写和空白）"""
+    if label.get("escalate") or intent.get("action", "") != label["action"]:
+        return False
+    return all(_norm(intent.get(field)) == _norm(label[field])
+               for field in ("location", "time", "attribute") if field in label)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--cities", default=DEFAULT_CITIES, help="快照中的城市（逗号分隔），用于构建地名词典")
+    parser.add_argument("--min-confidence", type=float, default=INTENT_PARSER_MIN_CONFIDENCE)
+    parser.add_argument("--repeat", type=int, default=500, help="测量耗时时每条查询重复解析的次数")
+    parser.add_argument("--verbose", action="store_true", help="打印每条误判和交给 LLM 的查询")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    outlets = [{"id": n, "city": city.strip()} for n, city in enumerate(args.cities.split(",")) if city.strip()]
+    gazetteer = Gazetteer(outlets)
+    intent_parser = IntentParser(min_confidence=args.min_confidence)
+
+    local = correct_local = wrong_local = escalated = 0
+    for label in corpus:
+        intent, confidence = intent_parser.parse(label["query"], gazetteer)
+        ok = matches(intent, label)
+        if confidence >= args.min_confidence:
+            local += 1
+            if ok:
+                correct_local += 1
+            else:
+                wrong_local += 1
+                if args.verbose:
+                    print(f"误判  ({confidence:.2f}) {label['query']!r}\n      得到 {intent}\n      期望 {label}")
+        else:
+            escalated += 1
+            if args.verbose:
+                print(f"LLM   ({confidence:.2f}) {label['query']!r} -> {intent.get('action')!r}")
+
+    per_query_us = []
+    for label in corpus:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            intent_parser.parse(label["query"], gazetteer)
+        per_query_us.append((time.perf_counter() - start) / args.repeat * 1e6)
+
+    total = len(corpus)
+    print(f"语料: {total} 条，置信度阈值 {args.min_confidence}")
+    print(f"本地解析: {local}/{total} ({local / total:.1%})，其中正确 {correct_local}，误判 {wrong_local}"
+          f"（本地准确率 {correct_local / local:.1%}）" if local else "本地解析: 0")
+    print(f"交给 LLM: {escalated}/{total} ({escalated / total:.1%})")
+    print(f"解析耗时: p50={percentile(per_query_us, 50):.1f}us  p99={percentile(per_query_us, 99):.1f}us  "
+          f"max={max(per_query_us):.1f}us  mean={statistics.mean(per_query_us):.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""序列化基准：/outlets 响应体的编码耗时
+
+比较三种方式编码 {"outlets": [...]}：
+  1. FastAPI 默认路径：jsonable_encoder + JSONResponse（json.dumps）
+  2. FastJSONResponse：orjson 直接编码行（Decimal/datetime 在 C 实现中转换）
+  3. 快照预编码：每行只编码一次，响应时只拼接片段
+
+行按 subway_outlets 表结构生成（DECIMAL 坐标、TIMESTAMP、JSONB 营业时间）。
+
+用法:
+    python benchmarks/bench_serialization.py
+    python benchmarks/bench_serialization.py --outlets 2000 --repeat 50
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from fast_json import FastJSONResponse  # noqa: E402
+from outlet_store import OutletSnapshot  # noqa: E402
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def make_rows(count, seed=1):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(1, count + 1):
+        opens, closes = rng.choice(["0700", "0800", "0900", "1000"]), rng.choice(["2100", "2200", "2300", "0100"])
+        rows.append({
+            "id": i,
+            "name": f"Subway Outlet {i}",
+            "address": f"{i}, Jalan Telawi {i % 9}, Bangsar, 59100 Kuala Lumpur",
+            "operating_hours": "Monday - Sunday, 8:00 AM - 10:00 PM",
+            "latitude": Decimal(f"{3.0 + rng.random() * 0.3:.6f}"),
+            "longitude": Decimal(f"{101.5 + rng.random() * 0.3:.6f}"),
+            "waze_link": f"https://waze.com/ul?q=subway-{i}",
+            "google_maps_link": f"https://maps.google.com/?q=subway-{i}",
+            "street_address": f"Jalan Telawi {i % 9}",
+            "district": "Bangsar",
+            "city": "Kuala Lumpur",
+            "postcode": "59100",
+            "postcode_int": 59100,
+            "opening_hours": {day: {"open": opens, "close": closes} for day in DAYS},
+            "is_24hours": i % 25 == 0,
+            "created_at": datetime.datetime(2025, 1, 1, 8, 30),
+            "updated_at": datetime.datetime(2025, 3, i % 28 + 1, 12, 0, 5),
+        })
+    return rows
+
+
+def measure(func, repeat):
+    func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--outlets", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    snapshot = OutletSnapshot(make_rows(args.outlets))
+    build_start = time.perf_counter()
+    snapshot.encoded_rows()
+    build_ms = (time.perf_counter() - build_start) * 1000
+
+    baseline = JSONResponse(jsonable_encoder({"outlets": snapshot.rows()})).body
+    fast = FastJSONResponse({"outlets": snapshot.rows()}).body
+    fragments = FastJSONResponse({"outlets": snapshot.encoded_rows()}).body
+    assert json.loads(baseline) == json.loads(fast) == json.loads(fragments), "三种方式的输出不一致"
+
+    cases = [
+        ("jsonable_encoder + JSONResponse", lambda: JSONResponse(jsonable_encoder({"outlets": snapshot.rows()}))),
+        ("FastJSONResponse(rows)", lambda: FastJSONResponse({"outlets": snapshot.rows()})),
+        ("FastJSONResponse(fragments)", lambda: FastJSONResponse({"outlets": snapshot.encoded_rows()})),
+    ]
+    print(f"{args.outlets} 家店铺，响应体 {len(baseline) / 1024:.0f} KB，预编码耗时 {build_ms:.2f}ms（每个快照一次）")
+    base = None
+    for label, func in cases:
+        ms = measure(func, args.repeat)
+        base = base or ms
+        print(f"  {label:<34} p50={ms:8.3f}ms  ({base / ms:5.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
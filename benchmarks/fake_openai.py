@@ -0,0 +1,143 @@
+"""模拟 OpenAI chat.completions 的本地服务，用于基准测试和故障演练
+
+每次调用固定延迟后返回一个 search_location 结果（stream=true 的请求则在延迟后逐词流式返回一段回答，
+词与词之间间隔 token_delay 秒）；可以按比例返回错误状态码，
+运行中可通过 POST /control 修改行为，例如模拟上游变慢或大量 500，观察超时、重试和熔断。
+
+用法:
+    python benchmarks/fake_openai.py --port 9100 --delay 1
+    OPENAI_API_KEY=test OPENAI_BASE_URL=http://127.0.0.1:9100/v1 uvicorn api:app --port 8000
+
+    # 让上游开始出错 / 变慢，再恢复
+    curl -XPOST localhost:9100/control -d '{"error_rate": 1.0, "status": 500}'
+    curl -XPOST localhost:9100/control -d '{"delay": 30}'
+    curl -XPOST localhost:9100/control -d '{"error_rate": 0, "delay": 1}'
+    curl localhost:8000/health
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """最小的 OpenAI chat.completions 兼容接口"""
+
+    settings = {"delay": 2.0, "token_delay": 0.05, "error_rate": 0.0, "status": 500}
+    streamed_answer = "Here are the Subway outlets I found for you, shown on the map."
+    counters = {"calls": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path.rstrip("/") == "/control":
+            self._control(body)
+            return
+
+        settings = dict(self.settings)
+        with self.lock:
+            self.counters["calls"] += 1
+        time.sleep(settings["delay"])
+        if random.random() < settings["error_rate"]:
+            with self.lock:
+                self.counters["errors"] += 1
+            self._send(settings["status"], {"error": {"message": "fake upstream error", "type": "server_error"}})
+            return
+
+        try:
+            stream = bool(json.loads(body or b"{}").get("stream"))
+        except json.JSONDecodeError:
+            stream = False
+        if stream:
+            self._stream(settings["token_delay"])
+            return
+
+        content = json.dumps({"answer": "Let me find Subway outlets in Bangsar.",
+                              "action": "search_location", "location": "Bangsar"})
+        self._send(200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-3.5-turbo",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    def _stream(self, token_delay):
+        """按 OpenAI 流式格式逐词返回 streamed_answer"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = self.streamed_answer.split(" ")
+        for n, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "gpt-3.5-turbo",
+                "choices": [{"index": 0, "finish_reason": None,
+                             "delta": {"content": word if n == 0 else " " + word}}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_GET(self):
+        with self.lock:
+            self._send(200, {"settings": self.settings, "counters": self.counters})
+
+    def _control(self, body):
+        try:
+            updates = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            self._send(400, {"error": "invalid JSON"})
+            return
+        with self.lock:
+            for key in self.settings:
+                if key in updates:
+                    self.settings[key] = type(self.settings[key])(updates[key])
+            self._send(200, {"settings": self.settings})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_fake_openai(port, delay, error_rate=0.0, status=500):
+    FakeOpenAIHandler.settings.update(delay=delay, error_rate=error_rate, status=status)
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    print(f"模拟 OpenAI 服务: http://127.0.0.1:{port}/v1 (每次调用延迟 {delay}s，错误率 {error_rate})")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--delay", type=float, default=2.0, help="每次调用的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误状态码的比例")
+    parser.add_argument("--status", type=int, default=500, help="出错时返回的状态码")
+    args = parser.parse_args()
+
+    server = serve_fake_openai(args.port, args.delay, args.error_rate, args.status)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器断开期间拒绝调用上游"""
+
+
+class CircuitBreaker:
+    """按最近 window 次调用的失败率（含慢调用）熔断
+
+    最近的调用中失败（异常或耗时超过 slow_call_seconds）比例达到 failure_threshold 时断开，
+    cooldown 秒内直接拒绝；之后进入半开状态，只放行一次探测调用，成功则恢复，失败则再次断开。
+    """
+
+    def __init__(self, name, window=20, min_calls=10, failure_threshold=0.5,
+                 slow_call_seconds=5.0, cooldown=30.0):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)  # True 表示失败
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "trips": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self):
+        """是否允许这次调用；半开状态下同一时间只放行一次探测"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def release(self):
+        """调用被取消（不代表上游成败）时释放半开状态的探测名额"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record(self, success, elapsed):
+        """记录一次调用结果（elapsed 为耗时秒数）"""
+        slow = elapsed > self.slow_call_seconds
+        failed = not success or slow
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["failures"] += not success
+            self._stats["slow_calls"] += slow
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if failed:
+                    self._trip()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if (self._state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and sum(self._outcomes) / len(self._outcomes) >= self.failure_threshold):
+                self._trip()
+
+    def record_failure(self, elapsed=0.0):
+        """记录一次 guarded_call 之外发现的失败，例如流式响应在两段之间超时"""
+        self.record(False, elapsed)
+
+    def _trip(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._stats["trips"] += 1
+        print(f"⚠️ 熔断器 {self.name} 断开，{self.cooldown:.0f} 秒后尝试恢复")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self._current_state()
+            stats["window_failure_rate"] = (
+                round(sum(self._outcomes) / len(self._outcomes), 4) if self._outcomes else 0.0)
+            if stats["state"] == OPEN:
+                stats["retry_in_seconds"] = round(self.cooldown - (time.monotonic() - self._opened_at), 1)
+        return stats
+
+
+class RetryBudget:
+    """重试预算：每次调用存入 ratio 个令牌，每次重试消耗一个，令牌最多 max_tokens 个
+
+    上游整体出问题时重试总量被限制在调用量的 ratio 倍以内，不会把故障放大。
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._lock = threading.Lock()
+        self._stats = {"retries": 0, "exhausted": 0}
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self._stats["retries"] += 1
+                return True
+            self._stats["exhausted"] += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tokens"] = round(self._tokens, 2)
+        return stats
+
+
+async def guarded_call(factory, breaker, budget, timeout, max_retries=2,
+                       retryable=(Exception,), backoff_base=0.2, backoff_max=2.0):
+    """在熔断器、总超时和重试预算保护下调用上游
+
+    factory 每次返回一个新的协程。熔断器断开时抛出 CircuitOpenError；
+    重试前按指数退避加全抖动（0 ~ backoff_base * 2^n）等待。
+    timeout 是包括所有重试和退避在内的总时限，每次尝试只能使用剩余的时间，
+    剩余时间不够再等一次退避时直接抛出最后一次的异常。
+    """
+    budget.deposit()
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f"circuit {breaker.name} is open")
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(factory(), max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            breaker.record(False, time.perf_counter() - start)
+            is_retryable = isinstance(e, (asyncio.TimeoutError,) + tuple(retryable))
+            if attempt >= max_retries or not is_retryable:
+                raise
+            delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** (attempt + 1)))
+            if time.monotonic() + delay >= deadline or not budget.withdraw():
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        breaker.record(True, time.perf_counter() - start)
+        return result
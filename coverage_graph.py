@@ -0,0 +1,107 @@
+import math
+import os
+
+import numpy as np
+
+from spatial_index import EARTH_RADIUS_KM
+
+# 两家店距离不超过该半径（公里）即视为覆盖范围相交
+COVERAGE_RADIUS_KM = float(os.getenv("COVERAGE_RADIUS_KM", "5"))
+
+# 每度对应的大圆弧长，与距离计算（haversine）使用同一个地球半径，约 111.195 公里
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+# 格子边长在半径基础上放大的比例：抵消浮点误差和经度方向上大圆距离略短于纬线弧长的差异，
+# 保证距离不超过半径的两家店一定落在同一个或相邻的格子里
+_CELL_MARGIN = 1.01
+
+
+def coordinate_key(coordinates):
+    """坐标数组的比较键，坐标不变时可以沿用已计算的覆盖图"""
+    return (coordinates.lats_rad.tobytes(), coordinates.lons_rad.tobytes())
+
+
+class _UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # 以较小的下标为根，保证簇编号稳定
+            if rb < ra:
+                ra, rb = rb, ra
+            self.parent[rb] = ra
+
+
+class CoverageGraph:
+    """店铺覆盖范围相交图：距离不超过 radius_km 的店铺两两相连
+
+    店铺先按经纬度放入边长不小于 radius_km 的网格，只需比较相邻 3x3 个格子内的店铺，
+    避免全表两两计算。连通分量（簇）用并查集求出。节点均为快照下标。
+    """
+
+    def __init__(self, coordinates, radius_km=COVERAGE_RADIUS_KM):
+        self.radius_km = radius_km
+        self.key = coordinate_key(coordinates)
+        size = len(coordinates)
+        self.neighbors = [[] for _ in range(size)]
+        self.distances = {}
+
+        valid = np.flatnonzero(coordinates.valid)
+        if len(valid):
+            for a_idx, b_idx in self._candidate_cells(coordinates, valid):
+                matrix = coordinates.pairwise(a_idx, b_idx)
+                same_cell = a_idx is b_idx
+                for ia, ib in zip(*np.nonzero(matrix <= radius_km)):
+                    a, b = int(a_idx[ia]), int(b_idx[ib])
+                    if a == b or (same_cell and a > b):
+                        continue
+                    self.neighbors[a].append(b)
+                    self.neighbors[b].append(a)
+                    self.distances[(min(a, b), max(a, b))] = float(matrix[ia, ib])
+        for n in self.neighbors:
+            n.sort()
+
+        union_find = _UnionFind(size)
+        for a, b in self.distances:
+            union_find.union(a, b)
+        self.cluster_of = [union_find.find(i) for i in range(size)]
+        clusters = {}
+        for i in valid:
+            clusters.setdefault(self.cluster_of[int(i)], []).append(int(i))
+        # 按簇大小降序，大小相同时按最小下标
+        self.clusters = sorted(clusters.values(), key=lambda c: (-len(c), c[0]))
+
+    def _candidate_cells(self, coordinates, valid):
+        """按网格分桶，产出需要比较的 (格子A下标数组, 格子B下标数组)，每对格子只产出一次"""
+        lats = np.degrees(coordinates.lats_rad[valid])
+        lons = np.degrees(coordinates.lons_rad[valid])
+        # 经度方向的格子宽度按最高纬度计算，保证不会漏掉相邻格子里的店铺
+        max_lat = min(float(np.max(np.abs(lats))), 89.0)
+        lat_step = self.radius_km * _CELL_MARGIN / KM_PER_DEGREE
+        lon_step = self.radius_km * _CELL_MARGIN / (KM_PER_DEGREE * math.cos(math.radians(max_lat)))
+
+        cells = {}
+        for i, row, col in zip(valid, np.floor(lats / lat_step), np.floor(lons / lon_step)):
+            cells.setdefault((int(row), int(col)), []).append(int(i))
+        cells = {cell: np.asarray(members, dtype=np.intp) for cell, members in cells.items()}
+
+        for (row, col), members in cells.items():
+            yield members, members
+            # 只看"右边和下边"的相邻格子，避免同一对格子比较两次
+            for d_row, d_col in ((0, 1), (1, -1), (1, 0), (1, 1)):
+                other = cells.get((row + d_row, col + d_col))
+                if other is not None:
+                    yield members, other
+
+    def overlap_counts(self):
+        return [len(n) for n in self.neighbors]
+
+    def edge_count(self):
+        return len(self.distances)
@@ -1,6 +1,10 @@
 import psycopg2
+from psycopg2 import pool as pg_pool
 from psycopg2.extras import DictCursor
+from contextlib import contextmanager
 import os
+import threading
+import time
 
 # 环境变量
 DB_NAME = "subway_db" 
@@ -9,22 +13,201 @@ DB_PASSWORD = "npg_c7TZpqPHBg9L"
 DB_HOST = "ep-blue-leaf-a5q7udps-pooler.us-east-2.aws.neon.tech"  
 DB_PORT = "5432"  
 
-def connect_db():
-    """ 连接 Neon PostgreSQL 数据库 """
-    try:
-        conn = psycopg2.connect(
+# 连接池配置
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # 借出连接的最长等待时间（秒）
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # 空闲超过该秒数的连接在借出前执行 SELECT 1
+
+
+class ConnectionPool:
+    """进程级连接池：借出/归还语义，借出时做健康检查，并记录等待时间与饱和度"""
+
+    def __init__(self, minconn, maxconn, timeout):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = pg_pool.ThreadedConnectionPool(
+            minconn, maxconn,
             dbname=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
             host=DB_HOST,
             port=DB_PORT,
-            sslmode="require"  # Neon 需要 SSL 连接
+            sslmode="require"
         )
+        # ThreadedConnectionPool 在耗尽时直接抛错，用信号量实现排队等待
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "wait_time_total_ms": 0.0,
+            "wait_time_max_ms": 0.0,
+        }
+
+    def getconn(self):
+        """借出一个健康的连接，池满时最多等待 timeout 秒"""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise pg_pool.PoolError(f"connection pool exhausted (waited {self.timeout}s)")
+        waited_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+            self._stats["wait_time_total_ms"] += waited_ms
+            self._stats["wait_time_max_ms"] = max(self._stats["wait_time_max_ms"], waited_ms)
         return conn
+
+    def _checkout_healthy(self):
+        """从池中取连接；已断开或长时间空闲后探测失败的连接会被丢弃并重建
+
+        连续两次失败后（例如数据库重启，池中都是失效的连接）第三个连接无论是否空闲都先探测，
+        仍然失败时抛出异常，不把未经检查的连接交给调用方。
+        """
+        for attempt in range(3):
+            conn = self._pool.getconn()
+            idle = time.monotonic() - self._last_used.get(id(conn), 0)
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError("connection already closed")
+                if idle > DB_POOL_HEALTHCHECK_IDLE or attempt == 2:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    conn.rollback()
+                return conn
+            except Exception as e:
+                print(f"⚠️ 连接池健康检查失败，丢弃连接: {e}")
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                if attempt == 2:
+                    raise
+
+    def putconn(self, conn):
+        """归还连接；未结束的事务先回滚，已断开的连接直接关闭"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=broken)
+        with self._lock:
+            self._stats["in_use"] -= 1
+        self._slots.release()
+
+    def stats(self):
+        """连接池指标：等待时间、使用中连接数和饱和度"""
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = stats["checkouts"] or 1
+        stats["min_size"] = self.minconn
+        stats["max_size"] = self.maxconn
+        stats["wait_time_avg_ms"] = round(stats["wait_time_total_ms"] / checkouts, 3)
+        stats["wait_time_total_ms"] = round(stats["wait_time_total_ms"], 3)
+        stats["wait_time_max_ms"] = round(stats["wait_time_max_ms"], 3)
+        stats["saturation"] = round(stats["in_use"] / self.maxconn, 3)
+        return stats
+
+
+class PooledConnection:
+    """池化连接的代理对象，close() 表示归还连接而不是断开"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ 获取（必要时创建）进程级连接池 """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+    return _pool
+
+
+def get_pool_stats():
+    """ 返回连接池指标，连接池尚未创建时返回空指标 """
+    if _pool is None:
+        return {"min_size": DB_POOL_MIN, "max_size": DB_POOL_MAX, "in_use": 0, "saturation": 0.0, "checkouts": 0}
+    return _pool.stats()
+
+
+def close_pool():
+    """ 关闭连接池中的所有连接（进程退出时调用） """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool._pool.closeall()
+            _pool = None
+
+
+def get_connection():
+    """ 从连接池借出一个连接，调用 close() 归还；失败时抛出异常 """
+    pool = get_pool()
+    return PooledConnection(pool, pool.getconn())
+
+
+def connect_db():
+    """ 从连接池借出一个 Neon PostgreSQL 连接，失败时返回 None """
+    try:
+        return get_connection()
     except Exception as e:
         print(f"⚠️ Database connection error: {e}")
         return None
 
+
+@contextmanager
+def pooled_connection():
+    """ 借出连接的上下文管理器，退出时自动归还 """
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
 def execute_query(query, values=None, fetch=False):
     """ 执行 SQL 查询 """
     conn = connect_db()
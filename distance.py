@@ -0,0 +1,63 @@
+import numpy as np
+
+from spatial_index import EARTH_RADIUS_KM, parse_coordinates
+
+
+def haversine_one_to_many(lat, lon, lats_rad, lons_rad):
+    """一个点到一组点的球面距离（公里），lats_rad/lons_rad 为弧度数组"""
+    lat1, lon1 = np.radians(float(lat)), np.radians(float(lon))
+    sin_dlat = np.sin((lats_rad - lat1) / 2)
+    sin_dlon = np.sin((lons_rad - lon1) / 2)
+    a = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lats_rad) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine_many_to_many(lats1_rad, lons1_rad, lats2_rad, lons2_rad):
+    """两组点两两之间的球面距离矩阵（公里），形状为 (len(第一组), len(第二组))"""
+    lat1 = lats1_rad[:, np.newaxis]
+    lon1 = lons1_rad[:, np.newaxis]
+    sin_dlat = np.sin((lats2_rad - lat1) / 2)
+    sin_dlon = np.sin((lons2_rad - lon1) / 2)
+    a = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lats2_rad) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class OutletCoordinates:
+    """快照中所有店铺的坐标，按快照下标存放为连续的 float64 弧度数组
+
+    缺失坐标的店铺在数组中为 NaN，计算出的距离统一替换为 inf（排在所有有坐标的店铺之后）。
+    """
+
+    def __init__(self, outlets):
+        lats = np.full(len(outlets), np.nan)
+        lons = np.full(len(outlets), np.nan)
+        for i, outlet in enumerate(outlets):
+            coords = parse_coordinates(outlet)
+            if coords is not None:
+                lats[i], lons[i] = coords
+        self.lats_rad = np.ascontiguousarray(np.radians(lats))
+        self.lons_rad = np.ascontiguousarray(np.radians(lons))
+        self.valid = ~np.isnan(self.lats_rad)
+
+    def __len__(self):
+        return len(self.lats_rad)
+
+    def distances_from(self, lat, lon, indexes=None):
+        """给定坐标到店铺的距离（公里）；indexes 为快照下标，默认全部店铺"""
+        lats, lons = self.lats_rad, self.lons_rad
+        if indexes is not None:
+            indexes = np.asarray(indexes, dtype=np.intp)
+            lats, lons = lats[indexes], lons[indexes]
+        return np.nan_to_num(haversine_one_to_many(lat, lon, lats, lons), nan=np.inf)
+
+    def pairwise(self, indexes_a=None, indexes_b=None):
+        """两组店铺两两之间的距离矩阵（公里），默认全部店铺"""
+        def pick(indexes):
+            if indexes is None:
+                return self.lats_rad, self.lons_rad
+            indexes = np.asarray(indexes, dtype=np.intp)
+            return self.lats_rad[indexes], self.lons_rad[indexes]
+
+        lats_a, lons_a = pick(indexes_a)
+        lats_b, lons_b = pick(indexes_b)
+        return np.nan_to_num(haversine_many_to_many(lats_a, lons_a, lats_b, lons_b), nan=np.inf)
@@ -0,0 +1,163 @@
+import hashlib
+import threading
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+
+from outlet_store import outlet_store
+from precompressed import applied_encoding, cacheable, choose_encoding
+from query_planner import is_now
+
+# 带 ETag 的只读接口
+ETAG_PATHS = ("/outlets", "/api/outlets/")
+# 与 pydantic 解析 bool 查询参数时接受的真值一致
+_TRUE_VALUES = {"1", "true", "t", "yes", "y", "on"}
+# 处理器的 ETag 时间范围只取决于路由：没有路径参数的路由按 (方法, 路径模板) 缓存，
+# 带路径参数或没有匹配到路由的请求每次重新匹配，因此缓存大小不超过路由数
+_route_scopes = {}
+
+_lock = threading.Lock()
+_stats = {"tagged": 0, "not_modified": 0}
+
+
+def etag_scope(scope):
+    """由处理器声明响应随时间变化的范围（放在 @app.get 下面）
+
+    scope 为 "static"（只取决于数据）、"date"（按天变化，例如默认按今天判断工作日/周末）、
+    "minute"（"营业中"之类按分钟变化），或接受查询参数字典（键和值均为小写）并返回其中之一的函数。
+    未声明的接口按 "minute" 处理。
+    """
+    def decorator(func):
+        func.etag_scope = scope
+        return func
+    return decorator
+
+
+def now_or_date(params):
+    """带时间条件的接口：请求"现在"（open_now 为真，或时间参数是 now/currently 等）时按分钟，否则按天"""
+    if params.get("open_now") in _TRUE_VALUES:
+        return "minute"
+    if any(is_now(value) for key, value in params.items() if key != "open_now"):
+        return "minute"
+    return "date"
+
+
+def _declared_scope(scope):
+    """找到请求对应的处理器，取它声明的 etag_scope"""
+    declared = _route_scopes.get((scope["method"], scope["path"]))
+    if declared is not None:
+        return declared
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(dict(scope, method="GET" if scope["method"] == "HEAD" else scope["method"]))
+        if match == Match.FULL:
+            declared = getattr(getattr(route, "endpoint", None), "etag_scope", "minute")
+            if not getattr(route, "param_convertors", None):
+                # 没有路径参数时路径模板就是请求路径
+                _route_scopes[(scope["method"], route.path_format)] = declared
+            return declared
+    return "minute"
+
+
+def time_scope(declared, params, now=None):
+    """把声明的范围换成 ETag 中的时间部分：数据不变时 ETag 在这个时间范围内保持不变"""
+    kind = declared(params) if callable(declared) else declared
+    if kind == "static":
+        return ""
+    now = now or datetime.now()
+    return now.strftime("%Y-%m-%dT%H:%M" if kind == "minute" else "%Y-%m-%d")
+
+
+def compute_etag(version, path, query_string, declared="minute", now=None):
+    """强 ETag：快照版本 + 路径和（排序后的）查询参数 + 时间范围"""
+    params = sorted(parse_qsl(query_string, keep_blank_values=True))
+    lowered = {k.lower(): v.lower() for k, v in params}
+    key = f"{path}?{params}@{time_scope(declared, lowered, now)}"
+    return f'"{version}-{hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]}"'
+
+
+def if_none_match(header, etag):
+    """If-None-Match 中是否包含该 ETag（按 RFC 7232 弱比较，支持多个值和 *）"""
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def with_encoding(etag, encoding):
+    """预压缩的接口按编码返回不同的字节，实际使用了压缩编码时 ETag 带上编码后缀"""
+    return etag if encoding == "identity" else f'{etag[:-1]}-{encoding}"'
+
+
+def _not_modified(etag, headers):
+    """304 响应的 http.response.start 消息"""
+    with _lock:
+        _stats["not_modified"] += 1
+    return {"type": "http.response.start", "status": 304, "headers": [(b"etag", etag.encode("latin-1"))] + headers}
+
+
+class ETagMiddleware:
+    """只读门店接口的 ETag / If-None-Match 中间件（ASGI）
+
+    ETag 在调用处理器之前由快照版本算出，If-None-Match 命中时直接返回 304，
+    不执行处理器、也不访问数据库。请求期间固定使用同一个快照，保证响应内容与 ETag 对应。
+    预压缩的接口按实际发送的编码区分 ETag：该版本尚未渲染、还不知道实际编码时，
+    渲染后再按响应的 Content-Encoding 确定 ETag 并比较 If-None-Match。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] not in ("GET", "HEAD")
+                or not scope["path"].startswith(ETAG_PATHS)):
+            await self.app(scope, receive, send)
+            return
+
+        with outlet_store.pinned() as snapshot:
+            request_headers = Headers(scope=scope)
+            header = request_headers.get("if-none-match")
+            base = compute_etag(snapshot.version, scope["path"], scope["query_string"].decode("latin-1"),
+                                _declared_scope(scope))
+            headers_304 = [(b"cache-control", b"no-cache")]
+            etag = base
+            if cacheable(scope):
+                headers_304.append((b"vary", b"Accept-Encoding"))
+                encoding = applied_encoding(scope["path"], snapshot.version,
+                                            choose_encoding(request_headers.get("accept-encoding")))
+                etag = with_encoding(base, encoding) if encoding is not None else None
+            if etag is not None and if_none_match(header, etag):
+                await send(_not_modified(etag, headers_304))
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            not_modified = False
+
+            async def send_with_etag(message):
+                nonlocal not_modified
+                if message["type"] == "http.response.start" and message["status"] == 200:
+                    headers = MutableHeaders(scope=message)
+                    tag = etag or with_encoding(base, headers.get("content-encoding", "identity"))
+                    if etag is None and if_none_match(header, tag):
+                        # 本次渲染后才知道实际编码，ETag 与 If-None-Match 一致时仍然返回 304
+                        not_modified = True
+                        await send(_not_modified(tag, headers_304))
+                        return
+                    headers["ETag"] = tag
+                    # 允许缓存，但每次使用前都要带 If-None-Match 重新验证
+                    headers.setdefault("Cache-Control", "no-cache")
+                    with _lock:
+                        _stats["tagged"] += 1
+                elif not_modified:
+                    if message["type"] == "http.response.body" and not message.get("more_body", False):
+                        await send({"type": "http.response.body", "body": b""})
+                    return
+                await send(message)
+
+            await self.app(scope, receive, send_with_etag)
+
+def stats():
+    with _lock:
+        return dict(_stats)
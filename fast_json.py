@@ -0,0 +1,41 @@
+from collections.abc import Mapping
+from decimal import Decimal
+
+import orjson
+from fastapi.responses import JSONResponse
+
+# numpy 数值、非字符串键也直接编码
+_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj):
+    """orjson 不认识的类型：与 FastAPI jsonable_encoder 的转换保持一致"""
+    if isinstance(obj, Decimal):
+        # 整数值的 Decimal 编码为整数，其余为浮点数
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, Mapping):
+        return dict(obj)  # 快照中的只读行（MappingProxyType）
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj):
+    """编码为 JSON 字节串；datetime、date 按 ISO 8601 输出"""
+    return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+
+def encode_row(row):
+    """预编码一行，返回可直接嵌入 dumps 结果的片段"""
+    return orjson.Fragment(dumps(row))
+
+
+class FastJSONResponse(JSONResponse):
+    """用 orjson 渲染的 JSON 响应
+
+    端点直接返回它时 FastAPI 不再对内容调用 jsonable_encoder，
+    Decimal、datetime 和 JSONB 字典在 orjson 的 C 实现中一次编码完成。
+    """
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,254 @@
+# 邮编范围匹配 - 吉隆坡和雪兰莪地区邮编范围（"起始-结束" 表示闭区间，其余为单个邮编）
+POSTCODE_AREAS = {
+    # 吉隆坡地区
+    "City Centre": ["50000-50999"],
+    "Taman Tun Dr Ismail": ["60000"],
+    "Ampang": ["68000"],
+    "Batu Caves": ["68100"],
+    "Bukit Bintang": ["55100"],
+    "Cheras": ["56000", "43200"],  # 吉隆坡 56000 与雪兰莪 43200 两部分
+    "Kepong": ["52100"],
+    "Setapak": ["53000"],
+    "Wangsa Maju": ["53300"],
+    "Bangsar": ["59000"],
+    "Brickfields": ["50470"],
+    "Mont Kiara": ["50480"],
+    "Sri Hartamas": ["50480"],
+    "Seputeh": ["58000"],
+    "Bukit Jalil": ["57000"],
+    "Sri Petaling": ["57000"],
+    "Desa Petaling": ["57100"],
+    "Taman Desa": ["58100"],
+    "Kuchai Lama": ["58200"],
+    "Salak South": ["57100"],
+    "Sungai Besi": ["57000"],
+    # 雪兰莪地区
+    "Petaling Jaya": ["46000-46999"],
+    "Subang Jaya": ["47500-47630"],
+    "UEP Subang Jaya (USJ)": ["47600"],
+    "Bandar Sunway": ["47500"],
+    "Puchong": ["47100"],
+    "Seri Kembangan": ["43300"],
+    "Putra Heights": ["47650"],
+    "Kota Damansara": ["47810"],
+    "Ara Damansara": ["47301"],
+    "Damansara Jaya": ["47400"],
+    "Damansara Utama": ["47400"],
+    "Mutiara Damansara": ["47800"],
+    "Bandar Utama": ["47800"],
+    "Kelana Jaya": ["47301"],
+    "Gombak": ["68100"],
+    "Selayang": ["68100"],
+    "Rawang": ["48000"],
+    "Kundang": ["48050"],
+    "Kuang": ["48050"],
+    "Taman Melawati": ["53100"],
+    "Taman Sri Gombak": ["68100"],
+    "Setiawangsa": ["54200"],
+    "Klang": ["41000-41999"],
+    "Port Klang": ["42000"],
+    "Kapar": ["42200"],
+    "Meru": ["41050"],
+    "Pandamaran": ["42000"],
+    "Bukit Tinggi": ["41200"],
+    "Bandar Botanik": ["41200"],
+    "Telok Panglima Garang": ["42500"],
+    "Banting": ["42700"],
+    "Kajang": ["43000"],
+    "Semenyih": ["43500"],
+    "Bangi": ["43650"],
+    "Balakong": ["43300"],
+    "Hulu Langat": ["43100"],
+    "Sungai Long": ["43000"],
+    "Bandar Mahkota Cheras": ["43200"],
+    "Kuala Kubu Bharu": ["44000"],
+    "Batang Kali": ["44300"],
+    "Serendah": ["44300"],
+    "Rasa": ["44200"],
+    "Ulu Yam": ["44300"],
+    "Bukit Beruntung": ["48300"],
+    "Sepang": ["43900"],
+    "Dengkil": ["43800"],
+    "Salak Tinggi": ["43900"],
+    "Cyberjaya": ["63000"],
+    "KLIA": ["64000"]
+}
+
+
+# 地区别名与关键词
+AREA_KEYWORDS = {
+    'bangsar': ['bangsar', 'telawi', 'jalan bangsar', 'lorong maarof', 'kerinchi', 'pantai', 'abdullah', 'menara ub', 'pusat', 'village'],
+    'bandar': ['bandar', 'sri', 'maju', 'puteri', 'utama', 'kinrara', 'sunway', 'sri', 'pudu', 'baru'],
+    'ampang': ['ampang', 'ukay', 'hulu', 'jaya', 'point', 'ampang park', 'ampang putra'],
+    'klcc': ['klcc', 'kuala lumpur city centre', 'pavilion', 'bukit bintang', 'suria', 'twin towers', 'avenue k'],
+    'sunway': ['sunway', 'subang', 'usj', 'sunway pyramid', 'subang jaya', 'sunway velocity'],
+    'damansara': ['damansara', 'mutiara', 'uptown', 'utama', 'perdana', 'heights', 'damai', 'jaya'],
+    'pj': ['petaling jaya', 'pj', 'ss2', 'ss15', 'kelana jaya', 'damansara'],
+    'kl': ['kuala lumpur', 'kl', 'sentral', 'berjaya times square', 'pavilion', 'kl gateway'],
+    'shah alam': ['shah alam', 'seksyen', 'setia alam', 'bukit jelutong']
+}
+
+
+# 聊天查询中直接识别的常见地区（按优先级排列）
+QUICK_LOCATIONS = ['bangsar', 'klcc', 'pj', 'petaling', 'subang', 'sunway', 'damansara', 'kl', 'shah alam']
+
+
+def postcode_ranges(postcodes):
+    """把地区的邮编列表转换为整数闭区间 [(起始, 结束), ...]"""
+    ranges = []
+    for postcode in postcodes:
+        start, _, end = postcode.partition("-")
+        ranges.append((int(start), int(end or start)))
+    return ranges
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机：一次线性扫描找出文本中出现的所有模式"""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+    def add(self, pattern, payload):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append((len(pattern), payload))
+
+    def build(self):
+        """按广度优先计算失败指针，并把失败链上的输出合并到每个状态"""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+        return self
+
+    def scan(self, text):
+        """产出 (起始位置, 结束位置, payload)，结束位置不含"""
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for length, payload in self._output[state]:
+                yield pos + 1 - length, pos + 1, payload
+
+
+def _is_word_boundary(text, start, end):
+    """与正则 \\b地区\\b 的判断一致"""
+    def boundary(pos):
+        left = pos > 0 and (text[pos - 1].isalnum() or text[pos - 1] == '_')
+        right = pos < len(text) and (text[pos].isalnum() or text[pos] == '_')
+        return left != right
+    return boundary(start) and boundary(end)
+
+
+# 同一段文本命中多种条目时的优先级（数字越小越优先）
+_KIND_RANK = {'city': 0, 'area': 1, 'quick': 2, 'keyword': 3}
+
+
+class Gazetteer:
+    """地名词典：邮编地区、地区关键词、常见地区和快照中的城市编译进同一个 Aho-Corasick 自动机
+
+    条目映射到邮编集合（邮编地区）或店铺 ID（城市）。从自由文本中提取地名只需对文本做一次线性扫描。
+    """
+
+    def __init__(self, outlets=()):
+        self.area_order = {area: n for n, area in enumerate(POSTCODE_AREAS)}
+        self.keyword_order = {area: n for n, area in enumerate(AREA_KEYWORDS)}
+        self.quick_order = {loc: n for n, loc in enumerate(QUICK_LOCATIONS)}
+
+        # 城市 -> 店铺 ID，城市按首次出现的顺序
+        self.city_outlets = {}
+        for outlet in outlets:
+            city = (outlet.get('city') or '').strip()
+            if city:
+                self.city_outlets.setdefault(city, []).append(outlet['id'])
+        self.cities = list(self.city_outlets)
+
+        automaton = AhoCorasick()
+        for area in POSTCODE_AREAS:
+            automaton.add(area.lower(), ('area', area))
+        for area, keywords in AREA_KEYWORDS.items():
+            automaton.add(area, ('keyword', area))
+            for keyword in keywords:
+                automaton.add(keyword, ('keyword', area))
+        for loc in QUICK_LOCATIONS:
+            automaton.add(loc, ('quick', loc))
+        for city in self.cities:
+            automaton.add(city.lower(), ('city', city))
+        self._automaton = automaton.build()
+
+        # 查询词是地区名子串的情况（如 "bangs" -> Bangsar），预先展开为字典
+        self._area_substrings = {}
+        for area in POSTCODE_AREAS:
+            name = area.lower()
+            for i in range(len(name)):
+                for j in range(i + 1, len(name) + 1):
+                    self._area_substrings.setdefault(name[i:j], set()).add(area)
+
+    def scan(self, text):
+        """对小写文本扫描一遍，返回 [(起始, 结束, (类型, 名称)), ...]"""
+        return list(self._automaton.scan(text.lower()))
+
+    def postcode_areas(self, query):
+        """与查询互相包含的邮编地区，返回 [(地区, 邮编列表), ...]，按词典顺序"""
+        query = query.lower()
+        areas = set(self._area_substrings.get(query, ()))
+        areas.update(name for _, _, (kind, name) in self.scan(query) if kind == 'area')
+        return [(area, POSTCODE_AREAS[area]) for area in sorted(areas, key=self.area_order.get)]
+
+    def keyword_areas(self, text):
+        """文本中出现了名称或任一关键词的地区，按词典顺序"""
+        areas = {name for _, _, (kind, name) in self.scan(text) if kind == 'keyword'}
+        return sorted(areas, key=self.keyword_order.get)
+
+    def quick_location(self, text):
+        """文本中出现的常见地区，多个时取优先级最高的"""
+        found = [name for _, _, (kind, name) in self.scan(text) if kind == 'quick']
+        return min(found, key=self.quick_order.get) if found else None
+
+    def find_city(self, text):
+        """文本中以完整单词出现的城市（取最靠前、最长的一个），没有时返回 None"""
+        lowered = text.lower()
+        best = None
+        for start, end, (kind, name) in self.scan(lowered):
+            if kind == 'city' and _is_word_boundary(lowered, start, end):
+                if best is None or (start, start - end) < (best[0], best[0] - best[1]):
+                    best = (start, end, name)
+        return best[2] if best else None
+
+    def locations(self, text):
+        """文本中以完整单词出现的地名，重叠时取最靠前、最长的一个
+
+        返回 [(起始, 结束, 名称, 类型), ...]。同一位置有多种条目时按 城市 > 邮编地区 > 常见地区 > 关键词
+        取类型，城市和邮编地区返回词典中的写法，其余返回文本中的原词。
+        """
+        lowered = text.lower()
+        spans = {}
+        for start, end, (kind, name) in self.scan(lowered):
+            if _is_word_boundary(lowered, start, end):
+                rank = _KIND_RANK[kind]
+                if (start, end) not in spans or rank < spans[(start, end)][0]:
+                    spans[(start, end)] = (rank, kind, name if kind in ('city', 'area') else lowered[start:end])
+        picked = []
+        for (start, end), (_, kind, name) in sorted(spans.items(), key=lambda item: (item[0][0], -item[0][1])):
+            if not picked or start >= picked[-1][1]:
+                picked.append((start, end, name, kind))
+        return picked
+
+    def city_outlet_ids(self, city):
+        return list(self.city_outlets.get(city, ()))
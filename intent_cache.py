@@ -0,0 +1,140 @@
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from intent_signature import slot_signature
+
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "1024"))  # 最多缓存的查询条数，0 表示关闭缓存
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", "3600"))  # 缓存条目的有效期（秒）
+# 按槽位签名命中时，以该比例仍然调用模型核对结果，用于统计签名碰撞率
+INTENT_SIGNATURE_AUDIT_RATE = float(os.getenv("INTENT_SIGNATURE_AUDIT_RATE", "0.05"))
+
+# 只缓存模型解析出的意图字段；answer 是面向用户的自然语言，命中时重新生成
+INTENT_FIELDS = ("action", "location", "time", "attribute")
+
+
+def normalize_query(query):
+    """缓存键：小写、合并空白、去掉首尾空白和句末标点"""
+    text = re.sub(r'\s+', ' ', (query or '').lower()).strip()
+    return text.rstrip('?!.。？！ ')
+
+
+def _comparable(intent):
+    """比较两个意图是否等价时忽略大小写和空白"""
+    return {field: re.sub(r'\s+', '', str(intent[field]).lower())
+            for field in INTENT_FIELDS if intent.get(field)}
+
+
+class IntentCache:
+    """LLM 意图解析结果的 LRU 缓存，条目超过 ttl 秒后失效
+
+    每个结果同时以规范化原文和槽位签名（见 intent_signature）为键保存。查询先按原文查找，
+    未命中再按签名查找，这样只是词序、填充词不同的问法也能复用已解析的意图。
+    """
+
+    def __init__(self, maxsize=INTENT_CACHE_SIZE, ttl=INTENT_CACHE_TTL,
+                 audit_rate=INTENT_SIGNATURE_AUDIT_RATE):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.audit_rate = audit_rate
+        self._entries = OrderedDict()  # ("query"|"signature", 键) -> (写入时间, 意图)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "signature_hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+                       "signature_audits": 0, "signature_collisions": 0}
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            self._stats["expired"] += 1
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def get(self, query, gazetteer=None):
+        """返回 (意图字典副本, 是否需要核对)，未命中或已过期时意图为 None
+
+        按签名命中时，以 audit_rate 的比例要求调用方仍然调用模型并用 audit() 报告结果。
+        """
+        with self._lock:
+            entry = self._lookup(("query", normalize_query(query)))
+            if entry is not None:
+                self._stats["hits"] += 1
+                return dict(entry[1]), False
+            signature = slot_signature(query, gazetteer) if gazetteer is not None else None
+            entry = self._lookup(("signature", signature)) if signature else None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None, False
+            self._stats["signature_hits"] += 1
+            return dict(entry[1]), random.random() < self.audit_rate
+
+    def put(self, query, result, gazetteer=None):
+        """保存模型结果中的意图字段（没有 action 的结果不缓存）"""
+        if self.maxsize <= 0 or not isinstance(result, dict) or not result.get("action"):
+            return
+        intent = {field: result[field] for field in INTENT_FIELDS if result.get(field) is not None}
+        keys = [("query", normalize_query(query))]
+        signature = slot_signature(query, gazetteer) if gazetteer is not None else None
+        if signature:
+            keys.append(("signature", signature))
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (now, intent)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def audit(self, cached, result):
+        """记录一次签名命中的核对结果：模型给出的意图与缓存不同即为一次碰撞"""
+        with self._lock:
+            self._stats["signature_audits"] += 1
+            if isinstance(result, dict) and _comparable(result) != _comparable(cached):
+                self._stats["signature_collisions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["signature_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["signature_hits"]) / lookups, 4) if lookups else 0.0
+        audits = stats["signature_audits"]
+        stats["signature_collision_rate"] = round(stats["signature_collisions"] / audits, 4) if audits else 0.0
+        stats["maxsize"] = self.maxsize
+        stats["ttl_seconds"] = self.ttl
+        stats["signature_audit_rate"] = self.audit_rate
+        return stats
+
+
+def describe_intent(intent):
+    """根据缓存的意图字段生成 answer 文本（与规则解析的措辞一致）"""
+    action = intent.get("action")
+    location = intent.get("location")
+    time_condition = intent.get("time")
+    attribute = intent.get("attribute")
+    if action == "search_location" and location:
+        return f"Let me find Subway outlets in {location}."
+    if action == "get_nearest":
+        return "Let me find the nearest Subway outlets to your location."
+    if action == "get_attribute" and attribute:
+        return f"Let me find Subway outlets with attribute: {attribute}."
+    if action in ("compound_query", "time_query") and location and time_condition:
+        return f"Looking for outlets in {location} that match the time condition: {time_condition}."
+    if action == "special_time_location" and location:
+        return f"Looking for outlets in {location} with attribute: {attribute}"
+    if time_condition:
+        return f"Let me find Subway outlets for the time condition: {time_condition}."
+    return "Let me look that up for you."
+
+
+intent_cache = IntentCache()
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+from gazetteer import AREA_KEYWORDS
+from intent_signature import extract_slots
+
+# 本地解析的置信度达到该值时直接使用，否则交给 LLM
+INTENT_PARSER_MIN_CONFIDENCE = float(os.getenv("INTENT_PARSER_MIN_CONFIDENCE", "0.8"))
+
+
+# 查询计划能从原文识别的日期词（is_weekend_query），其余（明天、星期几）只有 LLM 能处理
+_PLANNER_DAY_WORDS = {'weekday', 'weekend', 'today'}
+
+
+def _ignored_slots(slots, intent):
+    """查询中出现、但所选规则的意图没有用到的槽位（时间、日期、地点、"附近"）
+
+    例如 "subway near klcc open now" 匹配到最近店铺规则，"now" 会被丢掉；
+    "outlet near me that is open 24/7" 匹配到 24 小时规则，"near" 会被丢掉。
+    """
+    ignored = []
+    if slots['time'] and not intent.get('time'):
+        ignored.append('time')
+    if slots['location'] and not intent.get('location'):
+        ignored.append('location')
+    if slots['day'] - _PLANNER_DAY_WORDS:
+        ignored.append('day')
+    if 'nearest' in slots['superlative'] and intent.get('action') != 'get_nearest':
+        ignored.append('nearest')
+    return ignored
+
+
+def _is_weak_location(name, kind):
+    """地区关键词里的泛称单词（如 "jaya"、"utama"）作为地点时可信度较低"""
+    return kind == 'keyword' and ' ' not in name and name not in AREA_KEYWORDS
+
+
+def _intent(answer, action, **slots):
+    result = {"answer": answer, "action": action}
+    result.update(slots)
+    return result
+
+
+def _time_phrase(slots):
+    """比较符 + 原文时间，例如 "after 10pm"；没有比较符时为 "at 10pm" """
+    comparator = slots['comparator'][0] if slots['comparator'] else 'at'
+    return f"{comparator} {slots['time_text'][0]}"
+
+
+def _match_rules(slots):
+    """按优先级匹配规则，返回 (意图, 规则本身的置信度)"""
+    location = slots['location'][0][0] if slots['location'] else None
+    events = slots['event']
+    superlatives = slots['superlative']
+    has_time = bool(slots['time'])
+    is_now = slots['time'][:1] == ['now']
+    comparator = slots['comparator'][0] if slots['comparator'] else None
+
+    # 24 小时营业
+    if '24hours' in slots['flag']:
+        return (_intent("Let me find Subway outlets that are open 24 hours.", "get_attribute", attribute="24hours"),
+                0.9 if not location else 0.6)
+
+    # 最早/最晚开门、关门（可带地点）
+    extremes = superlatives & {'earliest', 'latest'}
+    if extremes and not has_time:
+        if len(extremes) != 1 or len(events) != 1:
+            return _intent("", ""), 0.3
+        attribute = f"{extremes.pop()}_{'opening' if 'open' in events else 'closing'}"
+        if location:
+            return (_intent(f"Looking for outlets in {location} with attribute: {attribute}",
+                            "special_time_location", location=location, attribute=attribute), 0.95)
+        verb = "opens" if 'open' in events else "closes"
+        which = "earliest" if attribute.startswith("earliest") else "latest"
+        return (_intent(f"Let me find which Subway outlet {verb} the {which}.", "get_attribute", attribute=attribute),
+                0.95)
+
+    # 最近的店铺
+    if 'nearest' in superlatives:
+        # 没有地名时不填 location，由处理器使用请求中的用户坐标
+        if location:
+            return (_intent(f"Let me find the nearest Subway outlets to {location}.", "get_nearest",
+                            location=location), 0.9)
+        return _intent("Let me find the nearest Subway outlets to your location.", "get_nearest"), 0.9
+
+    # 现在营业
+    if is_now:
+        if 'close' in events:
+            return _intent("", ""), 0.3
+        if location:
+            return (_intent(f"Let me check Subway outlets in {location} that are open now.", "time_query",
+                            location=location, time="now"), 0.95)
+        return _intent("Let me find Subway outlets that are currently open.", "time_query", time="now"), 0.95
+
+    # 指定时间的开门/关门/营业
+    if has_time:
+        if len(events) > 1:
+            return _intent("", ""), 0.3
+        time_phrase = _time_phrase(slots)
+        # 没有说明开门还是关门时："before X" 视为关门，其余视为营业
+        event = next(iter(events)) if events else ('close' if comparator == 'before' else 'open')
+        confidence = 0.9 if comparator in ('before', 'after') else 0.6
+        if not events:
+            confidence = min(confidence, 0.7)
+        if location:
+            time_condition = f"{event} {time_phrase}"
+            return (_intent(f"Looking for outlets in {location} that match the time condition: {time_condition}.",
+                            "compound_query", location=location, time=time_condition), confidence)
+        if event == 'close':
+            return (_intent(f"Let me find Subway outlets that close {time_phrase}.", "closing_time_query",
+                            time=time_phrase, location=None), confidence)
+        if comparator == 'before':
+            return (_intent(f"Let me find Subway outlets that open {time_phrase}.", "opening_time_query",
+                            time=time_phrase, location=None), confidence)
+        if comparator == 'after':
+            return (_intent(f"Let me find Subway outlets that are still open {time_phrase}.", "still_open_after",
+                            time=time_phrase, location=None), confidence)
+        return (_intent(f"Let me find Subway outlets that are open {time_phrase}.", "time_query",
+                        time=time_phrase), 0.5)
+
+    # 只有地点
+    if location:
+        if events:
+            return (_intent(f"Let me check Subway outlets in {location} for the specified time.", "time_query",
+                            location=location, time="business_hours"), 0.6)
+        return _intent(f"Let me find Subway outlets in {location}.", "search_location", location=location), 0.95
+
+    return _intent("", ""), 0.0
+
+
+class IntentParser:
+    """本地确定性意图解析：槽位抽取（intent_signature.extract_slots）+ 按优先级排列的规则
+
+    输出格式与 LLM 的 JSON 一致，并给出置信度：规则本身的置信度，再按查询中未识别的词、
+    多个地点/时间、泛称地名等情况打折扣。
+    """
+
+    def __init__(self, min_confidence=INTENT_PARSER_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._stats = {"parsed": 0, "resolved_locally": 0, "escalated": 0, "parse_time_total_us": 0.0}
+
+    def parse(self, query, gazetteer):
+        """返回 (意图字典, 置信度 0~1)"""
+        start = time.perf_counter()
+        intent, confidence = self._parse(query, gazetteer)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        with self._lock:
+            self._stats["parsed"] += 1
+            self._stats["resolved_locally" if confidence >= self.min_confidence else "escalated"] += 1
+            self._stats["parse_time_total_us"] += elapsed_us
+        return intent, confidence
+
+    def _parse(self, query, gazetteer):
+        slots = extract_slots(query, gazetteer)
+        intent, confidence = _match_rules(slots) if slots is not None else (_intent("", ""), 0.0)
+        if not intent["action"]:
+            intent["answer"] = ("I'm not sure how to answer that. You can ask about Subway outlets in specific "
+                                "locations, opening times, or find the nearest outlet to your location.")
+            return intent, confidence
+        if _ignored_slots(slots, intent):
+            # 规则会丢掉查询中的条件：置信度压到阈值以下，交给 LLM
+            confidence = min(confidence, self.min_confidence / 2)
+        if slots['unknown']:
+            confidence *= 0.6 if len(slots['unknown']) == 1 else 0.4
+        if len({name.lower() for name, _ in slots['location']}) > 1:
+            confidence *= 0.5
+        elif slots['location'] and _is_weak_location(*slots['location'][0]):
+            confidence *= 0.8
+        if len(set(slots['time'])) > 1:
+            confidence *= 0.5
+        elif slots['time'] and slots['time'][0].endswith('?'):
+            confidence *= 0.7  # 没有 am/pm 的钟点（"before 10"）有歧义
+        return intent, round(confidence, 3)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        total_us = stats.pop("parse_time_total_us")
+        stats["avg_parse_time_us"] = round(total_us / stats["parsed"], 1) if stats["parsed"] else 0.0
+        stats["local_rate"] = round(stats["resolved_locally"] / stats["parsed"], 4) if stats["parsed"] else 0.0
+        stats["min_confidence"] = self.min_confidence
+        return stats
+
+
+intent_parser = IntentParser()
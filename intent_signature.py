@@ -0,0 +1,153 @@
+import re
+
+# 不影响意图的填充词，规范化时直接丢弃
+FILLER_WORDS = {
+    'a', 'an', 'the', 'any', 'all', 'some', 'is', 'are', 'was', 'be', 'there', 'here',
+    'which', 'what', 'where', 'who', 'whats', 'how', 'many',
+    'subway', 'subways', 'outlet', 'outlets', 'store', 'stores', 'shop', 'shops',
+    'restaurant', 'restaurants', 'branch', 'branches', 'location', 'locations', 'ones', 'one',
+    'in', 'at', 'on', 'of', 'for', 'to', 'from', 'and', 'or', 'that', 'with',
+    'area', 'areas', 'district', 'region', 'located',
+    'show', 'list', 'find', 'tell', 'give', 'get', 'me', 'i', 'you', 'can', 'could',
+    'do', 'does', 'please', 'pls', 'want', 'need', 'looking', 'know', 'hey', 'hi',
+    'still', 'also', 'yet', 'time', 'hours', 'hour',
+}
+
+# 比较词：只有紧挨在时间表达式前面时才算比较符
+COMPARATORS = {
+    'before': 'before', 'after': 'after', 'past': 'after',
+    'until': 'until', 'till': 'until', 'at': 'at', 'around': 'around', 'by': 'by',
+}
+
+EVENT_WORDS = {
+    'open': 'open', 'opens': 'open', 'opening': 'open', 'opened': 'open',
+    'operate': 'open', 'operates': 'open', 'operating': 'open',
+    'close': 'close', 'closes': 'close', 'closing': 'close', 'closed': 'close', 'shut': 'close',
+}
+
+SUPERLATIVE_WORDS = {
+    'earliest': 'earliest', 'first': 'earliest',
+    'latest': 'latest', 'last': 'latest',
+    'nearest': 'nearest', 'closest': 'nearest', 'near': 'nearest', 'nearby': 'nearest',
+}
+
+DAY_WORDS = {
+    'weekday': 'weekday', 'weekdays': 'weekday',
+    'weekend': 'weekend', 'weekends': 'weekend',
+    'today': 'today', 'tonight': 'today', 'tomorrow': 'tomorrow',
+    'monday': 'monday', 'tuesday': 'tuesday', 'wednesday': 'wednesday', 'thursday': 'thursday',
+    'friday': 'friday', 'saturday': 'saturday', 'sunday': 'sunday',
+}
+
+# 先于单词切分识别的短语：(正则, 槽位, 值)
+PHRASES = [
+    (re.compile(rf'\b(?:{pattern})\b'), slot, value) for pattern, slot, value in [
+        (r'24\s*/\s*7|24\s*-?\s*hours?|all\s+day|all\s+night|round\s+the\s+clock|never\s+close', 'flag', '24hours'),
+        (r'close\s+to|next\s+to|around\s+me', 'superlative', 'nearest'),
+        (r'right\s+now|currently|at\s+the\s+moment|at\s+this\s+time|now', 'time', 'now'),
+        # 午夜保留原词：关门时间的午夜是 24:00 而不是 00:00，由查询计划按开/关门换算（"12am" 仍是 00:00）
+        (r'midnight', 'clock', ('midnight', 'midnight')),
+        (r'noon|midday', 'clock', ('12:00', '12pm')),
+    ]
+]
+
+TIME_PATTERN = re.compile(r'\b(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)?(?![\d])')
+
+
+def _normalize_time(hour, minute, ampm):
+    """12 小时制统一为 HH:MM；没有 am/pm 的数字原样保留（避免把 "10" 猜成 10am 或 10pm）"""
+    hour, minute = int(hour), int(minute or 0)
+    if hour > 23 or minute > 59:
+        return None
+    if ampm:
+        if hour == 0 or hour > 12:
+            return None
+        if ampm.startswith('p') and hour < 12:
+            hour += 12
+        elif ampm.startswith('a') and hour == 12:
+            hour = 0
+        return f"{hour:02d}:{minute:02d}"
+    return f"{hour}:{minute:02d}?"
+
+
+def extract_slots(query, gazetteer):
+    """把查询拆成槽位：地点、时间、比较符、开/关门、最早/最晚/最近、周中/周末、24 小时
+
+    返回槽位字典；非 ASCII（例如中文）或空查询返回 None。无法归入任何槽位、
+    也不是填充词的单词放在 'unknown' 中。
+    """
+    text = re.sub(r'\s+', ' ', (query or '').lower()).strip()
+    if not text or not text.isascii():
+        return None
+
+    slots = {'location': [], 'time': [], 'time_text': [], 'comparator': [], 'event': set(),
+             'superlative': set(), 'day': set(), 'flag': set(), 'unknown': []}
+
+    for start, end, name, kind in reversed(gazetteer.locations(text)):
+        slots['location'].insert(0, (name, kind))
+        text = text[:start] + ' ' + text[end:]
+
+    for pattern, slot, value in PHRASES:
+        # 具体钟点替换为占位符，用于识别紧挨在时间前面的比较词
+        text, count = pattern.subn(' \x00 ' if slot == 'clock' else ' ', text)
+        if count:
+            if slot == 'time':
+                slots['time'].append(value)
+                slots['time_text'].append(value)
+            elif slot == 'clock':
+                slots['time'].append(value[0])
+                slots['time_text'].append(value[1])
+            else:
+                slots[slot].add(value)
+
+    def take_time(match):
+        value = _normalize_time(*match.groups())
+        if value is None:
+            return match.group(0)
+        slots['time'].append(value)
+        slots['time_text'].append(match.group(0).strip())
+        return ' \x00 '
+
+    text = TIME_PATTERN.sub(take_time, text)
+
+    words = re.findall(r"[a-z0-9\x00']+", text)
+    for n, word in enumerate(words):
+        word = word.replace("'", '')
+        if word == '\x00':
+            continue
+        if word in COMPARATORS and n + 1 < len(words) and words[n + 1] == '\x00':
+            slots['comparator'].append(COMPARATORS[word])
+        elif word in EVENT_WORDS:
+            slots['event'].add(EVENT_WORDS[word])
+        elif word in SUPERLATIVE_WORDS:
+            slots['superlative'].add(SUPERLATIVE_WORDS[word])
+        elif word in DAY_WORDS:
+            slots['day'].add(DAY_WORDS[word])
+        elif word not in FILLER_WORDS:
+            slots['unknown'].append(word)
+    return slots
+
+
+def slot_signature(query, gazetteer):
+    """把查询归约为槽位签名（见 extract_slots）
+
+    只有查询中的每个词都能归入某个槽位或属于填充词、且地点/时间/比较符各不超过一个时才返回签名，
+    否则返回 None，此时只按原文精确缓存。这样词序、大小写、标点、填充词不同的问法可以共用一个
+    缓存条目，而含有未识别内容的查询不会被误合并。
+    """
+    slots = extract_slots(query, gazetteer)
+    if slots is None or slots['unknown']:
+        return None
+    locations = {name.lower() for name, _ in slots['location']}
+    if len(locations) > 1 or len(set(slots['time'])) > 1 or len(set(slots['comparator'])) > 1:
+        return None
+    values = {
+        'location': locations,
+        'time': slots['time'],
+        'comparator': slots['comparator'],
+        'event': slots['event'],
+        'superlative': slots['superlative'],
+        'day': slots['day'],
+        'flag': slots['flag'],
+    }
+    return "|".join(f"{slot}={','.join(sorted(set(v)))}" for slot, v in values.items())
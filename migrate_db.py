@@ -40,7 +40,9 @@ def add_new_columns():
                 {"name": "postcode", "type": "VARCHAR(10)"},
                 {"name": "street_address", "type": "VARCHAR(255)"},
                 {"name": "opening_hours", "type": "JSONB"},
-                {"name": "is_24hours", "type": "BOOLEAN DEFAULT false"}
+                {"name": "is_24hours", "type": "BOOLEAN DEFAULT false"},
+                # 整数邮编生成列，postcode 更新时自动重算
+                {"name": "postcode_int", "type": "INTEGER GENERATED ALWAYS AS (CASE WHEN postcode ~ '^\\s*[0-9]{5}\\s*$' THEN substring(postcode from '[0-9]{5}')::INTEGER END) STORED"}
             ]
             
             # 添加不存在的列
@@ -49,6 +51,9 @@ def add_new_columns():
                     print(f"添加列: {col['name']}")
                     cur.execute(f"ALTER TABLE subway_outlets ADD COLUMN {col['name']} {col['type']}")
             
+            # 邮编范围查询走整数列上的索引
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_subway_outlets_postcode_int ON subway_outlets (postcode_int)")
+            
             conn.commit()
             print("✅ 数据库结构已更新")
     except Exception as e:
@@ -0,0 +1,355 @@
+import contextlib
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+from psycopg2.extras import DictCursor
+
+from coverage_graph import COVERAGE_RADIUS_KM, CoverageGraph, coordinate_key
+from db import get_connection
+from distance import OutletCoordinates
+from fast_json import dumps, encode_row
+from gazetteer import Gazetteer
+from projection import project_row
+from spatial_index import SpatialIndex
+from text_index import TextIndex
+from time_index import OpenBitmap, TimeIndex
+
+# 快照自动刷新间隔（秒），0 表示只在启动时和手动触发时加载
+OUTLET_REFRESH_INTERVAL = float(os.getenv("OUTLET_REFRESH_INTERVAL", "300"))
+# 尚未加载到快照时（例如启动时数据库不可用），两次后台重试加载之间的最短间隔（秒）
+OUTLET_LOAD_RETRY_SECONDS = float(os.getenv("OUTLET_LOAD_RETRY_SECONDS", "5"))
+# 每个快照最多缓存多少种字段组合（fields 参数）的全表预编码片段
+OUTLET_FIELDS_CACHE_SIZE = int(os.getenv("OUTLET_FIELDS_CACHE_SIZE", "16"))
+
+# 不需要门店数据的路径：快照尚未加载时仍然正常响应
+_SNAPSHOT_EXEMPT_PATHS = frozenset({
+    "/", "/health", "/api/metrics", "/api/outlets/refresh", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json",
+})
+
+
+# 影响营业时间索引的字段，这些字段不变的店铺可以沿用上一个快照的位图
+_HOURS_FIELDS = ('opening_hours', 'is_24hours', 'operating_hours')
+
+# 当前上下文固定使用的快照（见 OutletStore.pinned），asyncio 任务和线程池调用会继承它
+_pinned_snapshot = contextvars.ContextVar("pinned_snapshot", default=None)
+
+
+def _compute_version(outlets):
+    """根据全部行内容计算快照版本号，数据不变时版本号不变"""
+    digest = hashlib.sha1()
+    for outlet in outlets:
+        digest.update(repr(tuple(outlet.items())).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class OutletSnapshot:
+    """subway_outlets 表在某一时刻的只读快照"""
+
+    def __init__(self, rows, previous=None, version=None):
+        # 每一行都是只读映射，调用方需要修改时先 dict() 复制
+        self.outlets = tuple(MappingProxyType(dict(r)) for r in rows)
+        self.by_id = {o['id']: o for o in self.outlets}
+        self.version = version or _compute_version(self.outlets)
+        updated = [o.get('updated_at') for o in self.outlets if o.get('updated_at')]
+        self.max_updated_at = max(updated) if updated else None
+        self.loaded_at = time.time()
+        self.index_of = {o['id']: i for i, o in enumerate(self.outlets)}
+        # 按快照顺序（即 ID 升序）排列的店铺 ID，用于键集分页
+        self.ids = [o['id'] for o in self.outlets]
+        # 营业时间索引随快照一起构建
+        self.time_index = TimeIndex(self.outlets)
+        self.open_bitmap, self.open_bitmap_updates = self._build_open_bitmap(previous)
+        # 位置文本的三元组倒排索引
+        self.text_index = TextIndex(self.outlets)
+        # 地名词典（含快照中的城市）
+        self.gazetteer = Gazetteer(self.outlets)
+        # 坐标的 KD 树索引，用于最近邻和半径查询
+        self.spatial_index = SpatialIndex(self.outlets)
+        # 按快照下标存放的弧度坐标数组，用于向量化距离计算
+        self.coordinates = OutletCoordinates(self.outlets)
+        # 覆盖范围相交图只在坐标变化时重新计算
+        self._coverage = {}
+        if previous is not None and previous.coverage.key == coordinate_key(self.coordinates):
+            self.coverage = previous.coverage
+        else:
+            self.coverage = CoverageGraph(self.coordinates)
+        self._coverage[COVERAGE_RADIUS_KM] = self.coverage
+        # 全部字段的每行预编码 JSON 片段，第一次需要时构建
+        self._encoded = None
+        # 其他字段组合的全表片段（只由返回全表的 /outlets 构建），按最近使用淘汰
+        self._encoded_fields = OrderedDict()
+        self._encoded_lock = threading.Lock()
+
+    def _build_open_bitmap(self, previous):
+        """店铺列表与上一个快照一致时只重算营业时间变化的店铺，否则整表构建"""
+        if previous is not None and [o['id'] for o in previous.outlets] == [o['id'] for o in self.outlets]:
+            changed = [i for i, (old, new) in enumerate(zip(previous.outlets, self.outlets))
+                       if any(old.get(f) != new.get(f) for f in _HOURS_FIELDS)]
+            if len(changed) * 4 <= len(self.outlets):
+                bitmap = previous.open_bitmap.copy(self.time_index)
+                for i in changed:
+                    bitmap.update(i)
+                return bitmap, len(changed)
+        return OpenBitmap(self.time_index), None
+
+    def __len__(self):
+        return len(self.outlets)
+
+    def get(self, outlet_id):
+        """按 ID 取一行的可修改副本"""
+        outlet = self.by_id.get(outlet_id)
+        return dict(outlet) if outlet is not None else None
+
+    def rows(self, outlets=None):
+        """返回行的可修改副本列表（默认全部行）"""
+        return [dict(o) for o in (self.outlets if outlets is None else outlets)]
+
+    def rows_at(self, indexes):
+        """按快照下标返回行的可修改副本"""
+        return [dict(self.outlets[i]) for i in indexes]
+
+    def encoded_rows(self, fields=None):
+        """全部行的预编码 JSON 片段（按快照顺序）
+
+        fields 为字段集合时片段只包含这些列（见 projection.parse_fields）。全部字段的片段在本快照内只编码一次，
+        其他字段组合最多缓存 OUTLET_FIELDS_CACHE_SIZE 种，超出时淘汰最久未使用的一种。
+        """
+        if fields is None:
+            if self._encoded is None:
+                self._encoded = tuple(encode_row(o) for o in self.outlets)
+            return self._encoded
+        encoded = self._cached_fields(fields)
+        if encoded is None:
+            encoded = tuple(encode_row(project_row(o, fields)) for o in self.outlets)
+            with self._encoded_lock:
+                self._encoded_fields[fields] = encoded
+                while len(self._encoded_fields) > OUTLET_FIELDS_CACHE_SIZE:
+                    self._encoded_fields.popitem(last=False)
+        return encoded
+
+    def _cached_fields(self, fields):
+        """已缓存的字段组合片段，没有时返回 None（不构建）"""
+        with self._encoded_lock:
+            encoded = self._encoded_fields.get(fields)
+            if encoded is not None:
+                self._encoded_fields.move_to_end(fields)
+            return encoded
+
+    def encoded_range(self, start, stop, fields=None):
+        """快照下标 [start, stop) 的行的预编码片段；字段组合没有缓存时只编码这一段，不构建全表片段"""
+        encoded = self.encoded_rows() if fields is None else self._cached_fields(fields)
+        if encoded is not None:
+            return encoded[start:stop]
+        return [encode_row(project_row(o, fields)) for o in self.outlets[start:stop]]
+
+    def encode_rows(self, rows, fields=None):
+        """把行列表中与快照内容完全一致的行替换为预编码片段，fields 不为 None 时只保留这些列
+
+        调用方添加或修改了字段的行（例如带 distance 的结果）只做列裁剪，由编码器现场编码。
+        字段组合没有缓存时所有行都只做列裁剪：只处理要返回的行，不为几行结果编码整个快照。
+        """
+        encoded = self.encoded_rows() if fields is None else self._cached_fields(fields)
+        if encoded is None:
+            return [project_row(row, fields) if isinstance(row, dict) else row for row in rows]
+        result = []
+        for row in rows:
+            i = self.index_of.get(row.get('id')) if isinstance(row, dict) else None
+            if i is not None and row == self.outlets[i]:
+                result.append(encoded[i])
+            else:
+                result.append(project_row(row, fields) if isinstance(row, dict) else row)
+        return result
+
+    def coverage_for(self, radius_km):
+        """指定半径的覆盖图，非默认半径按需计算并在本快照内缓存"""
+        coverage = self._coverage.get(radius_km)
+        if coverage is None:
+            if len(self._coverage) >= 8:
+                # 只保留默认半径，丢弃其余缓存
+                self._coverage = {COVERAGE_RADIUS_KM: self.coverage}
+            coverage = self._coverage[radius_km] = CoverageGraph(self.coordinates, radius_km)
+        return coverage
+
+    def mask_of(self, outlet_ids):
+        """把店铺 ID 集合转换为快照下标位图"""
+        mask = 0
+        for outlet_id in outlet_ids:
+            i = self.index_of.get(outlet_id)
+            if i is not None:
+                mask |= 1 << i
+        return mask
+
+
+def _load_rows():
+    """从数据库读取全表（按 id 排序，保证快照顺序稳定）"""
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT * FROM subway_outlets ORDER BY id")
+            return [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+class SnapshotUnavailable(Exception):
+    """门店快照尚未加载（首次加载失败或仍在进行中）"""
+
+
+class OutletStore:
+    """进程内门店数据快照：启动时加载一次，按间隔或手动原子刷新"""
+
+    def __init__(self, refresh_interval=OUTLET_REFRESH_INTERVAL, loader=_load_rows):
+        self.refresh_interval = refresh_interval
+        self._loader = loader
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._load_lock = threading.Lock()
+        self._loading = False
+        self._last_load_attempt = 0.0
+        self._stats = {
+            "refreshes": 0,
+            "refresh_failures": 0,
+            "version_changes": 0,
+            "last_refresh_ms": None,
+            "open_bitmap_full_builds": 0,
+            "open_bitmap_incremental_updates": 0,
+        }
+
+    def snapshot(self):
+        """当前快照，在 pinned() 内返回固定的快照
+
+        尚未加载时不在调用方（通常是事件循环）里同步访问数据库，而是在后台线程重试加载，
+        并抛出 SnapshotUnavailable。
+        """
+        # 空快照的 len() 为 0，必须用 is None 判断，否则固定的空快照会被忽略
+        snapshot = _pinned_snapshot.get()
+        if snapshot is None:
+            snapshot = self._snapshot
+        if snapshot is None:
+            self._load_in_background()
+            raise SnapshotUnavailable("Outlet data is not loaded yet")
+        return snapshot
+
+    def _load_in_background(self):
+        """在后台线程加载快照；同一时刻只有一次加载，失败后至少间隔 OUTLET_LOAD_RETRY_SECONDS 再试"""
+        with self._load_lock:
+            now = time.monotonic()
+            if self._loading or now - self._last_load_attempt < OUTLET_LOAD_RETRY_SECONDS:
+                return
+            self._loading = True
+            self._last_load_attempt = now
+        threading.Thread(target=self._initial_load, name="outlet-store-load", daemon=True).start()
+
+    def _initial_load(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"⚠️ 加载门店快照失败，{OUTLET_LOAD_RETRY_SECONDS:g} 秒后的请求会再次尝试: {e}")
+        finally:
+            self._loading = False
+
+    @contextlib.contextmanager
+    def pinned(self, snapshot=None):
+        """在此上下文内（含其中创建的任务）snapshot() 始终返回同一个快照，期间的刷新不影响它"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        token = _pinned_snapshot.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            _pinned_snapshot.reset(token)
+
+    def refresh(self):
+        """重新加载全表并原子替换快照，数据未变化时保留旧快照（不构建任何索引）"""
+        with self._refresh_lock:
+            start = time.perf_counter()
+            try:
+                rows = self._loader()
+            except Exception:
+                self._stats["refresh_failures"] += 1
+                raise
+            current = self._snapshot
+            version = _compute_version(dict(r) for r in rows)
+            if current is not None and version == current.version:
+                current.loaded_at = time.time()
+            else:
+                new_snapshot = OutletSnapshot(rows, previous=current, version=version)
+                # 引用赋值是原子的，读者要么看到旧快照要么看到新快照
+                self._snapshot = new_snapshot
+                self._stats["version_changes"] += 1
+                if new_snapshot.open_bitmap_updates is None:
+                    self._stats["open_bitmap_full_builds"] += 1
+                else:
+                    self._stats["open_bitmap_incremental_updates"] += new_snapshot.open_bitmap_updates
+                print(f"✅ 门店快照已更新: {len(new_snapshot)} 家店铺, 版本 {new_snapshot.version}")
+            self._stats["refreshes"] += 1
+            self._stats["last_refresh_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            return self._snapshot
+
+    def start(self):
+        """启动后台定时刷新线程"""
+        if self.refresh_interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outlet-store-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台刷新线程"""
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ 刷新门店快照失败，继续使用旧快照: {e}")
+
+    def stats(self):
+        """快照指标：版本、行数、刷新次数与耗时"""
+        snapshot = self._snapshot
+        stats = dict(self._stats)
+        stats["version"] = snapshot.version if snapshot is not None else None
+        stats["outlets"] = len(snapshot) if snapshot is not None else 0
+        stats["loaded_at"] = snapshot.loaded_at if snapshot is not None else None
+        stats["refresh_interval"] = self.refresh_interval
+        return stats
+
+
+# 进程级门店快照
+outlet_store = OutletStore()
+
+
+class SnapshotMiddleware:
+    """每个 HTTP 请求固定使用同一个快照（ASGI）；快照尚未加载时直接返回 503，不执行处理器
+
+    放在 CORS 中间件内层、ETag 和预压缩中间件外层，内层的中间件和处理器调用 snapshot() 都得到这个快照。
+    """
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store or outlet_store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in _SNAPSHOT_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        try:
+            snapshot = self.store.snapshot()
+        except SnapshotUnavailable as e:
+            body = dumps({"detail": str(e)})
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(body)).encode("latin-1")),
+                                    (b"retry-after", str(max(1, round(OUTLET_LOAD_RETRY_SECONDS))).encode("latin-1"))]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        with self.store.pinned(snapshot):
+            await self.app(scope, receive, send)
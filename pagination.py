@@ -0,0 +1,59 @@
+import bisect
+import os
+from operator import itemgetter
+from typing import Optional
+
+from fastapi import Query
+
+# 每页最多返回多少家店铺
+OUTLET_PAGE_MAX_LIMIT = int(os.getenv("OUTLET_PAGE_MAX_LIMIT", "500"))
+
+_by_id = itemgetter('id')
+
+
+class Page:
+    """列表接口的键集分页参数（作为 FastAPI 依赖使用）
+
+    分页时结果按店铺 ID 升序排列，after_id 为上一页最后一家店的 ID（即上一页返回的 next_after_id），
+    因此翻页期间数据刷新也不会重复或跳过店铺。三个参数都未提供时保持原来的完整结果和顺序。
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=OUTLET_PAGE_MAX_LIMIT, description="每页条数"),
+        after_id: Optional[int] = Query(None, ge=0, description="从该店铺 ID 之后开始（上一页的 next_after_id）"),
+        include_total: bool = Query(False, description="是否返回匹配的总数"),
+    ):
+        self.limit = limit
+        self.after_id = after_id
+        self.include_total = include_total
+
+    @property
+    def requested(self):
+        return self.limit is not None or self.after_id is not None or self.include_total
+
+    def window(self, ids):
+        """在升序的 ID 列表上定位本页的 [start, stop) 下标范围"""
+        start = 0 if self.after_id is None else bisect.bisect_right(ids, self.after_id)
+        stop = len(ids) if self.limit is None else min(start + self.limit, len(ids))
+        return start, stop
+
+    def info(self, ids, start, stop):
+        """分页信息：还有下一页时给出 next_after_id；总数取自内存中的匹配结果，不需要额外的 COUNT 查询"""
+        info = {
+            "limit": self.limit,
+            "after_id": self.after_id,
+            "next_after_id": ids[stop - 1] if start < stop < len(ids) else None,
+        }
+        if self.include_total:
+            info["total"] = len(ids)
+        return info
+
+    def apply(self, content):
+        """对响应中的 outlets 列表分页并附上 page 信息；未请求分页时原样返回"""
+        if not self.requested:
+            return content
+        rows = sorted(content.get("outlets") or [], key=_by_id)
+        ids = [row['id'] for row in rows]
+        start, stop = self.window(ids)
+        return dict(content, outlets=rows[start:stop], page=self.info(ids, start, stop))
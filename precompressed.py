@@ -0,0 +1,172 @@
+import asyncio
+import gzip
+import os
+import threading
+
+from starlette.datastructures import Headers
+
+from outlet_store import outlet_store
+from singleflight import SingleFlight
+
+try:
+    import brotli
+except ImportError:  # 没有安装 brotli 时只提供 gzip
+    brotli = None
+    print("⚠️ 未安装 brotli，预压缩缓存只提供 gzip")
+
+# 响应只取决于门店数据的接口：每个快照版本渲染一次，预先压缩后保存在内存中
+PRECOMPRESSED_PATHS = frozenset({
+    "/outlets",
+    "/api/outlets/24hours",
+    "/api/outlets/earliest",
+    "/api/outlets/latest",
+})
+# 每个快照只压缩一次，因此使用最高压缩级别
+PRECOMPRESS_GZIP_LEVEL = int(os.getenv("PRECOMPRESS_GZIP_LEVEL", "9"))
+PRECOMPRESS_BROTLI_QUALITY = int(os.getenv("PRECOMPRESS_BROTLI_QUALITY", "11"))
+
+# 客户端同时接受多种编码时的优先顺序
+_PREFERENCE = ("br", "gzip") if brotli else ("gzip",)
+
+_entries = {}  # 路径 -> 最新快照版本的 PrecompressedEntry
+_flight = SingleFlight("precompressed")
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "bytes_identity": 0, "bytes_sent": 0,
+          "encodings": {"br": 0, "gzip": 0, "identity": 0}}
+
+
+def cacheable(scope):
+    """是否由预压缩缓存处理：上述接口的不带查询参数的 GET 请求"""
+    return scope["method"] == "GET" and scope["path"] in PRECOMPRESSED_PATHS and not scope["query_string"]
+
+
+def applied_encoding(path, version, encoding):
+    """按 encoding 请求时实际发送的编码（压缩后没有变小时为 identity）；该版本尚未渲染时返回 None"""
+    entry = _entries.get(path)
+    if entry is None or entry.version != version:
+        return None
+    return entry.variant(encoding)[0]
+
+
+def choose_encoding(accept_encoding):
+    """按 Accept-Encoding（含 q 值和 *）选择编码：br、gzip 或 identity"""
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding] = q
+    for coding in _PREFERENCE:
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return "identity"
+
+
+class PrecompressedEntry:
+    """某个接口在某个快照版本下的响应体：原文和各压缩版本"""
+
+    def __init__(self, version, content_type, body):
+        self.version = version
+        self.content_type = content_type
+        self.bodies = {"identity": body}
+        candidates = {"gzip": gzip.compress(body, compresslevel=PRECOMPRESS_GZIP_LEVEL, mtime=0)}
+        if brotli:
+            candidates["br"] = brotli.compress(body, quality=PRECOMPRESS_BROTLI_QUALITY)
+        for coding, compressed in candidates.items():
+            # 压缩后没有变小（例如空结果）就不保存，直接返回原文
+            if len(compressed) < len(body):
+                self.bodies[coding] = compressed
+
+    def variant(self, encoding):
+        """返回 (实际编码, 响应体)，该编码没有更小的版本时退回原文"""
+        if encoding in self.bodies:
+            return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
+
+    def sizes(self):
+        return {coding: len(body) for coding, body in self.bodies.items()}
+
+
+class PrecompressedMiddleware:
+    """静态门店接口的预压缩响应缓存（ASGI）
+
+    缓存未命中时调用处理器渲染一次，并发的未命中合并为一次渲染，
+    压缩在线程池中完成；命中时按 Accept-Encoding 直接发送保存好的字节，
+    不执行处理器，也没有任何编码或压缩工作。快照版本变化后下一次请求重新渲染。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not cacheable(scope):
+            await self.app(scope, receive, send)
+            return
+
+        with outlet_store.pinned() as snapshot:
+            path = scope["path"]
+            entry = _entries.get(path)
+            hit = entry is not None and entry.version == snapshot.version
+            if not hit:
+                entry = await _flight.do((path, snapshot.version), self._render, scope, receive, snapshot.version)
+            if not isinstance(entry, PrecompressedEntry):
+                # 非 200 的响应（例如加载快照失败）原样返回，不缓存
+                start, body = entry
+                with _lock:
+                    _stats["bypassed"] += 1
+                await send(dict(start, headers=list(start["headers"])))  # 外层中间件会修改头部，每个等待者发送一份副本
+                await send({"type": "http.response.body", "body": body})
+                return
+
+            encoding, body = entry.variant(choose_encoding(Headers(scope=scope).get("accept-encoding")))
+            headers = [(b"content-type", entry.content_type), (b"content-length", str(len(body)).encode("latin-1")),
+                       (b"vary", b"Accept-Encoding")]
+            if encoding != "identity":
+                headers.append((b"content-encoding", encoding.encode("latin-1")))
+            with _lock:
+                _stats["hits" if hit else "misses"] += 1
+                _stats["encodings"][encoding] += 1
+                _stats["bytes_identity"] += len(entry.bodies["identity"])
+                _stats["bytes_sent"] += len(body)
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+
+    async def _render(self, scope, receive, version):
+        """调用处理器渲染一次响应，200 的响应压缩后存入缓存"""
+        messages = {"start": None, "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                messages["start"] = message
+            elif message["type"] == "http.response.body":
+                messages["body"].append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+        start, body = messages["start"], b"".join(messages["body"])
+        headers = Headers(raw=start["headers"])
+        if start["status"] != 200 or "content-encoding" in headers:
+            return start, body
+        content_type = headers.get("content-type", "application/json").encode("latin-1")
+        entry = await asyncio.to_thread(PrecompressedEntry, version, content_type, body)
+        _entries[scope["path"]] = entry
+        return entry
+
+
+def stats():
+    """命中率、各编码的响应次数、节省的字节数以及当前缓存的各版本大小"""
+    with _lock:
+        result = dict(_stats, encodings=dict(_stats["encodings"]))
+    served = result["hits"] + result["misses"]
+    result["hit_rate"] = round(result["hits"] / served, 4) if served else 0.0
+    result["bytes_saved"] = result["bytes_identity"] - result["bytes_sent"]
+    result["entries"] = {path: {"version": entry.version, "bytes": entry.sizes()}
+                         for path, entry in list(_entries.items())}
+    result["single_flight"] = _flight.stats()
+    return result
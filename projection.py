@@ -0,0 +1,45 @@
+from typing import Optional
+
+from fastapi import HTTPException, Query
+
+# subway_outlets 表的列（见 schema.sql），fields 参数只能从中选择
+OUTLET_COLUMNS = (
+    "id", "name", "address", "operating_hours", "latitude", "longitude", "waze_link", "google_maps_link",
+    "street_address", "district", "city", "postcode", "postcode_int", "opening_hours", "is_24hours",
+    "created_at", "updated_at",
+)
+_COLUMN_SET = frozenset(OUTLET_COLUMNS)
+
+
+def parse_fields(text):
+    """解析逗号分隔的字段列表，返回字段集合（始终包含 id）；为空时返回 None 表示全部字段
+
+    出现未知字段时抛出 ValueError。
+    """
+    if not text:
+        return None
+    names = {name.strip().lower() for name in text.split(",") if name.strip()}
+    if not names:
+        return None
+    unknown = names - _COLUMN_SET
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Available: {', '.join(OUTLET_COLUMNS)}")
+    return frozenset(names | {"id"})
+
+
+def project_row(row, fields):
+    """只保留请求的列；端点计算出的附加字段（如 distance、opening_time）不是表的列，始终保留"""
+    if fields is None:
+        return row
+    return {key: value for key, value in row.items() if key in fields or key not in _COLUMN_SET}
+
+
+class Fields:
+    """门店接口的稀疏字段参数（作为 FastAPI 依赖使用），例如 ?fields=id,name,latitude,longitude"""
+
+    def __init__(self, fields: Optional[str] = Query(
+            None, description="逗号分隔的返回字段，默认返回全部字段；id 始终返回")):
+        try:
+            self.names = parse_fields(fields)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
@@ -0,0 +1,488 @@
+import contextlib
+import re
+import time
+from datetime import datetime
+
+from gazetteer import AREA_KEYWORDS, postcode_ranges
+from intent_signature import TIME_PATTERN
+from spatial_index import parse_coordinates
+from text_index import merge_scores, ranked_indexes
+from time_index import MINUTES_PER_DAY, days_for, iter_bits
+
+# 位置匹配最多保留的店铺数（邮编和邮编地区精确匹配不受限制）
+LOCATION_RESULT_LIMIT = 20
+# 最近店铺查询返回的数量
+NEAREST_LIMIT = 5
+
+AGGREGATES = ("earliest_opening", "latest_opening", "earliest_closing", "latest_closing")
+AGGREGATE_DISPLAY = {
+    "earliest_opening": ("open earliest", "opens earliest"),
+    "latest_opening": ("open latest", "opens latest"),
+    "earliest_closing": ("close earliest", "closes earliest"),
+    "latest_closing": ("close latest", "closes latest"),
+}
+
+# 带时间条件的意图，以及各自默认的事件（开门 / 关门 / 营业中）
+_TIME_ACTIONS = {
+    "opening_time_query": "open",
+    "closing_time_query": "close",
+    "still_open_after": "operating",
+    "time_query": "operating",
+    "compound_query": None,  # 从时间条件文本中判断
+}
+
+_BEFORE_WORDS = re.compile(r'\b(?:before|earlier|prior)\b')
+_AFTER_WORDS = re.compile(r'\b(?:after|past|later)\b')
+_NOW_WORDS = re.compile(r'\b(?:now|currently|current)\b')
+
+
+def is_now(text):
+    """时间条件是否指"现在"（与 parse_time_condition 使用同一组词）"""
+    return bool(_NOW_WORDS.search((text or "").lower()))
+
+
+def match_location(snapshot, location_query, limit=LOCATION_RESULT_LIMIT):
+    """在快照的三元组倒排索引上匹配位置，返回按相关度排序的快照下标
+
+    依次尝试：邮编精确匹配、邮编地区（邮编范围 + 地区名）、城市/区域/地址/店名、
+    较长单词的部分匹配、模糊邮编、前缀相似、地区关键词；前面的策略命中即停止。
+    limit 为 None 时返回全部匹配（分页接口需要完整的结果和总数）。
+    """
+    index = snapshot.text_index
+
+    # 尝试直接邮编匹配
+    if location_query.isdigit() and len(location_query) == 5:
+        print(f"尝试邮编精确匹配: {location_query}")
+        postcode = int(location_query)
+        scores = index.search([location_query], ('address',), postcode_ranges=[(postcode, postcode)])
+        if scores:
+            print(f"邮编匹配成功，找到 {len(scores)} 个结果")
+            return ranked_indexes(scores)
+
+    # 检查输入是否匹配邮编地区名称或名称的一部分（地名词典）
+    matched_areas = snapshot.gazetteer.postcode_areas(location_query)
+
+    # 如果匹配到地区名称，查询该地区所有邮编范围内的店铺
+    if matched_areas:
+        area_scores = []
+        for area, postcodes in matched_areas:
+            print(f"匹配到地区: {area}, 邮编范围: {postcodes}")
+            # 邮编落在地区的邮编范围内（整数二分） + 地区名称出现在城市/区域/地址/店名中
+            area_scores.append(index.search([area], ('city', 'district', 'address', 'name'),
+                                            postcode_ranges=postcode_ranges(postcodes)))
+        scores = merge_scores(*area_scores)
+        if scores:
+            print(f"通过邮编范围匹配成功，找到 {len(scores)} 个结果")
+            return ranked_indexes(scores)
+
+    # 多种匹配条件：城市、区域、完整地址、街道、店名
+    scores = index.search([location_query], ('city', 'district', 'address', 'street_address', 'name'))
+
+    # 如果没找到，尝试更模糊的搜索
+    if not scores:
+        fuzzy_fields = ('address', 'name', 'city', 'district')
+        # 1. 尝试部分匹配，只使用较长的词以避免匹配太多无关项
+        words = location_query.split()
+        if len(words) > 1:
+            long_words = [word for word in words if len(word) > 3]
+            scores = index.search(long_words, fuzzy_fields)
+            if scores:
+                print(f"找到部分匹配: {long_words}")
+
+        # 2. 尝试处理邮编格式（处理不同长度的邮编）
+        if location_query.isdigit() and 4 <= len(location_query) <= 6:
+            padded_postcode = location_query.zfill(5)  # 将邮编填充到5位数
+            postcode = int(padded_postcode)
+            postcode_scores = index.search([padded_postcode], ('address',), postcode_ranges=[(postcode, postcode)])
+            if postcode_scores:
+                print(f"邮编模糊匹配成功: {padded_postcode}")
+                scores = merge_scores(scores, postcode_scores)
+
+        # 3. 尝试同音字或拼写相似的单词
+        if not scores and len(location_query) > 3:
+            # 例如：Bangsar, Bandar, Bangi - 开头相似
+            prefix = location_query[:3]
+            scores = index.search([prefix], fuzzy_fields)
+            if scores:
+                print(f"找到相似匹配: {prefix}")
+
+        # 4. 尝试使用特定键值对查询
+        if not scores:
+            # 查找名称或关键词出现在查询中的地区
+            matched_areas = snapshot.gazetteer.keyword_areas(location_query)
+
+            # 查询匹配地区的店铺
+            scores = merge_scores(*(index.search(AREA_KEYWORDS[area], fuzzy_fields) for area in matched_areas))
+            if scores:
+                print(f"找到特定关键词匹配: {matched_areas}")
+
+    # 限制最大结果数，避免返回太多
+    return ranked_indexes(scores, limit)
+
+
+def is_24hours(outlet):
+    """is_24hours 标记，或营业时间文本中写明 24 小时（'24hr' 同时覆盖了 '24hrs'）"""
+    return bool(outlet.get('is_24hours')) or any(
+        kw in (outlet.get('operating_hours') or '').lower() for kw in ('24 hours', '24hr'))
+
+
+def is_weekend_query(query, now=None):
+    """查询中写明周末/工作日时按写明的判断，否则按当天判断"""
+    text = (query or "").lower()
+    if "weekend" in text or "周末" in text:
+        return True
+    if "weekday" in text or "工作日" in text:
+        return False
+    return (now or datetime.now()).weekday() >= 5
+
+
+def parse_time_condition(text, event=None, now=None):
+    """把 "close before 9pm" / "after 10:30pm" / "now" 之类的时间条件解析为 (事件, 比较符, 分钟数, 显示文本)
+
+    事件为 open（开门）、close（关门）或 operating（营业中）；未给出 event 时从文本判断：
+    "still open" 或 "open ... after" 视为营业中，只有 "before" 视为关门。比较符为 before/after/at。
+    无法解析出时间时返回 None。
+    """
+    text = (text or "").lower()
+    if _NOW_WORDS.search(text):
+        now = now or datetime.now()
+        return "operating", "now", now.hour * 60 + now.minute, "now"
+
+    comparator = "before" if _BEFORE_WORDS.search(text) else "after" if _AFTER_WORDS.search(text) else "at"
+    if event is None:
+        is_open = "open" in text
+        if "clos" in text:
+            event = "close"
+        elif is_open and comparator == "before":
+            event = "open"
+        elif is_open or comparator != "before":
+            event = "operating"
+        else:
+            event = "close"
+
+    match = TIME_PATTERN.search(text)
+    if match:
+        hour, minute = int(match.group(1)), int(match.group(2) or 0)
+        ampm = match.group(3)
+        if hour > 24 or minute > 59 or (ampm and not 1 <= hour <= 12):
+            return None
+        if ampm:
+            if ampm.startswith('p') and hour < 12:
+                hour += 12
+            elif ampm.startswith('a') and hour == 12:
+                hour = 0
+        elif hour <= 12 and (re.search(r'evening|night', text) or (event == "close" and hour >= 7)):
+            # 没有 am/pm 时：晚上的说法按下午计；关门时间 7 点以后默认是晚上
+            hour += 12
+        display = match.group(0).strip()
+    elif "midnight" in text:
+        hour, minute, display = (24 if event == "close" else 0), 0, "midnight"
+    elif re.search(r'\b(?:noon|midday)\b', text):
+        hour, minute, display = 12, 0, "noon"
+    else:
+        return None
+    return event, comparator, hour * 60 + minute, display
+
+
+class QueryPlan:
+    """一次聊天查询的执行计划：位置谓词、时间谓词、聚合（最早/最晚）和空间排序
+
+    由解析出的意图一次性确定，执行时在快照索引上逐级缩小候选集合，不再重复解析查询文本。
+    """
+
+    def __init__(self, action, answer="", is_weekend=False):
+        self.action = action
+        self.answer = answer  # 意图自带的回答，无需查询时直接使用
+        self.is_weekend = is_weekend
+        self.location = None  # 位置谓词（过滤）
+        self.time = None  # (事件, 比较符, 分钟数, 显示文本)
+        self.always_open = False  # 只要24小时营业的店铺
+        self.aggregate = None  # AGGREGATES 之一
+        self.near = None  # 空间排序的中心：(纬度, 经度) 或 位置名
+        self.limit = None
+        self.missing = None  # 缺少的必要条件（"location" / "time"），此时不执行查询
+
+    @property
+    def day_type(self):
+        return "weekend" if self.is_weekend else "weekday"
+
+    def describe(self):
+        """计划的可读形式，用于 explain"""
+        plan = {"action": self.action, "day_type": self.day_type}
+        if self.location:
+            plan["location"] = self.location
+        if self.time:
+            event, comparator, minute, display = self.time
+            plan["time"] = {"event": event, "comparator": comparator,
+                            "minute_of_day": minute, "text": display}
+        if self.always_open:
+            plan["always_open"] = True
+        if self.aggregate:
+            plan["aggregate"] = self.aggregate
+        if self.near is not None:
+            plan["near"] = self.near if isinstance(self.near, str) else list(self.near)
+            plan["limit"] = self.limit
+        if self.missing:
+            plan["missing"] = self.missing
+        return plan
+
+
+def build_plan(intent, query, lat=None, lon=None, now=None):
+    """把意图（intent_parser / LLM 的 JSON）转换为 QueryPlan"""
+    action = intent.get("action") or ""
+    plan = QueryPlan(action, intent.get("answer") or "", is_weekend_query(query, now))
+    location = (intent.get("location") or "").strip() or None
+    attribute = intent.get("attribute")
+
+    if action == "search_location":
+        plan.location = location
+        plan.missing = None if location else "location"
+    elif action == "get_nearest":
+        # 用户提供了坐标时优先使用坐标
+        plan.near = (lat, lon) if lat and lon else location
+        plan.limit = NEAREST_LIMIT
+        plan.missing = None if plan.near else "location"
+    elif action in _TIME_ACTIONS:
+        plan.location = location
+        time_text = intent.get("time") or ""
+        if location:
+            # 时间条件里可能混入了位置（"close before 9pm in bangsar"）
+            time_text = re.sub(re.escape(location.lower()), " ", time_text.lower())
+        plan.time = parse_time_condition(time_text, _TIME_ACTIONS[action], now)
+        if plan.time is None and not location:
+            plan.missing = "time"
+    elif action == "get_attribute" and attribute == "24hours":
+        plan.always_open = True
+        plan.location = location
+    elif action in ("get_attribute", "special_time_location"):
+        plan.location = location if action == "special_time_location" else None
+        if attribute in AGGREGATES:
+            plan.aggregate = attribute
+        else:
+            plan.missing = "attribute"
+        if action == "special_time_location" and not location:
+            plan.missing = "location"
+    return plan
+
+
+class PlanResult:
+    """执行结果：命中的快照下标（有序）及各阶段的耗时和剩余行数"""
+
+    def __init__(self, plan, snapshot):
+        self.plan = plan
+        self.snapshot = snapshot
+        self.indexes = []
+        self.extreme_minute = None  # 聚合得到的最早/最晚时间
+        self.distances = None
+        self.center = []
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        info = {"stage": name}
+        yield info
+        info["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        self.stages.append(info)
+
+    @property
+    def outlets(self):
+        """命中店铺的只读行（不复制）"""
+        return [self.snapshot.outlets[i] for i in self.indexes]
+
+
+def _location_centroid(snapshot, indexes):
+    coords = [c for c in (parse_coordinates(snapshot.outlets[i]) for i in indexes) if c]
+    if not coords:
+        return None
+    return sum(c[0] for c in coords) / len(coords), sum(c[1] for c in coords) / len(coords)
+
+
+def _time_matches(snapshot, condition, days):
+    """时间谓词在营业时间索引上的结果，返回 (下标集合, 是否把24小时店铺排在最前)"""
+    event, comparator, minute, _ = condition
+    index = snapshot.time_index
+    if event == "operating":
+        if comparator in ("now", "at"):
+            # "营业中"位图已包含24小时店铺
+            return set(iter_bits(snapshot.open_bitmap.open_at(minute, days))), True
+        if comparator == "after":
+            matched = index.open_after(minute, days)
+        else:
+            matched = index.opens_before(minute, days, inclusive=True)
+        return matched | set(index.always_open), True
+    if event == "open":
+        if comparator == "before":
+            return index.opens_before(minute, days), False
+        if comparator == "after":
+            return index.opens_after(minute, days), False
+        return index.opens_near(minute, days, 30), False
+    if comparator == "before":
+        return index.closes_before(minute, days), False
+    if comparator == "after":
+        return index.closes_after(minute, days), False
+    return index.closes_near(minute, days, 30), False
+
+
+def execute_plan(plan, snapshot):
+    """在一个快照上按 位置 → 24小时 → 时间 → 聚合 → 空间排序 的顺序执行计划
+
+    每个阶段只在上一阶段留下的候选下标上计算；没有位置谓词时候选为全部店铺。
+    结果顺序：有时间谓词时按时间索引的顺序（营业中类查询24小时店铺在前），
+    只有位置时按相关度，聚合和空间排序按各自的结果顺序。
+    """
+    result = PlanResult(plan, snapshot)
+    if plan.missing:
+        return result
+    days = days_for(plan.is_weekend)
+    candidates = None  # None 表示全部店铺
+    order = None
+
+    if plan.location:
+        with result.stage("location") as info:
+            order = match_location(snapshot, plan.location)
+            candidates = set(order)
+            info["rows"] = len(order)
+
+    if plan.always_open:
+        with result.stage("always_open") as info:
+            order = [i for i, o in enumerate(snapshot.outlets)
+                     if (candidates is None or i in candidates) and is_24hours(o)]
+            candidates = set(order)
+            info["rows"] = len(order)
+
+    if plan.time:
+        with result.stage("time") as info:
+            matched, always_open_first = _time_matches(snapshot, plan.time, days)
+            if candidates is not None:
+                matched &= candidates
+            if always_open_first:
+                first = [i for i in snapshot.time_index.always_open if i in matched]
+                order = first + sorted(matched.difference(first))
+            else:
+                order = sorted(matched)
+            candidates = matched
+            info["rows"] = len(order)
+
+    if plan.aggregate:
+        with result.stage("aggregate") as info:
+            index = snapshot.time_index
+            aggregate = getattr(index, plan.aggregate)
+            order, result.extreme_minute = aggregate(days, candidates)
+            candidates = set(order)
+            info["rows"] = len(order)
+
+    if plan.near is not None:
+        with result.stage("spatial") as info:
+            if isinstance(plan.near, str):
+                anchor = _location_centroid(snapshot, match_location(snapshot, plan.near))
+            else:
+                anchor = (float(plan.near[0]), float(plan.near[1]))
+            if anchor is None:
+                order = []
+            else:
+                mask = None
+                if candidates is not None:
+                    mask = 0
+                    for i in candidates:
+                        mask |= 1 << i
+                hits = snapshot.spatial_index.nearest(anchor[0], anchor[1], plan.limit, mask)
+                order = [i for _, i in hits]
+                result.distances = [float(d) for d in snapshot.coordinates.distances_from(*anchor, order)]
+                result.center = list(anchor)
+            info["rows"] = len(order)
+
+    result.indexes = order if order is not None else []
+    if not result.center:
+        centroid = _location_centroid(snapshot, result.indexes)
+        result.center = list(centroid) if centroid else []
+    return result
+
+
+def _names_preview(outlets, other="other outlets"):
+    """前三个不重复的店名，其余以 "and N other outlets" 概括"""
+    names = list(dict.fromkeys(o['name'] for o in outlets))
+    preview = ", ".join(names[:3])
+    if len(names) > 3:
+        preview += f" and {len(names) - 3} {other}"
+    return preview
+
+
+def format_answer(result):
+    """根据计划和执行结果生成回答文本"""
+    plan = result.plan
+    count = len(result.indexes)
+    location_str = f" in {plan.location}" if plan.location else ""
+    day_type = plan.day_type
+
+    if plan.missing == "location":
+        if plan.action == "get_nearest":
+            return "I need a location to find nearby outlets."
+        if plan.action == "special_time_location":
+            return ("Sorry, I couldn't determine the location you're asking about. "
+                    "Please specify a location like 'Subang' or 'KLCC'.")
+        return "I need a location to search for outlets."
+    if plan.missing == "time":
+        return "I need a time to search for outlets."
+    if plan.missing == "attribute":
+        return ("Sorry, I couldn't determine what time attribute you're asking about "
+                "(earliest/latest opening/closing). Please try a more specific query.")
+
+    if plan.near is not None:
+        if result.center == [] and isinstance(plan.near, str):
+            return f"I couldn't determine the location of {plan.near}."
+        if not count:
+            return "I couldn't find any nearby Subway outlets."
+        target = "your location" if not isinstance(plan.near, str) else plan.near
+        lines = [f"{o['name']}: {d:.1f}km" for o, d in zip(result.outlets, result.distances)]
+        return f"Here are the nearest Subway outlets to {target}:\n" + "\n".join(lines[:3])
+
+    if plan.aggregate:
+        plural, singular = AGGREGATE_DISPLAY[plan.aggregate]
+        if not count:
+            if plan.location:
+                return f"No outlets found{location_str} that {plural} on {day_type}"
+            return f"I couldn't determine which outlet {singular.replace(' ', ' the ')}."
+        minute = result.extreme_minute % MINUTES_PER_DAY
+        time_str = f"{minute // 60:02d}:{minute % 60:02d}"
+        outlets = result.outlets
+        if count == 1:
+            return f"{outlets[0]['name']} {singular}{location_str} on {day_type} at {time_str}."
+        return f"{count} outlets{location_str} {plural} on {day_type} at {time_str}. Including: {_names_preview(outlets)}"
+
+    if plan.always_open:
+        if not count:
+            return f"I couldn't find any 24-hour Subway outlets{location_str}."
+        return f"I found {count} Subway outlets{location_str} that are open 24 hours."
+
+    if plan.time:
+        event, comparator, _, display = plan.time
+        if comparator == "now":
+            condition = "currently open"
+        else:
+            phrase = f"{comparator} {display}"
+            condition = {"open": f"that open {phrase}", "close": f"that close {phrase}"}.get(
+                event, f"that are still open {phrase}" if comparator == "after" else f"that are open {phrase}")
+        if not count:
+            return f"I couldn't find any Subway outlets {condition}{location_str} on {day_type}."
+        return f"I found {count} Subway outlets {condition}{location_str} on {day_type}."
+
+    if plan.location:
+        if not count:
+            return f"I couldn't find any Subway outlets in {plan.location}."
+        return f"I found {count} Subway outlets in or near {plan.location.title()}."
+
+    return plan.answer or "I'm not sure how to help with that query."
+
+
+def plan_response(result, explain=False):
+    """聊天接口的响应：answer / related_ids / center，explain 时附带计划和各阶段耗时"""
+    response = {
+        "answer": format_answer(result),
+        "related_ids": [o['id'] for o in result.outlets],
+        "center": result.center,
+    }
+    if explain:
+        response["plan"] = result.plan.describe()
+        response["stages"] = result.stages
+    return response
@@ -18,6 +18,10 @@ CREATE TABLE IF NOT EXISTS subway_outlets (
     district VARCHAR(100),
     city VARCHAR(100),
     postcode VARCHAR(10),
+    -- 规范化后的整数邮编，由 postcode 自动生成；不是 5 位数字的邮编为 NULL
+    postcode_int INTEGER GENERATED ALWAYS AS (
+        CASE WHEN postcode ~ '^\s*[0-9]{5}\s*$' THEN substring(postcode from '[0-9]{5}')::INTEGER END
+    ) STORED,
     opening_hours JSONB,
     is_24hours BOOLEAN DEFAULT false,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -46,3 +50,5 @@ CREATE INDEX idx_subway_outlets_latitude ON subway_outlets (latitude);
 CREATE INDEX idx_subway_outlets_longitude ON subway_outlets (longitude);
 CREATE INDEX idx_subway_outlets_city ON subway_outlets (city);
 CREATE INDEX idx_subway_outlets_postcode ON subway_outlets (postcode);
+-- 邮编范围查询使用 postcode_int BETWEEN ... AND ...，不再对 postcode 做 CAST
+CREATE INDEX idx_subway_outlets_postcode_int ON subway_outlets (postcode_int);
@@ -0,0 +1,51 @@
+import asyncio
+import functools
+
+
+class SingleFlight:
+    """合并相同 key 的并发调用：同一时刻只执行一次，结果（或异常）分发给所有等待者
+
+    工作在独立的任务中执行，某个等待者断开（被取消）不会影响其他等待者。
+    所有等待者拿到的是同一个结果对象，调用方不应修改它。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> (任务, 等待者数量列表)
+        self._stats = {"executions": 0, "coalesced": 0, "max_waiters": 1}
+
+    async def do(self, key, func, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            call = self._calls[key] = (task, [1])
+            self._stats["executions"] += 1
+            task.add_done_callback(lambda _, key=key, call=call: self._finish(key, call))
+        else:
+            call[1][0] += 1
+            self._stats["coalesced"] += 1
+            self._stats["max_waiters"] = max(self._stats["max_waiters"], call[1][0])
+        return await asyncio.shield(call[0])
+
+    def _finish(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        task = call[0]
+        if not task.cancelled():
+            task.exception()  # 所有等待者都已断开时避免 "exception was never retrieved" 警告
+
+    def coalesce(self, key_func):
+        """装饰异步函数，按 key_func(参数) 合并并发调用"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await self.do(key_func(*args, **kwargs), func, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._calls)
+        calls = stats["executions"] + stats["coalesced"]
+        stats["coalesced_ratio"] = round(stats["coalesced"] / calls, 4) if calls else 0.0
+        return stats
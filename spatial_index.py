@@ -0,0 +1,118 @@
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371  # 地球半径（公里）
+
+
+def to_unit_vector(lat, lon):
+    """经纬度转换为单位球面上的三维坐标，弦长与球面距离单调对应"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    """单位球面上的弦长转换为球面距离（公里）"""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    """球面距离（公里）转换为单位球面上的弦长"""
+    return 2 * math.sin(min(math.pi, km / EARTH_RADIUS_KM) / 2)
+
+
+def parse_coordinates(outlet):
+    """取店铺的经纬度；缺失、为 0 或无法解析时返回 None"""
+    lat, lon = outlet.get('latitude'), outlet.get('longitude')
+    if not lat or not lon:
+        return None
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(lat) or math.isnan(lon):
+        return None
+    return lat, lon
+
+
+class SpatialIndex:
+    """店铺坐标的 KD 树索引
+
+    坐标先投影到单位球面的三维坐标上，在三维空间中按欧氏距离（弦长）建树，
+    弦长与球面距离单调对应，所以最近邻和半径查询的结果与按 haversine 排序一致。
+    查询可以传入快照下标位图 mask，只返回位图中为 1 的店铺（例如"当前营业"）。
+    """
+
+    def __init__(self, outlets):
+        points = []
+        for i, outlet in enumerate(outlets):
+            coords = parse_coordinates(outlet)
+            if coords is not None:
+                points.append((to_unit_vector(*coords), i))
+        self.size = len(points)
+        self._root = self._build(points, 0)
+
+    def _build(self, points, axis):
+        """按中位数切分，节点为 (坐标, 店铺下标, 切分轴, 左子树, 右子树)"""
+        if not points:
+            return None
+        points.sort(key=lambda p: p[0][axis])
+        mid = len(points) // 2
+        next_axis = (axis + 1) % 3
+        return (points[mid][0], points[mid][1], axis,
+                self._build(points[:mid], next_axis),
+                self._build(points[mid + 1:], next_axis))
+
+    def nearest(self, lat, lon, k=5, mask=None):
+        """最近的 k 家店铺，返回按距离升序的 [(距离公里, 店铺下标), ...]"""
+        if k <= 0 or self._root is None:
+            return []
+        target = to_unit_vector(lat, lon)
+        heap = []  # 大小为 k 的最大堆，元素为 (-距离平方, -下标)
+
+        def visit(node):
+            point, i, axis, left, right = node
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            if near is not None:
+                visit(near)
+            if mask is None or mask >> i & 1:
+                dist2 = _dist2(target, point)
+                item = (-dist2, -i)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            # 另一侧只有可能更近时才需要访问
+            if far is not None and (len(heap) < k or diff * diff <= -heap[0][0]):
+                visit(far)
+
+        visit(self._root)
+        return [(chord_to_km(math.sqrt(-d)), -i) for d, i in sorted(heap, reverse=True)]
+
+    def within(self, lat, lon, radius_km, mask=None):
+        """半径 radius_km 内的店铺，返回按距离升序的 [(距离公里, 店铺下标), ...]"""
+        if self._root is None:
+            return []
+        target = to_unit_vector(lat, lon)
+        limit2 = km_to_chord(radius_km) ** 2
+        found = []
+        stack = [self._root]
+        while stack:
+            point, i, axis, left, right = stack.pop()
+            diff = target[axis] - point[axis]
+            if (mask is None or mask >> i & 1):
+                dist2 = _dist2(target, point)
+                if dist2 <= limit2:
+                    found.append((dist2, i))
+            near, far = (left, right) if diff < 0 else (right, left)
+            if near is not None:
+                stack.append(near)
+            if far is not None and diff * diff <= limit2:
+                stack.append(far)
+        found.sort()
+        return [(chord_to_km(math.sqrt(d)), i) for d, i in found]
+
+
+def _dist2(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
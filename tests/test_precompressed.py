@@ -0,0 +1,193 @@
+import asyncio
+import gzip
+
+import pytest
+
+import precompressed
+from fast_json import dumps
+from outlet_store import outlet_store
+from precompressed import PrecompressedEntry, PrecompressedMiddleware, choose_encoding
+
+
+def _rows(name):
+    return [{"id": i, "name": f"Subway {name} {i}", "address": f"{i}, Jalan {name}, Kuala Lumpur"} for i in range(1, 60)]
+
+
+class Endpoint:
+    """按当前快照渲染 /outlets 的 ASGI 应用，记录渲染次数"""
+
+    def __init__(self, delay=0.0, status=200):
+        self.delay = delay
+        self.status = status
+        self.renders = 0
+
+    async def __call__(self, scope, receive, send):
+        self.renders += 1
+        await asyncio.sleep(self.delay)
+        body = dumps({"outlets": [dict(o) for o in outlet_store.snapshot().outlets]})
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def _get(app, path="/outlets", query=b"", accept_encoding=None):
+    """发送一个 GET 请求，返回 (状态码, 头部字典, 响应体)"""
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding is not None else []
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": query, "headers": headers}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start, body = messages[0], b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, body
+
+
+def _decode(headers, body):
+    encoding = headers.get("content-encoding", "identity")
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "br":
+        return precompressed.brotli.decompress(body)
+    return body
+
+
+@pytest.fixture(autouse=True)
+def store():
+    """每个测试使用新的快照和空的预压缩缓存"""
+    saved_loader, saved_snapshot = outlet_store._loader, outlet_store._snapshot
+    outlet_store._loader = lambda: _rows("Bangsar")
+    outlet_store._snapshot = None
+    outlet_store.refresh()
+    precompressed._entries.clear()
+    yield outlet_store
+    outlet_store._loader, outlet_store._snapshot = saved_loader, saved_snapshot
+    precompressed._entries.clear()
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("gzip;q=0, *;q=0.5", "br"),
+    ("*", "br"),
+    ("*;q=0", "identity"),
+    ("identity", "identity"),
+    ("deflate", "identity"),
+    ("gzip;q=abc", "identity"),
+    ("", "identity"),
+    (None, "identity"),
+])
+def test_choose_encoding(header, expected):
+    if precompressed.brotli is None and expected == "br":
+        expected = "gzip"
+    assert choose_encoding(header) == expected
+
+
+@pytest.mark.parametrize("accept_encoding", ["br", "gzip", "identity", None])
+def test_negotiated_bodies_decode_to_the_same_response(accept_encoding):
+    app = PrecompressedMiddleware(Endpoint())
+    status, headers, body = asyncio.run(_get(app, accept_encoding=accept_encoding))
+    expected = choose_encoding(accept_encoding)
+    assert status == 200
+    assert headers.get("content-encoding", "identity") == expected
+    assert headers["vary"] == "Accept-Encoding"
+    assert int(headers["content-length"]) == len(body)
+    assert _decode(headers, body) == dumps({"outlets": _rows("Bangsar")})
+
+
+def test_cache_hit_skips_the_handler(store):
+    endpoint = Endpoint()
+    app = PrecompressedMiddleware(endpoint)
+
+    async def run():
+        return [await _get(app, accept_encoding=e) for e in ("gzip", "br", "identity", "gzip")]
+
+    version = store.snapshot().version
+    assert precompressed.applied_encoding("/outlets", version, "gzip") is None
+    responses = asyncio.run(run())
+    assert endpoint.renders == 1
+    assert responses[0] == responses[3]
+    assert len({_decode(h, b) for _, h, b in responses}) == 1
+    assert precompressed.applied_encoding("/outlets", version, "gzip") == "gzip"
+
+
+def test_query_string_bypasses_the_cache():
+    endpoint = Endpoint()
+    app = PrecompressedMiddleware(endpoint)
+
+    async def run():
+        return [await _get(app, query=b"limit=5", accept_encoding="gzip") for _ in range(2)]
+
+    for status, headers, _ in asyncio.run(run()):
+        assert status == 200 and "content-encoding" not in headers
+    assert endpoint.renders == 2
+    assert precompressed._entries == {}
+
+
+def test_uncached_paths_pass_through():
+    endpoint = Endpoint()
+    app = PrecompressedMiddleware(endpoint)
+    asyncio.run(_get(app, path="/api/outlets/search", accept_encoding="gzip"))
+    asyncio.run(_get(app, path="/api/outlets/search", accept_encoding="gzip"))
+    assert endpoint.renders == 2
+
+
+def test_new_snapshot_version_renders_again(store):
+    endpoint = Endpoint()
+    app = PrecompressedMiddleware(endpoint)
+    _, headers, body = asyncio.run(_get(app, accept_encoding="gzip"))
+    old_version = store.snapshot().version
+
+    store._loader = lambda: _rows("Cheras")
+    store.refresh()
+    assert store.snapshot().version != old_version
+    _, new_headers, new_body = asyncio.run(_get(app, accept_encoding="gzip"))
+    assert endpoint.renders == 2
+    assert _decode(new_headers, new_body) == dumps({"outlets": _rows("Cheras")})
+    assert precompressed._entries["/outlets"].version == store.snapshot().version
+
+    # 数据没有变化的刷新保留快照，缓存继续命中
+    store.refresh()
+    asyncio.run(_get(app, accept_encoding="gzip"))
+    assert endpoint.renders == 2
+
+
+def test_concurrent_misses_render_once():
+    endpoint = Endpoint(delay=0.05)
+    app = PrecompressedMiddleware(endpoint)
+
+    async def run():
+        return await asyncio.gather(*(_get(app, accept_encoding=e) for e in ["gzip", "br", "identity"] * 4))
+
+    responses = asyncio.run(run())
+    assert endpoint.renders == 1
+    assert all(status == 200 for status, _, _ in responses)
+    assert len({_decode(h, b) for _, h, b in responses}) == 1
+
+
+def test_errors_are_not_cached():
+    endpoint = Endpoint(delay=0.02, status=500)
+    app = PrecompressedMiddleware(endpoint)
+
+    async def run():
+        return await asyncio.gather(*(_get(app, accept_encoding="gzip") for _ in range(3)))
+
+    responses = asyncio.run(run())
+    # 并发的等待者共用一次渲染，各自收到一份原样的错误响应
+    assert endpoint.renders == 1
+    assert [status for status, _, _ in responses] == [500] * 3
+    assert all("content-encoding" not in headers for _, headers, _ in responses)
+    assert precompressed._entries == {}
+    asyncio.run(_get(app, accept_encoding="gzip"))
+    assert endpoint.renders == 2
+
+
+def test_bodies_that_do_not_shrink_stay_identity():
+    entry = PrecompressedEntry("v1", b"application/json", b"{}")
+    assert entry.variant("gzip") == ("identity", b"{}")
+    assert entry.variant("br") == ("identity", b"{}")
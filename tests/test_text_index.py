@@ -0,0 +1,119 @@
+import pytest
+
+from gazetteer import postcode_ranges
+from text_index import FIELD_WEIGHTS, POSTCODE_WEIGHT, PostcodeIndex, TextIndex, normalize_postcode, ranked_indexes
+
+OUTLETS = [
+    {"id": 1, "name": "Subway Bangsar Village", "address": "1, Jalan Telawi 1, Bangsar, 59100 Kuala Lumpur",
+     "street_address": "Jalan Telawi 1", "district": "Bangsar", "city": "Kuala Lumpur", "postcode": "59100"},
+    {"id": 2, "name": "Subway KLCC", "address": "Lot C-12, Suria KLCC, 50088 Kuala Lumpur",
+     "street_address": "Jalan Ampang", "district": "KLCC", "city": "Kuala Lumpur", "postcode": " 50088 "},
+    {"id": 3, "name": "Subway SS2", "address": "23, Jalan SS2/24, 47300 Petaling Jaya",
+     "street_address": "Jalan SS2/24", "district": "SS2", "city": "Petaling Jaya", "postcode": "47300"},
+    {"id": 4, "name": "Subway Sunway Pyramid", "address": "Sunway Pyramid, Bandar Sunway, 47500 Subang Jaya",
+     "street_address": None, "district": "Bandar Sunway", "city": "Subang Jaya", "postcode": "47500"},
+    {"id": 5, "name": "Subway Menara", "address": "Menara Hap Seng, 50250 Kuala Lumpur",
+     "street_address": "Jalan P. Ramlee", "district": None, "city": "Kuala Lumpur", "postcode": "5025",
+     "postcode_int": 50250},
+    {"id": 6, "name": "SUBWAY ANGKASA", "address": "Angkasa Raya, 50999 KL", "street_address": "",
+     "district": "City Centre", "city": "KL", "postcode": "50999"},
+    {"id": 7, "name": "Subway Sarang", "address": "No postcode here", "street_address": "Jalan Nga Sar",
+     "district": "Kampung Baru", "city": "Kuala Lumpur", "postcode": "ABCDE"},
+    {"id": 8, "name": "Subway Edge", "address": "Jalan Pinggir, 51000 Kuala Lumpur", "street_address": None,
+     "district": None, "city": "Kuala Lumpur", "postcode": 49999},
+]
+
+ALL_FIELDS = tuple(FIELD_WEIGHTS)
+
+
+def ilike(term, fields):
+    """原来的 ILIKE '%词%' 逐行扫描：{快照下标: 命中字段的权重和}"""
+    term = term.lower()
+    scores = {}
+    if not term:
+        return scores
+    for i, outlet in enumerate(OUTLETS):
+        score = sum(FIELD_WEIGHTS[f] for f in fields if term in (outlet.get(f) or "").lower())
+        if score:
+            scores[i] = score
+    return scores
+
+
+def postcode_scan(start, end):
+    """逐行比较规范化后的邮编"""
+    matched = []
+    for i, outlet in enumerate(OUTLETS):
+        postcode = outlet.get("postcode_int")
+        if postcode is None:
+            postcode = normalize_postcode(outlet.get("postcode"))
+        if postcode is not None and start <= postcode <= end:
+            matched.append(i)
+    return sorted(matched)
+
+
+@pytest.fixture(scope="module")
+def index():
+    return TextIndex(OUTLETS)
+
+
+@pytest.mark.parametrize("term", [
+    # 少于 3 个字符：没有三元组，在全部店铺上确认
+    "a", "kl", "KL", "Jl", "2", "/", " ", "",
+    # 大小写混合
+    "BANGSAR", "bAnGsAr", "Jalan SS2", "sunway PYRAMID", "Kuala Lumpur", "subway",
+    # 三元组都存在但子串不存在（候选过滤后还要确认）
+    "sarang kampung", "nga sara", "angkasar", "jaya pyramid",
+    "59100", "500", "jalan", "xyz", "ss2/24",
+])
+@pytest.mark.parametrize("fields", [ALL_FIELDS, ("city", "district"), ("name",), ("address", "street_address")])
+def test_search_matches_linear_ilike_scan(index, term, fields):
+    assert index.search([term], fields) == ilike(term, fields)
+
+
+def test_multiple_terms_add_up(index):
+    expected = ilike("bangsar", ALL_FIELDS)
+    for i, score in ilike("kuala", ALL_FIELDS).items():
+        expected[i] = expected.get(i, 0) + score
+    assert index.search(["Bangsar", "KUALA"], ALL_FIELDS) == expected
+    assert ranked_indexes(expected)[0] == 0
+
+
+@pytest.mark.parametrize("start, end", [
+    (50000, 50999), (47000, 47999), (59100, 59100), (49999, 50000), (51000, 51000), (0, 99999), (60000, 60999),
+])
+def test_postcode_range_matches_linear_scan(start, end):
+    assert sorted(PostcodeIndex(OUTLETS).between(start, end)) == postcode_scan(start, end)
+
+
+def test_postcode_normalization():
+    postcodes = PostcodeIndex(OUTLETS)
+    # 前后空白、整数邮编、postcode_int 优先于无效的 postcode 文本
+    assert postcodes.exact("50088") == postcodes.exact(" 50088") == postcodes.exact(50088) == [1]
+    assert postcodes.exact("50250") == [4]
+    assert postcodes.exact("5025") == [] and postcodes.exact("ABCDE") == [] and postcodes.exact(None) == []
+    assert normalize_postcode(True) is None and normalize_postcode(100000) is None
+
+
+def test_ranged_postcode_area(index):
+    # 地区的邮编写成 "50000-50999" 这样的范围时按整数闭区间匹配，两端都包含
+    ranges = postcode_ranges(["50000-50999", "60000"])
+    assert ranges == [(50000, 50999), (60000, 60000)]
+    scores = index.search(["City Centre"], ("city", "district", "address", "name"), postcode_ranges=ranges)
+    expected = {i: POSTCODE_WEIGHT for i in postcode_scan(50000, 50999)}
+    for i, score in ilike("city centre", ("city", "district", "address", "name")).items():
+        expected[i] = expected.get(i, 0) + score
+    assert scores == expected
+    assert sorted(scores) == [1, 4, 5]
+
+
+def test_match_location_on_a_snapshot():
+    from outlet_store import OutletSnapshot
+    from query_planner import match_location
+
+    snapshot = OutletSnapshot(OUTLETS)
+    # 邮编精确匹配、邮编地区范围（City Centre = 50000-50999）、大小写混合的地名
+    assert match_location(snapshot, "59100") == [0]
+    assert set(match_location(snapshot, "city centre")) == {1, 4, 5}
+    assert match_location(snapshot, "bAnGsAr")[0] == 0
+    assert match_location(snapshot, "Kuala Lumpur", limit=None) == ranked_indexes(
+        ilike("kuala lumpur", ("city", "district", "address", "street_address", "name")))
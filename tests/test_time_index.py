@@ -0,0 +1,212 @@
+import pytest
+
+from time_index import BUCKET_MINUTES, DAYS, MINUTES_PER_DAY, MINUTES_PER_WEEK, OpenBitmap, TimeIndex, iter_bits
+
+
+def _hours(open_time, close_time, days=DAYS):
+    return {day: {"open": open_time, "close": close_time} for day in days}
+
+
+# 营业时间的边界情况，下标即快照下标
+OUTLETS = [
+    {"id": 1, "opening_hours": _hours("0800", "2200")},                       # 当天关门
+    {"id": 2, "opening_hours": _hours("1800", "0200")},                       # 跨午夜
+    {"id": 3, "opening_hours": _hours("2000", "0300", days=["sunday"])},      # 周日跨到周一
+    {"id": 4, "opening_hours": _hours("0730", "2400")},                       # 24:00 关门
+    {"id": 5, "opening_hours": _hours("1700", "0000")},                       # 00:00 关门（跨午夜）
+    {"id": 6, "opening_hours": dict(_hours("0900", "2100", days=DAYS[:5]),
+                                    saturday=_hours("1000", "0130")["saturday"], sunday=None)},
+    {"id": 7, "opening_hours": None, "is_24hours": True, "operating_hours": "24 hours"},
+    {"id": 8, "opening_hours": _hours("0600", "2300"), "operating_hours": "Open 24hrs"},
+    {"id": 9, "opening_hours": {"monday": {"open": "", "close": "2200"}, "tuesday": "closed"}},
+]
+
+
+def baseline_open(outlet, day, minute):
+    """原来按 HHMM 字符串逐行比较的营业判断（关门时刻为闭区间）
+
+    跨午夜的时段在次日凌晨的部分算前一天的营业（周日的凌晨部分绕回周一），与 TimeIndex 的约定一致；
+    24:00 关门与 00:00 关门相同，次日 00:00 仍算营业。
+    """
+    hours = outlet.get("opening_hours") or {}
+    t = f"{minute // 60:02d}{minute % 60:02d}"
+    today = hours.get(DAYS[day])
+    if isinstance(today, dict) and today.get("open") and today.get("close"):
+        open_time, close_time = today["open"], today["close"]
+        if close_time >= open_time:
+            if open_time <= t <= close_time:
+                return True
+        elif t >= open_time:
+            return True
+    yesterday = hours.get(DAYS[day - 1])
+    if isinstance(yesterday, dict) and yesterday.get("open") and yesterday.get("close"):
+        if yesterday["close"] < yesterday["open"] and t <= yesterday["close"]:
+            return True
+        if yesterday["close"] == "2400" and t == "0000":
+            return True
+    return False
+
+
+@pytest.fixture(scope="module")
+def index():
+    return TimeIndex(OUTLETS)
+
+
+def test_open_at_matches_baseline_every_minute_of_the_week(index):
+    for i, outlet in enumerate(OUTLETS):
+        if i in index.always_open:
+            continue
+        for week_minute in range(MINUTES_PER_WEEK):
+            day, minute = divmod(week_minute, MINUTES_PER_DAY)
+            expected = baseline_open(outlet, day, minute)
+            assert (i in index.open_at_week_minute(week_minute)) == expected, (outlet["id"], DAYS[day], minute)
+
+
+@pytest.mark.parametrize("day, minute, expected", [
+    ("monday", 21 * 60 + 59, True),
+    ("monday", 22 * 60, True),        # 关门时刻本身仍算营业（close+1）
+    ("monday", 22 * 60 + 1, False),
+    ("monday", 7 * 60 + 59, False),
+    ("monday", 8 * 60, True),
+])
+def test_close_minute_is_inclusive(index, day, minute, expected):
+    assert (0 in index.open_at(minute, [day])) == expected
+
+
+def test_overnight_span_is_split_at_midnight(index):
+    # 1800-0200：拆成当天 18:00-24:00 和次日 00:00-02:00 两段
+    assert (DAYS.index("monday") * MINUTES_PER_DAY + 18 * 60,
+            DAYS.index("tuesday") * MINUTES_PER_DAY) in index.intervals[1]
+    assert 1 in index.open_at(2 * 60, ["tuesday"])
+    assert 1 not in index.open_at(2 * 60 + 1, ["tuesday"])
+    assert 1 in index.open_at(23 * 60 + 59, ["monday"])
+
+
+def test_sunday_overnight_wraps_to_monday(index):
+    assert index.intervals[2] == [(DAYS.index("sunday") * MINUTES_PER_DAY + 20 * 60, MINUTES_PER_WEEK),
+                                  (0, 3 * 60 + 1)]
+    assert 2 in index.open_at(60, ["monday"])
+    assert 2 in index.open_at(3 * 60, ["monday"])
+    assert 2 not in index.open_at(3 * 60 + 1, ["monday"])
+    assert 2 not in index.open_at(60, ["sunday"])
+    # 周六跨午夜的凌晨部分落在周日
+    assert 5 in index.open_at(90, ["sunday"])
+    assert 5 not in index.open_at(91, ["sunday"])
+
+
+@pytest.mark.parametrize("i", [3, 4])
+def test_midnight_closes(index, i):
+    # 24:00 关门是当天时段，00:00 关门是跨午夜时段，两者都营业到次日 00:00（含）
+    assert i in index.open_at(23 * 60 + 59, ["friday"])
+    assert i in index.open_at(0, ["saturday"])
+    assert i not in index.open_at(1, ["saturday"])
+    assert i in index.closes_after(23 * 60 + 59, ["friday"])
+
+
+def test_24_hour_outlets_are_kept_out_of_the_intervals(index):
+    # is_24hours 标记或营业时间文本含 "24" 的店铺不参与区间，由 always_open 整体加入
+    assert index.always_open == [6, 7]
+    assert index.intervals[6] == [] and index.intervals[7] == []
+    assert index.with_always_open({0, 1}) == [6, 7, 0, 1]
+    # 但它们写明的开关门时间仍然参与开门/关门查询
+    assert 7 in index.opens_before(6 * 60, ["monday"], inclusive=True)
+
+
+def test_unparseable_hours_are_skipped(index):
+    assert index.intervals[8] == []
+    assert 8 not in index.opens_before(MINUTES_PER_DAY, DAYS, inclusive=True)
+
+
+def test_overnight_close_counts_as_next_day(index):
+    # 跨午夜的关门时间按 +24 小时比较
+    assert 1 in index.closes_after(23 * 60, ["monday"])
+    assert 1 not in index.closes_before(3 * 60, ["monday"])
+    assert 0 in index.closes_before(23 * 60, ["monday"])
+    latest, minute = index.latest_closing(["sunday"])
+    assert latest == [2] and minute == MINUTES_PER_DAY + 3 * 60
+    earliest, minute = index.earliest_closing(["sunday"])
+    assert 1 not in earliest and minute == 22 * 60
+
+
+# === OpenBitmap ===
+
+# 在桶内（不在 5 分钟边界上）开门或关门的店铺，以及上面的边界情况
+BUCKET_OUTLETS = OUTLETS + [
+    {"id": 10, "opening_hours": _hours("0803", "2157")},
+    {"id": 11, "opening_hours": _hours("2359", "0001")},
+    {"id": 12, "opening_hours": _hours("1200", "1200")},
+    {"id": 13, "opening_hours": _hours("0901", "2203")},                      # 结束于桶末尾前一分钟
+]
+
+
+def _mask(indexes):
+    mask = 0
+    for i in indexes:
+        mask |= 1 << i
+    return mask
+
+
+def test_bitmap_matches_time_index_every_minute_of_the_week():
+    index = TimeIndex(BUCKET_OUTLETS)
+    bitmap = OpenBitmap(index)
+    for week_minute in range(MINUTES_PER_WEEK):
+        assert bitmap.open_at_week_minute(week_minute) == _mask(index.open_at_week_minute(week_minute)), week_minute
+
+
+@pytest.mark.parametrize("day, minute", [
+    ("monday", 8 * 60), ("monday", 8 * 60 + 2), ("monday", 8 * 60 + 3), ("monday", 8 * 60 + 4),
+    ("monday", 21 * 60 + 57), ("monday", 21 * 60 + 58), ("monday", 22 * 60), ("monday", 22 * 60 + 1),
+    ("tuesday", 0), ("tuesday", 1), ("tuesday", 2), ("monday", 12 * 60), ("monday", 12 * 60 + 1),
+])
+def test_bitmap_bucket_edges(day, minute):
+    index = TimeIndex(BUCKET_OUTLETS)
+    bitmap = OpenBitmap(index)
+    expected = _mask(index.open_at(minute, [day])) | _mask(index.always_open)
+    assert bitmap.open_at(minute, [day]) == expected
+
+
+def test_bitmap_full_and_edge_buckets():
+    bitmap = OpenBitmap(TimeIndex(BUCKET_OUTLETS))
+    monday = DAYS.index("monday") * MINUTES_PER_DAY
+    bit = 1 << 0  # 0800-2200
+    # 08:00 开始的桶整桶营业；22:00 关门（含）所在的桶只有一分钟营业
+    assert bitmap._full[(monday + 8 * 60) // BUCKET_MINUTES] & bit
+    assert bitmap._edge[(monday + 22 * 60) // BUCKET_MINUTES] & bit
+    assert not bitmap._full[(monday + 22 * 60) // BUCKET_MINUTES] & bit
+    assert list(iter_bits(bitmap.always_open_mask)) == [6, 7]
+
+
+@pytest.mark.parametrize("new_row", [
+    {"id": 2, "opening_hours": _hours("0700", "2100")},                      # 跨午夜改为当天
+    {"id": 2, "opening_hours": _hours("2200", "0430", days=["sunday"])},     # 只剩周日并绕回周一
+    {"id": 2, "opening_hours": None},                                         # 不再营业
+    {"id": 2, "opening_hours": None, "is_24hours": True},                     # 改为24小时
+    {"id": 7, "opening_hours": _hours("0803", "2157")},                      # 24小时改为普通时段
+])
+def test_incremental_update_matches_full_rebuild(new_row):
+    before = BUCKET_OUTLETS
+    i = next(n for n, o in enumerate(before) if o["id"] == new_row["id"])
+    after = before[:i] + [new_row] + before[i + 1:]
+    index = TimeIndex(after)
+
+    updated = OpenBitmap(TimeIndex(before)).copy(index)
+    updated.update(i)
+    rebuilt = OpenBitmap(index)
+
+    assert updated._full == rebuilt._full
+    assert updated._edge == rebuilt._edge
+    assert updated.always_open_mask == rebuilt.always_open_mask
+    for week_minute in range(0, MINUTES_PER_WEEK, 7):
+        assert updated.open_at_week_minute(week_minute) == rebuilt.open_at_week_minute(week_minute)
+
+
+def test_snapshot_refresh_updates_the_bitmap_incrementally():
+    from outlet_store import OutletSnapshot
+
+    previous = OutletSnapshot(BUCKET_OUTLETS)
+    rows = [dict(o) for o in BUCKET_OUTLETS]
+    rows[1]["opening_hours"] = _hours("0700", "2100")
+    snapshot = OutletSnapshot(rows, previous=previous)
+    assert snapshot.open_bitmap_updates == 1
+    assert snapshot.open_bitmap._full == OpenBitmap(snapshot.time_index)._full
+    assert snapshot.open_bitmap._edge == OpenBitmap(snapshot.time_index)._edge
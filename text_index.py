@@ -0,0 +1,121 @@
+import re
+from bisect import bisect_left, bisect_right
+
+from time_index import iter_bits
+
+# 参与文本匹配的字段及其排序权重：城市/区域命中比地址中顺带出现更相关
+FIELD_WEIGHTS = {
+    'city': 3,
+    'district': 3,
+    'name': 2,
+    'street_address': 1,
+    'address': 1,
+}
+POSTCODE_WEIGHT = 4
+
+
+def normalize_postcode(value):
+    """邮编规范化为整数；不是 5 位数字（允许前后空白）的邮编返回 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if 0 <= value <= 99999 else None
+    match = re.fullmatch(r'\s*(\d{5})\s*', str(value))
+    return int(match.group(1)) if match else None
+
+
+class PostcodeIndex:
+    """按整数邮编排序的 (邮编, 店铺下标) 数组，精确查询和范围查询都用二分完成"""
+
+    def __init__(self, outlets):
+        pairs = []
+        for i, outlet in enumerate(outlets):
+            # 数据库的 postcode_int 生成列优先，旧库没有该列时在这里规范化
+            postcode = outlet.get('postcode_int')
+            if postcode is None:
+                postcode = normalize_postcode(outlet.get('postcode'))
+            if postcode is not None:
+                pairs.append((postcode, i))
+        pairs.sort()
+        self.keys = [p[0] for p in pairs]
+        self.idxs = [p[1] for p in pairs]
+
+    def between(self, start, end):
+        """邮编在闭区间 [start, end] 内的店铺下标"""
+        return self.idxs[bisect_left(self.keys, start):bisect_right(self.keys, end)]
+
+    def exact(self, postcode):
+        postcode = normalize_postcode(postcode)
+        return self.between(postcode, postcode) if postcode is not None else []
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TextIndex:
+    """name/address/street_address/district/city/postcode 的三元组倒排索引
+
+    每个三元组对应一个快照下标位图。子串查询先对查询词的所有三元组取交集得到
+    候选，再逐个确认子串确实出现在指定字段中，结果与 ILIKE '%词%' 一致。
+    少于 3 个字符的查询词没有三元组，直接在全部店铺上确认。
+    """
+
+    def __init__(self, outlets):
+        self.outlet_count = len(outlets)
+        self.all_mask = (1 << self.outlet_count) - 1
+        self.texts = {field: [(o.get(field) or '').lower() for o in outlets] for field in FIELD_WEIGHTS}
+        self._postings = {}
+        self.postcodes = PostcodeIndex(outlets)
+        for i, outlet in enumerate(outlets):
+            bit = 1 << i
+            grams = set()
+            for field in FIELD_WEIGHTS:
+                grams |= _trigrams(self.texts[field][i])
+            for gram in grams:
+                self._postings[gram] = self._postings.get(gram, 0) | bit
+
+    def candidates(self, term):
+        """可能包含 term 的店铺位图（三元组交集）"""
+        mask = self.all_mask
+        for gram in _trigrams(term):
+            mask &= self._postings.get(gram, 0)
+            if not mask:
+                break
+        return mask
+
+    def search(self, terms, fields, postcode_ranges=()):
+        """在 fields 中做子串匹配（或邮编落在 postcode_ranges 的某个闭区间内），返回 {快照下标: 相关度}
+
+        相关度为命中的 (查询词, 字段) 权重之和，同时命中多个词/字段的店铺排在前面。
+        """
+        scores = {}
+        for term in terms:
+            term = term.lower()
+            if not term:
+                continue
+            for i in iter_bits(self.candidates(term)):
+                score = sum(FIELD_WEIGHTS[f] for f in fields if term in self.texts[f][i])
+                if score:
+                    scores[i] = scores.get(i, 0) + score
+        matched = set()
+        for start, end in postcode_ranges:
+            matched.update(self.postcodes.between(start, end))
+        for i in matched:
+            scores[i] = scores.get(i, 0) + POSTCODE_WEIGHT
+        return scores
+
+
+def merge_scores(*score_maps):
+    """合并多次 search 的结果，相关度相加"""
+    merged = {}
+    for scores in score_maps:
+        for i, score in scores.items():
+            merged[i] = merged.get(i, 0) + score
+    return merged
+
+
+def ranked_indexes(scores, limit=None):
+    """按相关度降序、快照顺序升序排列下标"""
+    order = sorted(scores, key=lambda i: (-scores[i], i))
+    return order[:limit] if limit is not None else order
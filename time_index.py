@@ -0,0 +1,309 @@
+import re
+from bisect import bisect_left, bisect_right
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+WEEKDAYS = DAYS[:5]
+WEEKEND = DAYS[5:]
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def days_for(is_weekend):
+    """周末/工作日对应的星期列表"""
+    return WEEKEND if is_weekend else WEEKDAYS
+
+
+def parse_hhmm(value):
+    """把 "0800" / "800" / "08:00" 解析为当天的分钟数，无法解析时返回 None"""
+    if not value:
+        return None
+    text = str(value).strip()
+    match = re.fullmatch(r'(\d{1,2}):?(\d{2})', text)
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 24 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+
+def format_hhmm(minutes):
+    """分钟数转回 "HHMM" 字符串"""
+    return f"{minutes // 60:02d}{minutes % 60:02d}"
+
+
+def is_24hour_outlet(outlet):
+    """与原有查询保持一致：is_24hours 标记或营业时间文本中含 "24" """
+    return bool(outlet.get('is_24hours')) or '24' in (outlet.get('operating_hours') or '')
+
+
+class _SortedColumn:
+    """按分钟排序的 (分钟, 店铺下标) 列，支持二分范围查询"""
+
+    def __init__(self, pairs):
+        pairs.sort()
+        self.keys = [p[0] for p in pairs]
+        self.idxs = [p[1] for p in pairs]
+
+    def below(self, minute, inclusive=False):
+        end = bisect_right(self.keys, minute) if inclusive else bisect_left(self.keys, minute)
+        return self.idxs[:end]
+
+    def above(self, minute):
+        return self.idxs[bisect_right(self.keys, minute):]
+
+    def between(self, low, high):
+        return self.idxs[bisect_left(self.keys, low):bisect_right(self.keys, high)]
+
+
+class TimeIndex:
+    """营业时间的分钟级周索引
+
+    每家店每天的营业时段被转换为一周内的分钟区间 [start, end)，跨午夜的时段在
+    日界处拆分。开门/关门时间按天排好序，"在 T 之前开门"、"在 T 之后关门"等
+    查询通过二分完成；"在 T 时营业"通过对区间端点预先切分出的基本段做二分定位。
+    所有查询返回快照中的店铺下标。
+    """
+
+    def __init__(self, outlets):
+        self.outlet_count = len(outlets)
+        self.always_open = [i for i, o in enumerate(outlets) if is_24hour_outlet(o)]
+        self.intervals = [[] for _ in outlets]
+
+        opens = [[] for _ in DAYS]
+        closes = [[] for _ in DAYS]
+        closes_raw = [[] for _ in DAYS]
+        same_day_closes = [[] for _ in DAYS]
+
+        always_open = set(self.always_open)
+        for i, outlet in enumerate(outlets):
+            for d, open_min, close_min in self._day_hours(outlet):
+                overnight = close_min < open_min
+                close_ext = close_min + MINUTES_PER_DAY if overnight else close_min
+                opens[d].append((open_min, i))
+                closes[d].append((close_ext, i))
+                closes_raw[d].append((close_min, i))
+                if not overnight:
+                    same_day_closes[d].append((close_min, i))
+                # 24小时店铺在"营业中"类查询里整体加入，不参与区间
+                if i not in always_open:
+                    # 原查询对关门时刻是闭区间，这里用 close+1 的半开区间表示
+                    self._add_span(i, d * MINUTES_PER_DAY + open_min, d * MINUTES_PER_DAY + close_ext + 1)
+
+        self._opens = [_SortedColumn(p) for p in opens]
+        self._closes = [_SortedColumn(p) for p in closes]
+        self._closes_raw = [_SortedColumn(p) for p in closes_raw]
+        self._same_day_closes = [_SortedColumn(p) for p in same_day_closes]
+        self._build_segments()
+
+    @staticmethod
+    def _day_hours(outlet):
+        """逐天产出 (星期下标, 开门分钟, 关门分钟)，跳过缺失或无法解析的数据"""
+        hours = outlet.get('opening_hours') or {}
+        if not isinstance(hours, dict):
+            return
+        for d, day in enumerate(DAYS):
+            day_hours = hours.get(day)
+            if not day_hours or not isinstance(day_hours, dict):
+                continue
+            open_min = parse_hhmm(day_hours.get('open'))
+            close_min = parse_hhmm(day_hours.get('close'))
+            if open_min is None or close_min is None:
+                continue
+            yield d, open_min, close_min
+
+    def _add_span(self, i, start, end):
+        """把一周内的区间按日界拆分后登记，超出周日末尾的部分绕回周一"""
+        while start < end:
+            day_end = (start // MINUTES_PER_DAY + 1) * MINUTES_PER_DAY
+            piece_end = min(end, day_end)
+            self.intervals[i].append((start % MINUTES_PER_WEEK, (piece_end - 1) % MINUTES_PER_WEEK + 1))
+            start = piece_end
+
+    def _build_segments(self):
+        """把所有区间端点排序，预先计算每个基本段内营业的店铺"""
+        events = {}
+        for i, spans in enumerate(self.intervals):
+            for start, end in spans:
+                events.setdefault(start, []).append((i, 1))
+                events.setdefault(end, []).append((i, -1))
+        self._breakpoints = sorted(events)
+        self._segments = []
+        active = {}
+        for point in self._breakpoints:
+            for i, delta in events[point]:
+                count = active.get(i, 0) + delta
+                if count:
+                    active[i] = count
+                else:
+                    active.pop(i, None)
+            self._segments.append(frozenset(active))
+
+    # === 查询 ===
+
+    def open_at_week_minute(self, week_minute):
+        """一周中某一分钟正在营业的店铺（区间刺探，不含24小时店铺）"""
+        pos = bisect_right(self._breakpoints, week_minute % MINUTES_PER_WEEK) - 1
+        return self._segments[pos] if pos >= 0 else frozenset()
+
+    def open_at(self, minute, days):
+        """指定星期中任一天的 minute 时刻营业"""
+        matched = set()
+        for day in days:
+            matched |= self.open_at_week_minute(DAYS.index(day) * MINUTES_PER_DAY + minute)
+        return matched
+
+    def open_after(self, minute, days):
+        """指定星期中任一天在 minute 之后仍营业（当天时段的结束时间晚于 minute）"""
+        return self._collect(self._closes, days, lambda col: col.above(minute))
+
+    def opens_before(self, minute, days, inclusive=False):
+        return self._collect(self._opens, days, lambda col: col.below(minute, inclusive))
+
+    def opens_after(self, minute, days):
+        return self._collect(self._opens, days, lambda col: col.above(minute))
+
+    def opens_near(self, minute, days, tolerance=30):
+        return self._collect(self._opens, days, lambda col: col.between(minute - tolerance, minute + tolerance))
+
+    def closes_before(self, minute, days):
+        """跨午夜的关门时间按次日计算（+24小时）"""
+        return self._collect(self._closes, days, lambda col: col.below(minute))
+
+    def closes_after(self, minute, days):
+        return self._collect(self._closes, days, lambda col: col.above(minute))
+
+    def closes_near(self, minute, days, tolerance=30):
+        """按当天钟点比较关门时间（不加24小时）"""
+        return self._collect(self._closes_raw, days, lambda col: col.between(minute - tolerance, minute + tolerance))
+
+    def earliest_opening(self, days, candidates=None):
+        return self._extreme(self._opens, days, candidates, lowest=True)
+
+    def latest_opening(self, days, candidates=None):
+        return self._extreme(self._opens, days, candidates, lowest=False)
+
+    def earliest_closing(self, days, candidates=None):
+        """最早关门：忽略跨午夜关门的时段"""
+        return self._extreme(self._same_day_closes, days, candidates, lowest=True)
+
+    def latest_closing(self, days, candidates=None):
+        """最晚关门：跨午夜的关门时间按 +24 小时比较，返回的分钟数可能 >= 1440"""
+        return self._extreme(self._closes, days, candidates, lowest=False)
+
+    def with_always_open(self, matched):
+        """24小时店铺在前，其余按快照顺序排列"""
+        always_open = set(self.always_open)
+        return self.always_open + sorted(i for i in matched if i not in always_open)
+
+    @staticmethod
+    def _collect(columns, days, select):
+        matched = set()
+        for day in days:
+            matched.update(select(columns[DAYS.index(day)]))
+        return matched
+
+    @staticmethod
+    def _extreme(columns, days, candidates, lowest):
+        """在指定星期中找最小/最大时间及对应的全部店铺，返回 (下标列表, 分钟数或 None)"""
+        best = None
+        for day in days:
+            col = columns[DAYS.index(day)]
+            order = range(len(col.keys)) if lowest else range(len(col.keys) - 1, -1, -1)
+            for pos in order:
+                if candidates is None or col.idxs[pos] in candidates:
+                    value = col.keys[pos]
+                    if best is None or (value < best if lowest else value > best):
+                        best = value
+                    break
+        if best is None:
+            return [], None
+        matched = set()
+        for day in days:
+            for i in columns[DAYS.index(day)].between(best, best):
+                if candidates is None or i in candidates:
+                    matched.add(i)
+        return sorted(matched), best
+
+
+BUCKET_MINUTES = 5
+BUCKETS_PER_DAY = MINUTES_PER_DAY // BUCKET_MINUTES
+BUCKETS_PER_WEEK = 7 * BUCKETS_PER_DAY
+
+
+def iter_bits(mask):
+    """按从低到高的顺序产出位图中为 1 的位下标"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class OpenBitmap:
+    """"营业中"位图表：一周按 5 分钟切成 2016 个时间桶，每个桶一个位集合，第 i 位表示店铺 i 营业
+
+    整桶都在营业的店铺记在 full 中；只覆盖桶的一部分（在桶内开门或关门）的店铺记在
+    edge 中，查询时按 TimeIndex 的区间精确判断，所以结果与逐分钟比较一致。
+    24小时店铺单独记为一个掩码，不占用时间桶。
+    """
+
+    def __init__(self, time_index):
+        self.time_index = time_index
+        self._full = [0] * BUCKETS_PER_WEEK
+        self._edge = [0] * BUCKETS_PER_WEEK
+        self.always_open_mask = 0
+        for i in time_index.always_open:
+            self.always_open_mask |= 1 << i
+        for i, spans in enumerate(time_index.intervals):
+            self._set_bits(i, spans)
+
+    def _set_bits(self, i, spans):
+        bit = 1 << i
+        for start, end in spans:
+            first, last = start // BUCKET_MINUTES, (end - 1) // BUCKET_MINUTES
+            for b in range(first, last + 1):
+                if start <= b * BUCKET_MINUTES and (b + 1) * BUCKET_MINUTES <= end:
+                    self._full[b] |= bit
+                else:
+                    self._edge[b] |= bit
+
+    def copy(self, time_index):
+        """复制位图并绑定到新的 TimeIndex，用于增量更新"""
+        clone = OpenBitmap.__new__(OpenBitmap)
+        clone.time_index = time_index
+        clone._full = list(self._full)
+        clone._edge = list(self._edge)
+        clone.always_open_mask = self.always_open_mask
+        return clone
+
+    def update(self, i):
+        """店铺 i 的营业时间变化后，只重算这一位"""
+        bit = 1 << i
+        keep = ~bit
+        for b in range(BUCKETS_PER_WEEK):
+            if (self._full[b] | self._edge[b]) & bit:
+                self._full[b] &= keep
+                self._edge[b] &= keep
+        if i in self.time_index.always_open:
+            self.always_open_mask |= bit
+        else:
+            self.always_open_mask &= keep
+        self._set_bits(i, self.time_index.intervals[i])
+
+    def open_at_week_minute(self, week_minute):
+        """一周中某一分钟正在营业的店铺位图（不含24小时店铺）"""
+        week_minute %= MINUTES_PER_WEEK
+        b = week_minute // BUCKET_MINUTES
+        mask = self._full[b]
+        for i in iter_bits(self._edge[b] & ~mask):
+            if any(start <= week_minute < end for start, end in self.time_index.intervals[i]):
+                mask |= 1 << i
+        return mask
+
+    def open_at(self, minute, days):
+        """指定星期中任一天的 minute 时刻营业的店铺位图（含24小时店铺）"""
+        mask = self.always_open_mask
+        for day in days:
+            mask |= self.open_at_week_minute(DAYS.index(day) * MINUTES_PER_DAY + minute)
+        return mask